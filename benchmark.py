@@ -0,0 +1,404 @@
+#! /usr/bin/env python3
+
+# Benchmarks for sessions.py on synthetic VitalView exports
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import textwrap
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+import sessions
+
+ACTIVITY_PATTERNS = ['random', 'circadian', 'bouts']
+GROUP_NAMES = ['wild', '10^10', '10^11', 'Null']
+
+#################################################################################
+### Section below contains functions for generating synthetic VitalView data  ###
+#################################################################################
+
+def boutPhases(minutes, meanRun, meanRest, rng):
+    """Alternating run (True) and rest (False) phases with geometrically
+    distributed lengths, starting at a random point of a bout"""
+    numPairs = minutes // (meanRun + meanRest) + 10
+
+    while True:
+        lengths = np.column_stack((rng.geometric(1 / meanRun, numPairs),
+                                   rng.geometric(1 / meanRest, numPairs))).ravel()
+        if lengths.sum() > 2 * minutes:
+            break
+        numPairs *= 2
+
+    phases = np.repeat(np.tile([True, False], numPairs), lengths)
+    offset = rng.integers(0, minutes)
+
+    return phases[offset:offset + minutes]
+
+
+def generateTurns(numAnimals, minutes, startTime, activity='bouts', nanRate=0.0, seed=0):
+    """Minute by minute wheel turns (minutes x animals, float with NaN for
+    missing values) for one of the ACTIVITY_PATTERNS:
+        random      every minute is a run with the same probability
+        circadian   runs are much more likely during the dark phase (18:00-6:00)
+        bouts       runs and rests come in bouts of a few to tens of minutes"""
+    rng = np.random.default_rng(seed)
+    shape = (minutes, numAnimals)
+
+    if activity == 'random':
+        running = rng.random(shape) < 0.3
+    elif activity == 'circadian':
+        hours = pd.date_range(startTime, periods=minutes, freq='min').hour.values
+        isDark = (hours >= 18) | (hours < 6)
+        running = rng.random(shape) < np.where(isDark, 0.6, 0.05)[:, None]
+    elif activity == 'bouts':
+        running = np.column_stack([boutPhases(minutes, 8, 25, rng) for i in range(numAnimals)])
+    else:
+        raise ValueError("Unknown activity pattern '{0}'".format(activity))
+
+    turns = np.where(running, rng.poisson(25, shape) + 1, 0).astype(float)
+    turns[rng.random(shape) < nanRate] = np.nan
+
+    return turns
+
+
+def writeVitalViewCsv(outputPath, turns, startTime):
+    """Write turns in the VitalView export layout: the 'Channel Name:/Channel
+    Group:/Sensor Type:' header rows, then one row per minute with the time
+    as 'month/day/yy hour:minute' (no leading zeros) and empty missing values"""
+    numAnimals = turns.shape[1]
+    times = pd.date_range(startTime, periods=len(turns), freq='min')
+    timeStrings = (times.month.astype(str) + '/' + times.day.astype(str) + '/'
+                   + (times.year % 100).map('{:02d}'.format) + ' '
+                   + times.hour.astype(str) + ':' + times.minute.map('{:02d}'.format))
+
+    headerRows = [['T{0}'.format(1000 + i) for i in range(numAnimals)],
+                  [GROUP_NAMES[i % len(GROUP_NAMES)] for i in range(numAnimals)],
+                  ['0'] * numAnimals]
+
+    with open(outputPath, 'w', newline='') as f:
+        for name, row in zip(sessions.HEADER_NAMES, headerRows):
+            f.write(','.join([name] + row) + '\n')
+        body = DataFrame(turns, index=timeStrings).astype('Int64')
+        body.to_csv(f, header=False)
+
+
+def generateVitalViewCsv(outputPath, numAnimals, days, activity='bouts', nanRate=0.0,
+    seed=0, startTime='2017-08-21 10:01'):
+    """Make a synthetic VitalView csv export. Returns the number of rows."""
+    minutes = int(days * 24 * 60)
+    turns = generateTurns(numAnimals, minutes, startTime, activity, nanRate, seed)
+    writeVitalViewCsv(outputPath, turns, startTime)
+
+    return minutes
+
+
+#######################################################
+### Section below contains functions for timing     ###
+#######################################################
+
+def timeStage(stageTimes, name, func, *args, **kwargs):
+    """Run func and add its wall and CPU time (seconds) to stageTimes[name]"""
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    result = func(*args, **kwargs)
+    stageTimes.setdefault(name, []).append({'wall':time.perf_counter() - wallStart,
+                                            'cpu':time.process_time() - cpuStart})
+    return result
+
+
+def runPipeline(inputPath, outputDir, stageTimes, customGrpByHr, plots=True, legacy=False):
+    """Time each step of the sessions.py pipeline once, in the same order
+    analyzeCohort() runs them. Progress messages are swallowed."""
+    cohortName = os.path.splitext(os.path.basename(inputPath))[0]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        rawDf = timeStage(stageTimes, 'load', sessions.readVitalViewCsv, inputPath)
+        timeStage(stageTimes, 'checkDataQuality', sessions.checkDataQuality, rawDf)
+        formattedTurnsDf, formattedDistanceDf, nullRows = timeStage(stageTimes,
+            'formatTurnsDf', sessions.formatTurnsDf, rawDf)
+
+        # Skip the first hour, the same way -S is normally used
+        customStart = rawDf.index[0] + pd.Timedelta(hours=1)
+        customStart = '{0.month}/{0.day}/{0.year} {0.hour}:{0.minute}'.format(customStart)
+        selectedDistanceDf = timeStage(stageTimes, 'customStartDateTime',
+            sessions.customStartDateTime, formattedDistanceDf, customStart, None)
+
+        baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+        timeStage(stageTimes, 'formatHourly', sessions.formatHourly, selectedDistanceDf, baseParam)
+        timeStage(stageTimes, 'formatDaily', sessions.formatDaily, selectedDistanceDf, baseParam)
+        timeStage(stageTimes, 'resampleByHr', sessions.resampleByHr, selectedDistanceDf,
+                  customGrpByHr, baseParam)
+        binnedDict = timeStage(stageTimes, 'binAllRules', sessions.binAllRules,
+                               selectedDistanceDf, customGrpByHr, baseParam)
+        hourlyDf = binnedDict['H']
+        dailyDf = binnedDict['1d']
+        customDfList = [{i + 'H':binnedDict[i + 'H']} for i in customGrpByHr]
+
+        sessionTable = timeStage(stageTimes, 'calcSessions', sessions.calcSessions,
+                                 selectedDistanceDf)
+        reformattedTable = timeStage(stageTimes, 'reformatSessions',
+                                     sessions.reformatSessions, sessionTable)
+        percentRunRestDf = timeStage(stageTimes, 'calcPercentRunRest',
+                                     sessions.calcPercentRunRest, reformattedTable)
+
+        # makeCohortDir() puts the cohort folder in the current directory
+        workingDir = os.getcwd()
+        os.chdir(outputDir)
+        try:
+            artifacts = [name for name in sessions.OUTPUT_ARTIFACTS if name != 'graphs']
+            timeStage(stageTimes, 'csvOutput', sessions.outputAllToFile, rawDf,
+                formattedTurnsDf, formattedDistanceDf, selectedDistanceDf, baseParam,
+                hourlyDf, dailyDf, customDfList, sessionTable, reformattedTable,
+                percentRunRestDf, nullRows, cohortName, 'csv', artifacts)
+        finally:
+            os.chdir(workingDir)
+
+        if plots:
+            timeStage(stageTimes, 'plotGraphs', sessions.plotGraphs, percentRunRestDf,
+                      hourlyDf, dailyDf, os.path.join(outputDir, cohortName), cohortName)
+
+        if legacy:
+            legacyDf = timeStage(stageTimes, 'legacyLoad', pd.read_csv, inputPath,
+                                 index_col=[0], header=None, low_memory=False)
+            timeStage(stageTimes, 'formatRawDf', sessions.formatRawDf, legacyDf)
+            # The row by row loop can't handle missing values, count them as rest
+            # the same way calcSessions() does
+            timeStage(stageTimes, 'calcSessionsLegacy', sessions.calcSessionsLegacy,
+                      selectedDistanceDf.fillna(0))
+
+        shutil.rmtree(os.path.join(outputDir, cohortName), ignore_errors=True)
+
+
+def summarizeStages(stageTimes):
+    """Best (minimum) and mean wall time and the CPU time of the best run of
+    every stage, plus the raw per repeat timings"""
+    summary = {}
+    for name, runs in stageTimes.items():
+        best = min(runs, key=lambda run: run['wall'])
+        summary[name] = {'wall':best['wall'], 'cpu':best['cpu'],
+                         'meanWall':float(np.mean([run['wall'] for run in runs])),
+                         'runs':runs}
+    return summary
+
+
+def benchmarkCase(workDir, numAnimals, days, activity, nanRate, repeats, customGrpByHr,
+    plots=True, legacy=False, seed=0):
+    """Generate one synthetic file and time the pipeline on it repeats times"""
+    caseName = 'bench_{0}animals_{1}days_{2}'.format(numAnimals, days, activity)
+    inputPath = os.path.join(workDir, caseName + '.csv')
+
+    genStart = time.perf_counter()
+    rows = generateVitalViewCsv(inputPath, numAnimals, days, activity, nanRate, seed)
+    genTime = time.perf_counter() - genStart
+
+    stageTimes = {}
+    for i in range(repeats):
+        runPipeline(inputPath, workDir, stageTimes, customGrpByHr, plots, legacy)
+
+    case = {'animals':numAnimals, 'days':days, 'activity':activity, 'nanRate':nanRate,
+            'rows':rows, 'fileBytes':os.path.getsize(inputPath),
+            'generateSeconds':genTime, 'stages':summarizeStages(stageTimes)}
+    os.remove(inputPath)
+
+    return case
+
+
+def timeCommand(stageTimes, name, command, cwd=None):
+    """Run command in a new process and add its wall time and the CPU time
+    of the process (seconds) to stageTimes[name]"""
+    childStart = os.times()
+    wallStart = time.perf_counter()
+    subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, check=True)
+    wallTime = time.perf_counter() - wallStart
+    childEnd = os.times()
+    stageTimes.setdefault(name, []).append({'wall':wallTime,
+        'cpu':(childEnd.children_user - childStart.children_user
+               + childEnd.children_system - childStart.children_system)})
+
+
+def benchmarkStartup(repeats):
+    """Time how long a fresh Python process takes to import sessions and to
+    print the sessions.py --help text, i.e. before any data is read"""
+    sessionsPath = os.path.abspath(sessions.__file__)
+    sessionsDir = os.path.dirname(sessionsPath)
+
+    stageTimes = {}
+    for i in range(repeats):
+        timeCommand(stageTimes, 'importSessions', [sys.executable, '-c', 'import sessions'],
+                    sessionsDir)
+        timeCommand(stageTimes, 'helpText', [sys.executable, sessionsPath, '--help'])
+
+    return {'stages':summarizeStages(stageTimes)}
+
+
+def caseKey(case):
+    return (case['animals'], case['days'], case['activity'], case['nanRate'])
+
+
+def gitRevision():
+    """Commit of the sessions.py checkout, None if it isn't a git repository"""
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(sessions.__file__)),
+            capture_output=True, text=True, check=True)
+        return revision.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environmentInfo():
+    return {'sessionsVersion':sessions.VERSION, 'gitRevision':gitRevision(),
+            'python':platform.python_version(), 'numpy':np.__version__,
+            'pandas':pd.__version__, 'platform':platform.platform(),
+            'cpuCount':os.cpu_count(), 'date':time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def printStages(stages):
+    print('    {0:<22}{1:>12}{2:>12}'.format('stage', 'wall (s)', 'cpu (s)'))
+    for name, stage in stages.items():
+        print('    {0:<22}{1:>12.4f}{2:>12.4f}'.format(name, stage['wall'], stage['cpu']))
+
+
+def printCase(case):
+    print('\n{animals} animals, {days} days, {activity} activity, NaN rate {nanRate}'
+          ' ({rows} rows, {fileBytes} bytes)'.format(**case))
+    printStages(case['stages'])
+
+
+def compareStages(label, stages, baseStages, tolerance, regressions):
+    """Used in compareResults(). Print the ratios for the stages of one case
+    and add the ones more than tolerance times slower to regressions"""
+    for name, stage in stages.items():
+        if name not in baseStages:
+            continue
+        ratio = stage['wall'] / max(baseStages[name]['wall'], 1e-9)
+        flag = ''
+        if ratio > tolerance:
+            flag = '  <-- slower'
+            regressions.append((label, name, ratio))
+        print('    {0} {1:<22}{2:>8.2f}x{3}'.format(label, name, ratio, flag))
+
+
+def compareResults(results, baselineResults, tolerance):
+    """Print the ratio of each stage's best wall time to the baseline's for
+    the cases (and the startup times) both results have. Returns the (case,
+    stage, ratio) of stages more than tolerance times slower."""
+    baselineCases = {caseKey(case):case for case in baselineResults['cases']}
+    regressions = []
+
+    print('\nCompared to {0} ({1}):'.format(baselineResults['environment']['gitRevision'],
+                                         baselineResults['environment']['date']))
+    if results.get('startup') != None and baselineResults.get('startup') != None:
+        compareStages('startup', results['startup']['stages'],
+                      baselineResults['startup']['stages'], tolerance, regressions)
+
+    for case in results['cases']:
+        baseCase = baselineCases.get(caseKey(case))
+        if baseCase == None:
+            continue
+        compareStages(caseKey(case), case['stages'], baseCase['stages'], tolerance, regressions)
+
+    return regressions
+
+
+def parseUserInput(argv=None):
+    """Use argparse to handle user input for the benchmark"""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""%(prog)s generates synthetic VitalView csv exports and
+        times each step of the sessions.py pipeline on them. Every combination
+        of --animals, --days and --activity is a separate case.""",
+        epilog=textwrap.dedent("""\
+        Example:
+            python benchmark.py --animals 8,32,128 --days 1,7 -o results.json
+            python benchmark.py --animals 8,32,128 --days 1,7 --compare results.json"""))
+
+    listOf = lambda cast: (lambda x: [cast(i) for i in x.split(',')])
+
+    parser.add_argument('--animals', default=[8, 32], type=listOf(int),
+        help="Comma separated animal (column) counts. Defaults to 8,32")
+    parser.add_argument('--days', default=[1, 7], type=listOf(float),
+        help="Comma separated recording lengths in days. Defaults to 1,7")
+    parser.add_argument('--activity', default=['bouts'], type=listOf(str),
+        help="Comma separated activity patterns from: {0}. Defaults to bouts".format(
+            ', '.join(ACTIVITY_PATTERNS)))
+    parser.add_argument('--nanRate', default=0.001, type=float,
+        help="Fraction of missing values. Defaults to 0.001")
+    parser.add_argument('-H', '--customGrpByHr', default=['4', '6', '12'], type=listOf(str),
+        help="Comma separated custom hour groupings. Defaults to 4,6,12")
+    parser.add_argument('-r', '--repeats', default=3, type=int,
+        help="Times to run the pipeline on each case, the best time is reported. Defaults to 3")
+    parser.add_argument('--noPlots', default=False, action='store_true',
+        help="Don't time plotGraphs")
+    parser.add_argument('--noStartup', default=False, action='store_true',
+        help="Don't time importing sessions and sessions.py --help in a new process")
+    parser.add_argument('--legacy', default=False, action='store_true',
+        help="Also time the original loader, formatRawDf and calcSessionsLegacy (slow)")
+    parser.add_argument('--seed', default=0, type=int, help="Random seed. Defaults to 0")
+    parser.add_argument('-o', '--output', default='benchmark_results.json',
+        help="Where to write the JSON results. Defaults to benchmark_results.json")
+    parser.add_argument('--compare', default=None,
+        help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', default=1.25, type=float,
+        help="With --compare, exit with status 1 if a stage is this many times slower. Defaults to 1.25")
+    parser.add_argument('--generate', default=None, metavar='CSV',
+        help="Only write one synthetic file (first --animals/--days/--activity value) and exit")
+
+    args = parser.parse_args(argv)
+
+    for activity in args.activity:
+        if activity not in ACTIVITY_PATTERNS:
+            parser.error("unknown activity pattern '{0}'".format(activity))
+
+    return args
+
+
+def main(argv=None):
+    args = parseUserInput(argv)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    if args.generate != None:
+        rows = generateVitalViewCsv(args.generate, args.animals[0], args.days[0],
+                                    args.activity[0], args.nanRate, args.seed)
+        print('Wrote {0} rows to {1}'.format(rows, args.generate))
+        return
+
+    results = {'environment':environmentInfo(), 'startup':None, 'cases':[]}
+    if not args.noStartup:
+        results['startup'] = benchmarkStartup(args.repeats)
+        print('\nStartup, new Python process')
+        printStages(results['startup']['stages'])
+
+    with tempfile.TemporaryDirectory() as workDir:
+        for numAnimals in args.animals:
+            for days in args.days:
+                for activity in args.activity:
+                    case = benchmarkCase(workDir, numAnimals, days, activity,
+                        args.nanRate, args.repeats, args.customGrpByHr,
+                        not args.noPlots, args.legacy, args.seed)
+                    printCase(case)
+                    results['cases'].append(case)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults written to {0}'.format(args.output))
+
+    if args.compare != None:
+        with open(args.compare) as f:
+            regressions = compareResults(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\n{0} stage(s) more than {1}x slower'.format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
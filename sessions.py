@@ -5,16 +5,96 @@ import re
 import os
 import csv
 import sys
+import glob
+import time
+import io
+import contextlib
+import hashlib
+import json
+import pickle
+import shutil
+import pathlib
+import sqlite3
+import threading
+import traceback
+import cProfile
 import argparse
 import textwrap
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pandas import Series, DataFrame
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+# matplotlib is imported inside the plotting functions, so importing this
+# module (or running it without plots) doesn't pay for it
 
 # Regular Expressions and static (unchanging) variables 
+VERSION = '0.5.0'
 FILE_NAME_REGEXP = r'(.+)\.(.+)'
+OUTPUT_FORMATS = ['csv', 'parquet', 'npz']
+OUTPUT_ARTIFACTS = ['raw', 'null', 'turns', 'distance', 'selected', 'bins', 
+                    'percent', 'sessions', 'groups', 'circadian', 'synchrony', 'graphs']
+DEFAULT_CHUNK_SIZE = 10000 # rows per chunk for --incremental if --chunkSize isn't given
+DEFAULT_PLOT_POINTS = 2000 # most points per line on the hourly graph pages, 0 draws them all
+COMPRESSIONS = {'gzip':'.gz', 'zstd':'.zst', 'lz4':'.lz4'} # --compress codecs and file extensions
+COMPRESS_LEVELS = {'gzip':(0, 9, 6), 'zstd':(1, 22, 3), 'lz4':(0, 16, 0)} # lowest, highest, default
+CSV_WRITE_ROWS = 10000 # rows formatted at a time when writing a csv table
+OUTPUT_HEADER_LEVELS = ['sample', 'group', 'sensor', 'stat'] # column level names in the csv tables
+SESSION_COLUMNS = [('run_start', np.int64), ('run_end', np.int64), ('run_mins', np.int64),
+                   ('run_dist(m)', float), ('rest_start', np.int64), ('rest_end', np.int64),
+                   ('rest_mins', np.int64), ('run_obs', bool), ('rest_obs', bool)]
+SESSION_CSV_COLUMNS = ['run_start', 'run_end', 'run_mins', 'run_dist(m)',
+                       'rest_start', 'rest_end', 'rest_mins']
+SESSION_LAYOUTS = ['animal', 'long', 'both'] # --sessionLayout: one table per animal, one for all, or both
+DEFAULT_CACHE_SIZE = 2048 # MB, largest size of the --cacheDir cache
+CACHE_VERSION = 1 # part of the --cacheDir key, bump when readVitalViewCsv() or the entry layout changes
+FILL_POLICIES = ['nan', 'zero', 'ffill', 'bfill'] # how --reindex fills missing minutes
+MINUTE_NS = 60 * 10**9
+DAY_MINUTES = 24 * 60
+SYNC_BLOCK_ROWS = 4096 # minutes (or run bout pieces) per block of the --synchrony matrix sums
+FOLLOW_INTERVAL = 5 # seconds between checks for new rows in follow mode
+STORE_TIMEOUT = 600 # seconds to wait for another process writing to the --store database
+STORE_CHUNK_ROWS = 100000 # minutes of one animal per executemany() when filling the --store
+STORE_COLUMNS = {'minutes':['time', 'distance'], 'bins':['rule', 'time', 'distance'],
+                 'sessions':['session', 'run_start', 'run_end', 'run_mins', 'run_dist',
+                             'velocity', 'rest_start', 'rest_end', 'rest_mins'],
+                 'animals':['position']} # columns the query subcommand returns
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cohorts (
+    cohort_id INTEGER PRIMARY KEY,
+    cohort TEXT NOT NULL UNIQUE,
+    stored_at TEXT);
+CREATE TABLE IF NOT EXISTS animals (
+    animal_id INTEGER PRIMARY KEY,
+    cohort_id INTEGER NOT NULL REFERENCES cohorts,
+    sample TEXT, group_name TEXT, sensor TEXT, position INTEGER,
+    UNIQUE (cohort_id, sample, group_name, sensor));
+CREATE INDEX IF NOT EXISTS animals_group ON animals (group_name, cohort_id);
+CREATE INDEX IF NOT EXISTS animals_sample ON animals (sample, cohort_id);
+CREATE TABLE IF NOT EXISTS minutes (
+    animal_id INTEGER NOT NULL, time TEXT NOT NULL, distance REAL,
+    PRIMARY KEY (animal_id, time)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS bins (
+    animal_id INTEGER NOT NULL, rule TEXT NOT NULL, time TEXT NOT NULL, distance REAL,
+    PRIMARY KEY (animal_id, rule, time)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sessions (
+    animal_id INTEGER NOT NULL, session INTEGER NOT NULL,
+    run_start TEXT, run_end TEXT, run_mins INTEGER, run_dist REAL, velocity REAL,
+    rest_start TEXT, rest_end TEXT, rest_mins INTEGER,
+    PRIMARY KEY (animal_id, session)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sessions_run_start ON sessions (run_start);
+"""
+PROFILE_STAGES = ['load', 'checkDataQuality', 'formatTurnsDf', 'customStartDateTime', 'binAllRules',
+                  'calcSessions', 'reformatSessions', 'calcPercentRunRest', 'calcCircadian',
+                  'calcSynchrony',
+                  'outputMinuteData', 'outputResults', 'calcGroupStats', 'plotGraphs', 'streamChunks',
+                  'finishStream', 'store']
+MEMORY_SAMPLE_SECONDS = 0.005 # how often --profile samples the memory use
+HEADER_NAMES = ['Channel Name:', 'Channel Group:', 'Sensor Type:']
+INPUT_EXTENSIONS = ['csv', 'asc'] # VitalView exports the program reads
+ASC_SEPARATORS = ['\t', ',', ';'] # field separators looked for in an .asc file's 'Channel Name:' row
+MAX_PREAMBLE_LINES = 100 # experiment information lines an .asc file may have above the header rows
+DATETIME_FORMAT = '%m/%d/%y %H:%M' # month, day, 2 digit year, hour, minutes
 
 ##############################################################################
 ### Section below contains functions for reformatting and calculating data ###
@@ -44,28 +124,38 @@ def reformatString(stringList):
 
 
 def convertDatetime(df):
-    '''Function to convert the row indexes (dates and times) into a proper datetime object we can use downstream'''
-    originalIndex = df.index
-    
-    dtIndex = []
-    for i in originalIndex:
-        temp = datetime.strptime(str(i), '%m/%d/%y %H:%M') # specify the month, date, year, hour, minutes
-        dtIndex.append(temp)
-    
-    df.index = dtIndex # replace original index with new datetime index
+    '''Function to convert the row indexes (dates and times) into a proper datetime object we can use downstream.
+    Every row uses the same fixed format, so the whole index is parsed in one vectorized call. An index of
+    separate date and time levels (from .asc files) is parsed level by level.'''
+    if df.index.nlevels > 1:
+        # Each distinct date and time is only parsed once
+        dateFormat, timeFormat = DATETIME_FORMAT.split(' ')
+        dates = pd.to_datetime(df.index.levels[0].astype(str), format=dateFormat)
+        times = pd.to_datetime(df.index.levels[1].astype(str), format=timeFormat) - pd.Timestamp(1900, 1, 1)
+        df.index = dates[df.index.codes[0]] + times[df.index.codes[1]]
+    else:
+        df.index = pd.to_datetime(df.index.astype(str), format=DATETIME_FORMAT)
+    df.index.name = None
     
     return df
 
 
-def fillNa(df):
-    nullRows = df.isnull().sum()
-    
+def labelNullCounts(nullCounts):
+    """Used in fillNa(). Turn the per column null counts into a labeled table"""
+    nullRows = nullCounts.copy()
+
     # Lets put some labels down
     nullRows.index.name = 'column_name'
     nullRows.name = 'null_value_count'
     nullRows = nullRows.reset_index()
     print('\nWarning: There are {} null values that will be back filled'.format(nullRows.null_value_count.sum()))
 
+    return nullRows
+
+
+def fillNa(df):
+    nullRows = labelNullCounts(df.isnull().sum())
+
     # df_fill = df.fillna(0)
     # df_fill = df.fillna(method='ffill', limit=1)
     dfFilled = df.fillna(method='bfill', limit=1) # Do the backfill and limit it to only 1 consecutive row
@@ -73,33 +163,338 @@ def fillNa(df):
     return dfFilled, nullRows
 
 
-def formatRawDf(rawDf):
-    '''Formats the raw data file by cleaning up the headers, assigning them properly and converting the row
-    names into proper datetime objects. Outputs two dataframes, one with original turns data and the other 
-    converted into meters (turns * 0.361)'''
-    header1 = reformatString(rawDf.iloc[0]) # grab row 0 and reformat to remove spaces and special chars
-    header2 = reformatString(rawDf.iloc[1])
-    header3 = reformatString(rawDf.iloc[2])
-    
-    rawDf.iloc[0] = header1 # replace the original row with the reformated row
-    rawDf.iloc[1] = header2
-    rawDf.iloc[2] = header3
-    
-    # Use the first three rows as a multiindex header (3 stacked headers)
-    rawDf.columns = [rawDf.iloc[0],rawDf.iloc[1],rawDf.iloc[2]]
-    rawDf = rawDf.drop(rawDf.index[[0,1,2]]) # Remove the original 3 rows from the df
-    rawDf.columns.names = ['sample', 'group', 'sensor'] # rename the three headers
-    
-    df = convertDatetime(rawDf) # Convert the row indexs (names) into proper datetime objects
-    formattedTurnsDf, nullRows = fillNa(df) # Back fill any single NA's that may show up in the formatted df
+def buildHeaderIndex(headerRows):
+    """Turn the three VitalView header rows (lists of strings without the
+    'Channel Name:' etc. labels) into the sample/group/sensor column MultiIndex"""
+    header1 = reformatString(headerRows[0]) # reformat to remove spaces and special chars
+    header2 = reformatString(headerRows[1])
+    header3 = reformatString(headerRows[2])
+
+    headerIndex = pd.MultiIndex.from_arrays([header1, header2, header3], 
+                                            names=['sample', 'group', 'sensor'])
+    return headerIndex
+
+
+def readInputLayout(inputPath, check=True):
+    """Read and check the 'Channel Name:/Channel Group:/Sensor Type:' block
+    of a VitalView export and work out how the file is laid out. A csv export
+    starts with the header rows. An .asc export may have lines of experiment
+    information above them, which are skipped, its fields may be separated
+    by tabs, commas or semicolons and the date and time may be two fields.
+    Returns a dictionary with the header rows (lists of fields), the
+    separator 'sep', 'dateFields' (1 or 2), the number of lines above the
+    data 'skiprows' and the byte offset of the first data row 'headerEnd'.
+    The header labels are checked with checkHeader() unless check=False."""
+    isAsc = inputPath.lower().endswith('.asc')
+    sep = ','
+    headerLines = []
+    skiprows = 0
+
+    with open(inputPath, 'rb') as f:
+        while len(headerLines) < len(HEADER_NAMES):
+            line = f.readline()
+            if len(line) == 0:
+                break
+            text = line.decode('utf-8', 'replace').lstrip('\ufeff').rstrip('\r\n')
+            skiprows += 1
+
+            if isAsc and len(headerLines) == 0:
+                if not text.lstrip('"').startswith(HEADER_NAMES[0]):
+                    if skiprows > MAX_PREAMBLE_LINES:
+                        break
+                    continue
+                sep = next((x for x in ASC_SEPARATORS if x in text), sep)
+            headerLines.append(text)
+
+        headerEnd = f.tell()
+        firstRow = f.readline().decode('utf-8', 'replace').rstrip('\r\n')
+
+    headerRows = list(csv.reader(headerLines, delimiter=sep))
+    if check:
+        labels = [row[0] if row else '' for row in headerRows]
+        checkHeader([label.strip() for label in labels] if isAsc else labels)
+
+    # A data row with one field more than the header rows has the date and
+    # the time in separate fields
+    dateFields = 1
+    if firstRow and len(next(csv.reader([firstRow], delimiter=sep))) == len(headerRows[0]) + 1:
+        dateFields = 2
+
+    layout = {'headerRows':headerRows, 'sep':sep, 'dateFields':dateFields,
+              'skiprows':skiprows, 'headerEnd':headerEnd}
+    return layout
+
+
+def readVitalViewBody(source, numCols, skiprows=len(HEADER_NAMES), chunkSize=None, sep=',',
+    dateFields=1):
+    """Parse the numeric body below the header rows into float32 columns.
+    source is a path or an open file, numCols the number of columns including
+    the timestamps. Returns an iterator of dataframes if a chunkSize (rows) 
+    is given. With dateFields=2 the date and time are separate fields, and
+    the index has a level for each (see convertDatetime())."""
+
+    # Column 0 is the timestamp (or 0 and 1 the date and time), the rest are
+    # the wheel turns for each channel
+    numFields = numCols + dateFields - 1
+    colTypes = {i:np.float32 for i in range(dateFields, numFields)}
+    body = pd.read_csv(source, header=None, sep=sep, skiprows=skiprows,
+                       index_col=0 if dateFields == 1 else list(range(dateFields)),
+                       usecols=range(numFields), dtype=colTypes, chunksize=chunkSize)
+    return body
+
+
+def readVitalViewCsv(inputPath):
+    """Fast loader for VitalView csv (and .asc) exports. The 'Channel Name:/Channel Group:/
+    Sensor Type:' block is read on its own, so the numeric body can be parsed
+    straight into a compact float32 array (instead of an object dtype table of 
+    strings) and the timestamps converted in one go. Returns the raw turns 
+    dataframe with the MultiIndex header and datetime index."""
+    layout = readInputLayout(inputPath)
+    headerRows = layout['headerRows']
+
+    rawDf = readVitalViewBody(inputPath, len(headerRows[0]), layout['skiprows'],
+                              sep=layout['sep'], dateFields=layout['dateFields'])
+    rawDf.columns = buildHeaderIndex([row[1:] for row in headerRows])
+    rawDf = convertDatetime(rawDf)
+
+    return rawDf
+
+
+def readVitalViewChunks(inputPath, chunkSize):
+    """Same as readVitalViewCsv(), but yields the raw turns dataframe in 
+    chunks of chunkSize rows"""
+    layout = readInputLayout(inputPath)
+    headerRows = layout['headerRows']
+    headerIndex = buildHeaderIndex([row[1:] for row in headerRows])
+
+    for chunk in readVitalViewBody(inputPath, len(headerRows[0]), layout['skiprows'], chunkSize,
+                                   layout['sep'], layout['dateFields']):
+        chunk.columns = headerIndex
+        yield convertDatetime(chunk)
+
+
+def formatTurnsDf(rawDf):
+    """Used by readVitalViewCsv() output and formatRawDf(). Back fills single
+    missing values and converts turns to meters (turns * 0.361). The turns are
+    stored as integers if no missing values are left after the back fill."""
+    formattedTurnsDf, nullRows = fillNa(rawDf) # Back fill any single NA's that may show up in the formatted df
+
+    if not formattedTurnsDf.isnull().values.any():
+        formattedTurnsDf = formattedTurnsDf.astype(np.int32)
+
     formattedDistanceDf = formattedTurnsDf.astype(float) * 0.361 # Convert turns to meters
 
     return formattedTurnsDf, formattedDistanceDf, nullRows
 
 
-def customStartDateTime(formattedDistanceDf, customStart, customEnd):
-    """Use user defined start and end date times if specified. None will be specifed
-    for both customStart and customEnd if not specified (e.g. use all data)"""
+def formatRawDf(rawDf):
+    '''Formats a raw data file read with pd.read_csv(inputPath, index_col=[0], header=None) by cleaning
+    up the headers, assigning them properly and converting the row names into proper datetime objects.
+    Outputs two dataframes, one with original turns data and the other converted into meters (turns * 0.361).
+    readVitalViewCsv() followed by formatTurnsDf() does the same thing without the object dtype detour.'''
+    checkHeader(rawDf.index[0:3].str.lstrip('\ufeff'))
+    headerIndex = buildHeaderIndex([rawDf.iloc[0], rawDf.iloc[1], rawDf.iloc[2]])
+
+    df = rawDf.drop(rawDf.index[[0,1,2]]).astype(float) # Remove the original 3 header rows from the df
+    df.columns = headerIndex
+    df = convertDatetime(df) # Convert the row indexs (names) into proper datetime objects
+
+    return formatTurnsDf(df)
+
+
+def initQuality():
+    """Running counts for the data quality checks, see updateQuality()"""
+    quality = {'outOfOrder':0, 'duplicates':0, 'lastMax':np.iinfo(np.int64).min,
+               'runStarts':np.zeros(0, dtype=np.int64), 'runEnds':np.zeros(0, dtype=np.int64),
+               'late':[]}
+    return quality
+
+
+def updateQuality(quality, times):
+    """Check the next block of timestamps (int64 nanoseconds, in file order)
+    against each other and everything seen before. A row is out of order if
+    an earlier row has a later timestamp, and a duplicate if an earlier row
+    has the same one. Rows in order are only kept as the first and last
+    timestamp of each run of rows one minute apart (quality['runStarts'] and
+    ['runEnds']), so memory doesn't grow with the recording. quality['late']
+    keeps the sorted timestamps of the out of order rows (without
+    duplicates) for finishQuality()."""
+    if len(times) == 0:
+        return
+
+    runMax = np.maximum(np.maximum.accumulate(times), quality['lastMax'])
+    prevMax = np.concatenate(([quality['lastMax']], runMax[:-1]))
+    isLate = times < prevMax
+    quality['outOfOrder'] += int(isLate.sum())
+    quality['duplicates'] += int((times == prevMax).sum())
+
+    # Rows later than everything before them extend the last run, or start
+    # a new one after a gap
+    inOrder = times[times > prevMax]
+    if len(inOrder) > 0:
+        runFirst = np.flatnonzero(np.concatenate(([True], np.diff(inOrder) != MINUTE_NS)))
+        runLast = np.append(runFirst[1:] - 1, len(inOrder) - 1)
+        if len(quality['runEnds']) > 0 and inOrder[0] - quality['lastMax'] == MINUTE_NS:
+            quality['runEnds'][-1] = inOrder[runLast[0]]
+            runFirst, runLast = runFirst[1:], runLast[1:]
+        if len(runFirst) > 0:
+            quality['runStarts'] = np.append(quality['runStarts'], inOrder[runFirst])
+            quality['runEnds'] = np.append(quality['runEnds'], inOrder[runLast])
+        quality['lastMax'] = int(inOrder[-1])
+
+    lateTimes = times[isLate]
+    if len(lateTimes) == 0:
+        return
+
+    lateTimes = np.sort(lateTimes)
+    isDup = lateTimes[1:] == lateTimes[:-1]
+    quality['duplicates'] += int(isDup.sum())
+    lateTimes = lateTimes[np.concatenate(([True], ~isDup))]
+
+    # Repeats of a row in order, i.e. in a run and on its minutes
+    if len(quality['runStarts']) > 0:
+        runStarts = quality['runStarts'][runPosition(quality, lateTimes)]
+        isSeen = inQualityRuns(quality, lateTimes) & ((lateTimes - runStarts) % MINUTE_NS == 0)
+        quality['duplicates'] += int(isSeen.sum())
+        lateTimes = lateTimes[~isSeen]
+
+    # or of an earlier out of order row
+    for part in quality['late']:
+        if len(lateTimes) == 0:
+            break
+        pos = np.minimum(np.searchsorted(part, lateTimes), len(part) - 1)
+        isSeen = part[pos] == lateTimes
+        quality['duplicates'] += int(isSeen.sum())
+        lateTimes = lateTimes[~isSeen]
+
+    if len(lateTimes) > 0:
+        quality['late'].append(lateTimes)
+
+
+def runPosition(quality, times):
+    """Used in updateQuality(). Position of the last run of in order rows
+    that starts at or before each of times (0 if there is none)"""
+    return np.maximum(np.searchsorted(quality['runStarts'], times, side='right') - 1, 0)
+
+
+def inQualityRuns(quality, times):
+    """Whether each of times lies between the first and last timestamp of a
+    run of in order rows"""
+    if len(quality['runStarts']) == 0:
+        return np.zeros(len(times), dtype=bool)
+
+    pos = runPosition(quality, times)
+    return (times >= quality['runStarts'][pos]) & (times <= quality['runEnds'][pos])
+
+
+def finishQuality(quality):
+    """Counts from the quality checks: out of order rows, duplicate rows and
+    the missing minutes and number of gaps between the first and last
+    timestamp"""
+    counts = {'out_of_order_rows':quality['outOfOrder'], 'duplicate_rows':quality['duplicates'],
+              'missing_minutes':0, 'gaps':0}
+
+    # Out of order rows inside a run of rows one minute apart leave no gap,
+    # the rest are runs of their own
+    lateTimes = np.concatenate([np.zeros(0, dtype=np.int64)] + quality['late'])
+    lateTimes = lateTimes[~inQualityRuns(quality, lateTimes)]
+    starts = np.concatenate((quality['runStarts'], lateTimes))
+    ends = np.concatenate((quality['runEnds'], lateTimes))
+
+    if len(starts) > 0:
+        order = np.argsort(starts, kind='stable')
+        steps = starts[order][1:] - ends[order][:-1]
+        isGap = steps > MINUTE_NS
+        counts['gaps'] = int(isGap.sum())
+        counts['missing_minutes'] = int((steps[isGap] // MINUTE_NS - 1).sum())
+
+    return counts
+
+
+def checkDataQuality(rawDf):
+    """Look for timestamp problems that break the one row per minute that
+    calcSessions() and the binning count on: missing minutes, duplicate
+    timestamps (e.g. from the exporter restarting) and rows out of order.
+    Returns the counts from finishQuality()."""
+    quality = initQuality()
+    updateQuality(quality, rawDf.index.values.astype('datetime64[ns]').astype(np.int64))
+    counts = finishQuality(quality)
+
+    return counts
+
+
+def printQualityWarnings(counts, reindex=False):
+    """Tell the user about any problems checkDataQuality() found"""
+    problems = ['{0} {1}'.format(counts[name], name.replace('_', ' '))
+                for name in ['out_of_order_rows', 'duplicate_rows', 'missing_minutes']
+                if counts[name] > 0]
+    if len(problems) == 0:
+        return
+
+    print('\nWarning: The timestamps have {0} ({1} gaps)'.format(', '.join(problems), counts['gaps']))
+    if not reindex:
+        print('Sessions and bins assume one row per minute, use --reindex to fix this.')
+
+
+def reindexMinutes(rawDf, fillPolicy='nan'):
+    """Put the raw turns dataframe on a regular one minute grid from its first
+    to its last timestamp. Rows are sorted by time and of duplicate timestamps
+    the last row in the file is kept, as the exporter rewrites rows after a
+    restart. Minutes without a row are filled according to fillPolicy (one of
+    FILL_POLICIES): left as NaN, set to 0 or copied from the previous (ffill)
+    or next (bfill) row that exists."""
+    times = rawDf.index.values.astype('datetime64[ns]').astype(np.int64)
+    if len(times) == 0 or (np.diff(times) == MINUTE_NS).all():
+        return rawDf
+
+    # A stable sort keeps repeated timestamps in file order, keep the last one
+    order = np.argsort(times, kind='stable')
+    sortedTimes = times[order]
+    isLast = np.concatenate((sortedTimes[1:] != sortedTimes[:-1], [True]))
+    keep = order[isLast]
+
+    firstTime = sortedTimes[0]
+    numMinutes = int((sortedTimes[-1] - firstTime) // MINUTE_NS) + 1
+    gridPos = (times[keep] - firstTime) // MINUTE_NS
+
+    dtype = np.result_type(rawDf.values.dtype, np.float32) # room for NaN
+    values = np.full((numMinutes, rawDf.shape[1]), np.nan, dtype=dtype)
+    values[gridPos] = rawDf.values[keep]
+    isMissing = np.ones(numMinutes, dtype=bool)
+    isMissing[gridPos] = False
+
+    rowNums = np.arange(numMinutes)
+    if fillPolicy == 'zero':
+        values[isMissing] = 0
+    elif fillPolicy == 'ffill':
+        fromRow = np.maximum.accumulate(np.where(isMissing, 0, rowNums))
+        values[isMissing] = values[fromRow[isMissing]]
+    elif fillPolicy == 'bfill':
+        fromRow = np.minimum.accumulate(np.where(isMissing, numMinutes - 1, rowNums)[::-1])[::-1]
+        values[isMissing] = values[fromRow[isMissing]]
+
+    gridIndex = pd.to_datetime(firstTime + rowNums.astype(np.int64) * MINUTE_NS)
+    reindexedDf = DataFrame(values, index=gridIndex, columns=rawDf.columns)
+    print('Reindexed to {0} minutes, {1} filled with {2}'.format(numMinutes,
+          int(isMissing.sum()), fillPolicy))
+
+    return reindexedDf
+
+
+def addQualityCounts(nullRows, counts):
+    """Add the counts from checkDataQuality() to the null count table written
+    to <cohort_name>_num_null.csv. They apply to the timestamps, so every
+    animal gets the same counts."""
+    nullRows = nullRows.copy()
+    for name in ['missing_minutes', 'gaps', 'duplicate_rows', 'out_of_order_rows']:
+        nullRows[name] = counts[name]
+
+    return nullRows
+
+
+def parseCustomDateTimes(customStart, customEnd):
+    """Convert the user defined start and end date times into datetime objects.
+    None is passed through for either one if not specified (e.g. use all data)"""
 
     if customStart != None:
         try:
@@ -121,11 +516,28 @@ def customStartDateTime(formattedDistanceDf, customStart, customEnd):
     else:
         customEndDt = customEnd
 
+    return customStartDt, customEndDt
+
+
+def customStartDateTime(formattedDistanceDf, customStart, customEnd):
+    """Use user defined start and end date times if specified. None will be specifed
+    for both customStart and customEnd if not specified (e.g. use all data)"""
+    customStartDt, customEndDt = parseCustomDateTimes(customStart, customEnd)
+
     selectedDistanceDf = formattedDistanceDf[customStartDt:customEndDt]
 
     return selectedDistanceDf
 
 
+def checkSelectedWindow(isEmpty):
+    """Stop with a message, rather than a traceback further on, if -S/-E
+    left no rows to analyze"""
+    if isEmpty:
+        print('No data in the selected window, check the -S/--customStart and '
+              '-E/--customEnd times against the recording.')
+        sys.exit(1)
+
+
 def getStartingTime(selectedDistanceDf):
     """Determine the initial time point in the input data"""
     startDt = selectedDistanceDf.index[0] # grab datetime index from very first row of data
@@ -144,35 +556,125 @@ def calcBaseParam(startHr, startMin):
 
 def resampleByHr(selectedDistanceDf, customGrpByHr, baseParam):
     """Outputs a list of dictionaries with the rule as key, and resampledDf as value"""
-    customDfList = []
-    
     if customGrpByHr == None:
-        customDfList = None
-    else:
-        for i in customGrpByHr:
-            ruleStr = i + 'H'
-            resampledDf = selectedDistanceDf.resample(rule=ruleStr, base=baseParam).sum()
-            customDfDict = {ruleStr:resampledDf}
-            customDfList.append(customDfDict)
+        return None
+
+    binnedDict = binAllRules(selectedDistanceDf, customGrpByHr, baseParam)
+    customDfList = [{i + 'H':binnedDict[i + 'H']} for i in customGrpByHr]
     
     return customDfList
 
 
 def formatHourly(selectedDistanceDf, baseParam):
-    hourlyDf = selectedDistanceDf.resample(rule='H', base=baseParam).sum()
+    hourlyDf = binAllRules(selectedDistanceDf, [], baseParam)['H']
 
     return hourlyDf
 
 
 def formatDaily(selectedDistanceDf, baseParam):
-    dailyDf = selectedDistanceDf.resample(rule="1d", base=baseParam).sum()
+    dailyDf = binAllRules(selectedDistanceDf, [], baseParam)['1d']
 
     return dailyDf
 
 
-def calcSessions(df):
-    """Calculates running session data. Each session consists of a run phase
-    followed by a rest phase. Function outputs a dictionary containing a
+def binAllRules(selectedDistanceDf, customGrpByHr, baseParam):
+    """Bin the selected distance data by hour, by day and by every custom
+    grouping in one pass. The data is summed once into blocks that end at 
+    every bin edge of every bin size, then each bin is the sum of its blocks, 
+    so extra bin sizes cost next to nothing. Returns a dict of rule: binnedDf, 
+    laid out the same as resample(rule, base=baseParam).sum()"""
+    colList = selectedDistanceDf.columns
+
+    # Rows out of time order (e.g. an exporter restart without --reindex) 
+    # would split the blocks, sort them first like resample does
+    if not selectedDistanceDf.index.is_monotonic_increasing:
+        order = np.argsort(selectedDistanceDf.index.values, kind='stable')
+        selectedDistanceDf = selectedDistanceDf.iloc[order]
+    times = selectedDistanceDf.index.values
+
+    ruleBins = []
+    for rule, freqN, freqNs in binRules(customGrpByHr):
+        if len(times) == 0:
+            ruleBins.append((rule, None, None, freqNs))
+            continue
+        origin = calcBinOrigin(times[0], baseParam, freqN, freqNs)
+        ruleBins.append((rule, origin, calcBinNumbers(times, origin, freqNs), freqNs))
+
+    # First row of every block, i.e. every row that starts a bin of any size
+    isEdge = np.zeros(len(times), dtype=bool)
+    isEdge[:1] = True
+    for rule, origin, binNums, freqNs in ruleBins:
+        if binNums is not None:
+            isEdge[1:] |= binNums[1:] != binNums[:-1]
+    blockStarts = np.append(np.flatnonzero(isEdge), len(times))
+
+    # NaN sums as 0, same as resample
+    blockSums = selectedDistanceDf.groupby(np.cumsum(isEdge)).sum().values
+
+    binnedDict = {}
+    for rule, origin, binNums, freqNs in ruleBins:
+        if binNums is None:
+            binnedDict[rule] = DataFrame(columns=colList, index=pd.DatetimeIndex([]), dtype=float)
+            continue
+
+        # Block that starts each bin, bins without any rows get a sum of 0. 
+        # Adding up the blocks directly rather than taking the difference of 
+        # running totals keeps rounding noise out of the output
+        rowEdges = np.searchsorted(binNums, np.arange(binNums[0], binNums[-1] + 2))
+        edges = np.searchsorted(blockStarts, rowEdges)
+        binnedArray = np.add.reduceat(blockSums, edges[:-1], axis=0)
+        binnedArray[edges[:-1] == edges[1:]] = 0
+
+        binnedDict[rule] = binnedFrame(binnedArray, origin, binNums[0], freqNs, colList)
+
+    return binnedDict
+
+
+def binnedFrame(binnedArray, origin, firstBin, freqNs, colList):
+    """Dataframe of bin sums indexed by the start time of each bin"""
+    binTimes = origin + (firstBin + np.arange(len(binnedArray))) * freqNs
+    binnedDf = DataFrame(binnedArray, index=pd.to_datetime(binTimes), columns=colList)
+
+    return binnedDf
+
+
+def binRules(customGrpByHr=None):
+    """List the (rule, freqN, freqNs) of every bin size we output: 'H' and '1d'
+    plus the custom '<X>H' groupings. freqN and freqNs are the multiple and
+    length (in nanoseconds) of the pandas frequency, used to place the bins
+    the same way resample(rule, base=baseParam) does."""
+    hourNs = 3600 * 10**9
+    rules = [('H', 1, hourNs), ('1d', 1, 24 * hourNs)]
+
+    if customGrpByHr != None:
+        for i in customGrpByHr:
+            rules.append((i + 'H', int(i), int(i) * hourNs))
+
+    return rules
+
+
+def calcBinOrigin(firstTime, baseParam, freqN, freqNs):
+    """Time (in nanoseconds) of a bin edge for resampling data that starts at
+    firstTime. Bins are anchored to midnight of the first day, shifted by
+    baseParam units of the frequency (hours for 'H' rules, days for '1d').
+    baseParam is whole minutes (see calcBaseParam()), the shift is worked out
+    in integers so the float doesn't put the bins a nanosecond early."""
+    firstDay = pd.Timestamp(firstTime).normalize().value
+    baseMins = int(round(baseParam * 60))
+    baseNanos = (baseMins % (freqN * 60)) * freqNs // (freqN * 60)
+
+    return firstDay + baseNanos
+
+
+def calcBinNumbers(times, originNs, freqNs):
+    """Number of the bin (counted from originNs) that each datetime falls in"""
+    return (times.astype('datetime64[ns]').astype(np.int64) - originNs) // freqNs
+
+
+def calcSessionsLegacy(df):
+    """Original row by row version of calcSessions(), kept so the two can be
+    compared (--legacySessions). Calculates running session data. Each session
+    consists of a run phase followed by a rest phase. Function outputs a dictionary containing a
     session dataframe for each animal in the formatted dataframe. Each session
     dataframe contains columns for session number, run start time,
     run stop time, number of minutes run, distance run, velocity of run,
@@ -309,322 +811,2856 @@ def calcSessions(df):
 
     return sessionsDict
 
-def observed(x):
-    """Used in calcObsCols(). Simple test to see if data is present. 
-    If None, then return False"""
-    if x == None:
-        return False
-    else:
-        return True
-
-def calcObsCols(sessionDf):
-    """Used in reformatSessions(). Check to see if a run or rest was observed 
-    for each session, return both columns."""
-    runObsCol = sessionDf.run_start.apply(observed)
-    restObsCol = sessionDf.rest_start.apply(observed)
-    runObsCol.name = 'run_obs'
-    restObsCol.name = 'rest_obs'
-    return runObsCol, restObsCol
-
-def calcVelocityCol(sessionDf):
-    """Used in reformatSessions(). Calculate the velocity of each run session 
-    and return column of data"""
-    velocityCol = sessionDf['run_dist(m)'] / sessionDf['run_mins']
-    velocityCol.name = 'velocity(m/min)'
-    return velocityCol
-
-def reformatSessions(sessionsDict):
-    """Reformats the sessionsDict from calcSessions(). Calculates and adds
-    new columns to each sessionDf including:
-        1. Session column
-        2. Run velocity column
-        3. Run observed column
-        4. Rest observed column
-    Finally, it creates a new dataframe and reorganizes the columns."""
-    reformatedDict = {} # new session dictionary for added and reformated cols
-    
-    for animalName, df in sessionsDict.items():
-        
-        # Do calculations and get columns
-        runObsCol, restObsCol = calcObsCols(df)
-        velocityCol = calcVelocityCol(df)
-        #sessionCol = calcSessionCol(df)
-        
-        # Join all columns into a single dataframe
-        joinedDf = pd.concat([df,velocityCol,runObsCol, restObsCol],
-                                axis=1)
 
-        resetDf = joinedDf.reset_index()  # reset the index
-        
-        # Make a list of column names in the order we want
-        colOrder = ['run_start', 'run_end', 'run_mins', 
-                    'run_dist(m)', 'velocity(m/min)', 'rest_start',
-                    'rest_end', 'rest_mins', 'run_obs', 'rest_obs']
-        
-        arrangedDf = resetDf[colOrder]
-        arrangedDf.index = arrangedDf.index + 1
-        arrangedDf.index.name = 'session'
+def findPhaseSegments(values, minDistance=0.0):
+    """Run-length encode the run (distance > minDistance) and rest phases of
+    every animal in a single pass over the 2-D (minutes x animals) array.
+    Missing values are counted as rest. Returns a dictionary of flat segment
+    arrays ordered by animal and then by time: animal (column) number, start
+    row, number of minutes, run phase (True) or rest phase (False) and
+    distance covered while running."""
+    nRows, nCols = values.shape
 
-        reformatedDict[animalName] = arrangedDf
-        
-    return reformatedDict
+    with np.errstate(invalid='ignore'):
+        running = values > minDistance
+    dist = np.where(running, values, 0.0)
 
+    # A new segment starts on the first row or wherever the phase flips
+    change = np.ones((nRows, nCols), dtype=bool)
+    change[1:] = running[1:] != running[:-1]
 
-def calcPercentRunRest(sessionsDict):
-    '''Calculate the percentage the animal ran and rested of the total time the
-    data was collected. If data was collected one row per minute, the number of
-    rows in the raw data file should correspond to the sum total of minutes.'''
-    # Create an empy dictionary list for creating a dataframe in the end
-    dictList = []
+    # Transpose so each animal's minutes are contiguous. The forced change on
+    # row 0 keeps segments from spilling over into the next animal.
+    starts = np.flatnonzero(change.T.ravel())
+    lengths = np.diff(np.append(starts, nRows * nCols))
 
-    for animalName, df in sessionsDict.items():
-        sumMinsRun = df.run_mins.sum()
-        sumDistRun = df['run_dist(m)'].sum()
-        sumMinsRest = df.rest_mins.sum()
-        sumTotal = sumMinsRun + sumMinsRest
+    segments = {'animal':starts // nRows, 'start':starts % nRows,
+                'mins':lengths, 'run':running.T.ravel()[starts],
+                'dist':np.add.reduceat(dist.T.ravel(), starts)}
 
-        # Create a dictionary for each row to be in the dataframe
-        rowDict = {'animal':animalName, 'sum_mins_run':sumMinsRun, 
-                    'sum_mins_rest':sumMinsRest, 'sum_dist_run(m)':sumDistRun,
-                    'total_mins':sumTotal}
+    return segments
 
-        dictList.append(rowDict) # Add to the dictionary list
 
-    # Create dataframe
-    df2 = DataFrame(dictList)
+def boutRules(minRun=1, minRest=1, minDistance=0.0, mergeGap=0):
+    """What counts as a run or rest bout (--minRun, --minRest, --minDistance,
+    --mergeGap), see applyBoutRules(). The defaults give plain distance > 0
+    run-length phases. Exits on values that make no sense."""
+    if minRun < 1 or minRest < 1 or mergeGap < 0 or not minDistance >= 0:
+        print("--minRun and --minRest need to be at least 1, --mergeGap and --minDistance at least 0.")
+        sys.exit(1)
 
-    # Calculate percent data columns
-    percentRun =  (df2.sum_mins_run / df2.total_mins) * 100
-    percentRest = (df2.sum_mins_rest / df2.total_mins) * 100
+    return {'minRun':int(minRun), 'minRest':int(minRest), 'minDistance':float(minDistance),
+            'mergeGap':int(mergeGap)}
 
-    rPercentRun = percentRun.round(2)
-    rPercentRest = percentRest.round(2)
 
-    df2.index.name = 'index' # Add header names to the columns
-    rPercentRun.name = 'percent_mins_run'
-    rPercentRest.name = 'percent_mins_rest'
+def innerRests(seg):
+    """Rest segments with a run segment of the same animal on both sides"""
+    animal = seg['animal']
+    sameBefore = np.zeros(len(animal), dtype=bool)
+    sameBefore[1:] = animal[1:] == animal[:-1]
+    sameAfter = np.zeros(len(animal), dtype=bool)
+    sameAfter[:-1] = sameBefore[1:]
 
-    joinedDf = pd.concat([df2, rPercentRun, rPercentRest], axis=1) # join cols
+    return ~seg['run'] & sameBefore & sameAfter
 
-    colOrder = ['animal','sum_mins_run', 'sum_dist_run(m)', 'sum_mins_rest',
-                'total_mins', 'percent_mins_run', 'percent_mins_rest']
 
-    percentRunRestDf = joinedDf[colOrder] # Final order of columns
+def mergeSegments(seg, flip):
+    """Used in applyBoutRules(). Flip the phase of the segments where flip is
+    True, then join each animal's neighbouring segments that are now the same
+    phase. Minutes and distance add up, a joined segment starts where its
+    first part starts and ends where its last part ends."""
+    if not flip.any():
+        return seg
 
-    return percentRunRestDf
+    run = seg['run'] != flip
+    animal = seg['animal']
+    isFirst = np.ones(len(run), dtype=bool)
+    isFirst[1:] = (animal[1:] != animal[:-1]) | (run[1:] != run[:-1])
+    firsts = np.flatnonzero(isFirst)
+    lasts = np.append(firsts[1:], len(run)) - 1
 
+    merged = takeSegments(seg, firsts)
+    merged['run'] = run[firsts]
+    merged['mins'] = np.add.reduceat(seg['mins'], firsts)
+    merged['dist'] = np.add.reduceat(seg['dist'], firsts)
+    if 'endTime' in seg:
+        merged['endTime'] = seg['endTime'][lasts]
 
-###########################################################
-### Section below contains functions for plotting data  ###
-###########################################################
+    return merged
 
-def chunkLists(userList, chunkSize):
-    """Use to split lists of columns into chunks of sublists for graphing"""
-    chunkList = []
 
-    # x goes from start of list to end in groups of chunkSize
-    for x in range(0, len(userList), chunkSize):
-        # Eg. If chunkSize = 6:
-        # first loop: start = 0 and end = 6
-        # second loop: start = 6 and end = 12
-        # third loop: start = 12 end = 18 etc.
-        chunk=userList[x:x+chunkSize]
-        chunkList.append(chunk)
-    return chunkList
+def applyBoutRules(seg, bouts):
+    """Turn the phase segments from findPhaseSegments() into bouts, in three
+    passes over all animals at once:
+        1) rests of at most mergeGap minutes between two runs are joined into
+           one run, so a few minutes off the wheel don't split a bout
+        2) runs shorter than minRun minutes count as rest
+        3) rests shorter than minRest minutes between two runs are joined
+           into one run
+    Rests at the start or end of the recording are cut off by it and are kept
+    whatever their length. Distance covered in runs that end up as rest is
+    left out of run_dist(m)."""
+    if bouts['mergeGap'] > 0:
+        seg = mergeSegments(seg, innerRests(seg) & (seg['mins'] <= bouts['mergeGap']))
+    if bouts['minRun'] > 1:
+        seg = mergeSegments(seg, seg['run'] & (seg['mins'] < bouts['minRun']))
+    if bouts['minRest'] > 1:
+        seg = mergeSegments(seg, innerRests(seg) & (seg['mins'] < bouts['minRest']))
 
-def plotGraphs(selectedDistanceDf, percentRunRestDf, hourlyDf, dailyDf, newDirPath, cohortName):
-    """Make some plots"""
-    with PdfPages(os.path.join(newDirPath, cohortName + '_graphs.pdf')) as pdf:
-        # Barplot of daily distance sums
-        b = dailyDf.plot(kind='bar',figsize=(10,5), width=0.75, alpha=.75) #color=['#FFAAAA','#D46A6A','#801515','#550000'])
-        b.set_title('{0}: Total Running Distance By Day'.format(cohortName), y=1.08)
-        b.set_ylabel('Distance in meters')
-        b.set_xlabel('Animal & Condition')
-        b.legend(bbox_to_anchor=(1.12, 0.6),prop={'size':6})
-        pdf.savefig(bbox_inches='tight')
-        plt.clf()
+    return seg
 
-        # Stacked Barplot of % rest and run
-        pnames = percentRunRestDf.animal
-        pruns = percentRunRestDf.percent_mins_run
-        prests = percentRunRestDf.percent_mins_rest
-        px = range(len(pnames)) # xaxis must be numbers, we can change to names with xticks
-        width =0.50 # of bars, must be a fraction
-        b1 = plt.bar(px, pruns, width, color='black')
-        b2 = plt.bar(px, prests, width, color='lightgrey',bottom=pruns)
-        # xticks takes original xaxis (px), and replacement (pnames)
-        plt.xticks(px, pnames, size='small', rotation=90, horizontalalignment='left')
-        plt.title('Percent Run and Percent Rest Per Animal', y=1.08)
-        plt.legend((b1[0], b2[0]), ('Run', 'Rest'), bbox_to_anchor=(1.15, 1.01),prop={'size':10})
-        plt.ylabel('Percent %')
-        plt.xlabel('Animal & Condition')
-        pdf.savefig(bbox_inches='tight')
-        plt.clf()
 
-        # Cumsum Line plot
-        chunks = chunkLists(hourlyDf.columns, 6)
-        for i, c in enumerate(chunks):
-            l = hourlyDf[chunks[i]].cumsum().plot(figsize=(7, 7), linewidth=3, alpha=0.70)
-            l.set_title('{0}: Cumilative Sum Plot Binned By Hour (plot {1} of {2})'.format(
-                cohortName, i+1, len(chunks)), y=1.08)
-            l.set_ylabel('Distance in meters)')
-            l.set_xlabel('Date & Time')
-            l.legend(bbox_to_anchor=(1.38, 1.01),prop={'size':8})
-            pdf.savefig(bbox_inches='tight')
-            plt.clf()
+def nullableColumn(values, mask):
+    """Used in calcSessions(). Blank out values where mask is False. Columns
+    with nothing missing keep their dtype, the same way a list of numbers
+    without any None does in calcSessionsLegacy()."""
+    if mask.all():
+        return values
+    elif values.dtype.kind == 'M':
+        return np.where(mask, values, np.datetime64('NaT'))
+    else:
+        return np.where(mask, values, np.nan)
 
-        # Distance Histogram - Line plot
-        chunks2 = chunkLists(hourlyDf.columns, 3)
-        for i, c in enumerate(chunks2):   
-            h = hourlyDf[chunks2[i]].plot(figsize=(15, 3), linewidth=3, alpha=0.65)
-            h.set_title('{0}: Distance Histogram Binned By Hour (plot {1} of {2})'.format(
-                cohortName, i+1, len(chunks2)), y=1.08)
-            h.set_ylabel('Distance in meters')
-            h.set_xlabel('Date & Time')
-            h.legend(bbox_to_anchor=(1.18, 1.01), prop={'size':8})
-            pdf.savefig(bbox_inches='tight')
-            plt.clf()
 
+def calcSessions(df, legacy=False, bouts=None):
+    """Calculates running session data. Each session consists of a run phase
+    followed by a rest phase. Function outputs a session table (see
+    buildSessions()) with the run start time, run end time, number of minutes
+    run, distance run, rest start time, rest end time and number of minutes
+    rested of every session of every animal in the formatted dataframe.
 
-####################################################################################
-### Section below contains functions for file input/output data & sanity checks  ###
-####################################################################################
+    Run and rest phases are found as run-length segments of distance > 0 for
+    all animals at once. An animal that starts out resting gets an empty run
+    phase in its first session, and a run still going on the last row gets an
+    empty rest phase. bouts (see boutRules()) sets the minimum bout lengths,
+    distance and gap merging, applied with applyBoutRules(). Set legacy=True
+    to use calcSessionsLegacy() instead."""
+    if legacy:
+        return sessionTableFromFrames(calcSessionsLegacy(df), df.columns)
 
-def checkInputFile(inputFileArg):
-    """Make sure the file exists"""
-    if not os.path.exists(inputFileArg):
-        print("{0} not found. Check path.".format(inputFileArg))
-        sys.exit(1)
+    if len(df) == 0:
+        return emptySessionTable(df.columns)
 
-def checkHeader(rawDf):
-    HEADER0_NAME = 'Channel Name:'
-    HEADER1_NAME = 'Channel Group:'
-    HEADER2_NAME = 'Sensor Type:'
+    if bouts == None:
+        bouts = boutRules()
 
-    """Function to check the file's header."""
-    #Move to the next (first) row of data and assign it to a variable
+    times = df.index.values
+    seg = findPhaseSegments(df.values.astype(float), bouts['minDistance'])
 
-    # Try a search and find on the header row to match HEADER_STRING. If return
-    # error, print feedback and quit program.
-    if (rawDf.index[0] != HEADER0_NAME) or (rawDf.index[1] != HEADER1_NAME) or (rawDf.index[2] != HEADER2_NAME):
-        print("ERROR: This file is in the wrong format. ")
-        print("It's missing the proper headers (i.e. Channel Name, Channel Group, Sensor Type)")
-        sys.exit(1) # quit the program
-    else:
-        print('File header checks out.') 
+    # A phase ends on the first minute of the next phase or on the last row
+    endRow = np.minimum(seg['start'] + seg['mins'], len(df) - 1)
+    seg['startTime'] = times[seg['start']]
+    seg['endTime'] = times[endRow]
+    seg = applyBoutRules(seg, bouts)
 
+    return buildSessions(seg, df.columns)
 
-def outputAllToFile(formattedTurnsDf, formattedDistanceDf, selectedDistanceDf, 
-    baseParam, hourlyDf, dailyDf, customDfList, sessionsDict, reformattedDict, percentRunRestDf, 
-    nullRows, cohortName):
-    """Creates a cohort folder in current directory and output's all the 
-    data frames for each sample."""
 
-    currWorkingDir = os.getcwd()
-    newDirPath = os.path.join(currWorkingDir, cohortName)
+def emptySessionTable(colList):
+    """Session table without any sessions"""
+    sessionTable = {'animals':colList, 'animal':np.zeros(0, dtype=np.int64),
+                    'session':np.zeros(0, dtype=np.int64)}
+    for name, dtype in SESSION_COLUMNS:
+        sessionTable[name] = np.zeros(0, dtype=dtype)
 
-    if not os.path.exists(newDirPath):
-        os.makedirs(newDirPath)
+    return sessionTable
 
-    # output main formatted data frame
-    print('\nExporting results to CSV...')
-    print("Outputting raw dataframe")
-    rawDf.to_csv(os.path.join(newDirPath, cohortName +'_rawdata.csv'))
-    print("Outputting number of null rows.")
-    nullRows.to_csv(os.path.join(newDirPath, cohortName +'_num_null.csv'))
-    print("Outputting turns formatted dataframe.")
-    formattedTurnsDf.to_csv(os.path.join(newDirPath, cohortName +'_formatted_turns.csv'))
-    print("Outputting formatted distance dataframe.")
-    formattedDistanceDf.to_csv(os.path.join(newDirPath, cohortName +'_formatted_distance.csv'))
-    print("Outputting df with selected hours, if not specified will output all data")
-    selectedDistanceDf.to_csv(os.path.join(newDirPath, cohortName +'_selected_distance.csv'))
-    
-    print("Outputting custom data bins.")
-    if customDfList != None:
-        for dfDict in customDfList:
-            for rule, customDf in dfDict.items():
-                customDf.to_csv(os.path.join(newDirPath, cohortName +'_bin_by_' + rule + '_' + '.csv'))
 
-    print("Outputting data binned by the hour.")
-    hourlyDf.to_csv(os.path.join(newDirPath, cohortName +'_bin_by_hour.csv'))
-    print("Outputting data binned by day")
-    dailyDf.to_csv(os.path.join(newDirPath, cohortName +'_bin_by_day.csv'))
-    # Output the plots
-    # Output session data frames
-    print("Outputting calculated percent run and rest.")
-    percentRunRestDf.to_csv(os.path.join(newDirPath, cohortName + '_percentRunRest.csv'))
-    print('\nExporting results to CSV...')
+def buildSessions(seg, colList):
+    """Used in calcSessions() and the streaming session builder. Pairs up the
+    run and rest phase segments (ordered by animal and then by time, with
+    start and end times filled in) into a session table: a dictionary of flat
+    arrays with one entry per session, ordered by animal and then by session.
+    'animals' holds colList, 'animal' the column number of each session's
+    animal and 'session' its number (from 0) within the animal. Times are
+    int64 nanoseconds. A session without a run or rest phase has run_obs or
+    rest_obs set to False, and 0 in that phase's columns."""
+    isRun = seg['run']
+    nCols = len(colList)
+    if len(isRun) == 0:
+        return emptySessionTable(colList)
 
-    animalSessionsDir = os.path.join(newDirPath, 'animal_sessions')
-    if not os.path.exists(animalSessionsDir):
-        os.makedirs(animalSessionsDir)
+    # Number the sessions within each animal. Every run phase opens a new
+    # session and the rest phase after it shares the run's session number.
+    segCount = np.bincount(seg['animal'], minlength=nCols)
+    firstSeg = np.concatenate(([0], np.cumsum(segCount)[:-1]))
+    lastSeg = firstSeg + segCount - 1
+    hasSeg = segCount > 0
+    leadRest = np.zeros(nCols, dtype=int)
+    leadRest[hasSeg] = ~isRun[firstSeg[hasSeg]]
+    runCount = np.cumsum(isRun)
+    runsBefore = runCount[firstSeg] - isRun[firstSeg]
+    sessionNum = (runCount - runsBefore[seg['animal']] - 1
+                  + leadRest[seg['animal']])
 
-    for animalName, sessionDf in sessionsDict.items():
-        print("Outputting session data for: ", animalName)
-        sessionDf.to_csv(os.path.join(animalSessionsDir, animalName[0] +'_' + animalName[1] + '_sessions.csv'))
+    numSessions = np.zeros(nCols, dtype=int)
+    numSessions[hasSeg] = sessionNum[lastSeg[hasSeg]] + 1
+    sessionOffset = np.concatenate(([0], np.cumsum(numSessions)[:-1]))
+    sessionRow = sessionOffset[seg['animal']] + sessionNum
+    animal = np.repeat(np.arange(nCols), numSessions)
 
-    print('\nMaking plots...')
-    plotGraphs(selectedDistanceDf, percentRunRestDf, hourlyDf, dailyDf, newDirPath, cohortName)
-    print('**Done**.')
+    # Segment number of the run and rest phase of each session, -1 if none
+    runSeg = np.full(numSessions.sum(), -1)
+    restSeg = np.full(numSessions.sum(), -1)
+    segIdx = np.arange(len(isRun))
+    runSeg[sessionRow[isRun]] = segIdx[isRun]
+    restSeg[sessionRow[~isRun]] = segIdx[~isRun]
+    runObs = runSeg >= 0
+    restObs = restSeg >= 0
 
-        
-def getFilenameInfo(FILE_NAME_REGEXP, user_args_input):
-    """Function to split the filename and extension and return both."""
-    
-    # get filename from first command line argument
-    # fileDir, wholeFileName = os.path.split(user_args_input)
-    wholeFileName = os.path.basename(user_args_input)
+    startNs = seg['startTime'].astype('datetime64[ns]').astype(np.int64)
+    endNs = seg['endTime'].astype('datetime64[ns]').astype(np.int64)
 
-    # Use a regular expression to match the filename
-    nameSearchObj = re.search(FILE_NAME_REGEXP, wholeFileName)
+    sessionTable = {'animals':colList, 'animal':animal,
+                    'session':np.arange(len(animal)) - sessionOffset[animal],
+                    'run_start':np.where(runObs, startNs[runSeg], 0),
+                    'run_end':np.where(runObs, endNs[runSeg], 0),
+                    'run_mins':np.where(runObs, seg['mins'][runSeg], 0),
+                    'run_dist(m)':np.where(runObs, seg['dist'][runSeg], 0.0),
+                    'rest_start':np.where(restObs, startNs[restSeg], 0),
+                    'rest_end':np.where(restObs, endNs[restSeg], 0),
+                    'rest_mins':np.where(restObs, seg['mins'][restSeg], 0),
+                    'run_obs':runObs, 'rest_obs':restObs}
 
-    # Capture name without extension. 
-    fileNameNoExtension = nameSearchObj.group(1)
+    return sessionTable
 
-    # Grab file extension to determine if .asc or .csv
-    fileExtension = nameSearchObj.group(2)
 
-    # return information file name without extension (e.g. '.csv', '.asc')
-    return  fileNameNoExtension, fileExtension #, wholeFileName, fileDir
+def sessionTableFromFrames(sessionsDict, colList):
+    """Turn the dictionary of per animal session dataframes from
+    calcSessionsLegacy() into a session table"""
+    frames = []
+    for pos, col in enumerate(colList):
+        df = sessionsDict[col].reset_index(drop=True)
+        frames.append(df.assign(animal=pos, session=df.index))
+    allDf = pd.concat(frames, ignore_index=True)
 
+    sessionTable = emptySessionTable(colList)
+    if len(allDf) == 0:
+        return sessionTable
 
-def parseUserInput():
-    """Use argparse to handle user input for program"""
-    
-    # Create a parser object
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        
-        description="""%(prog)s parses mouse running wheel data and calculates 
-        run and rest sessions.  
+    sessionTable['animal'] = allDf['animal'].values.astype(np.int64)
+    sessionTable['session'] = allDf['session'].values.astype(np.int64)
+    sessionTable['run_obs'] = allDf['run_start'].notnull().values
+    sessionTable['rest_obs'] = allDf['rest_start'].notnull().values
 
-        The program takes '.csv' data output from the 
-        Vitalview Software. The input file should have three levels of headers. 
-        From top to bottom. The header needs to be 'Channel Name:','Channel Group:' 
-        and 'Sensor Type:'""",
+    for name, dtype in SESSION_COLUMNS:
+        if dtype == np.int64 and name.endswith(('start', 'end')):
+            values = pd.to_datetime(allDf[name]).values.astype('datetime64[ns]').astype(np.int64)
+            isObs = sessionTable[name.split('_')[0] + '_obs']
+            sessionTable[name] = np.where(isObs, values, 0)
+        elif dtype != bool:
+            sessionTable[name] = allDf[name].fillna(0).values.astype(dtype)
 
-        epilog=textwrap.dedent("""\
-        The script will output a csv file for each of the following:
-            1) Raw data               <cohort_name>_rawdata.csv
-            2) Formatted turns        <cohort_name>_formatted_turns.csv
-            3) Formatted distance     <cohort_name>_formatted_distance.csv
-            4) Selected distance      <cohort_name>_selected_distance.csv (based on customStart/End inputs)
-            4) Bin by hr              <cohort_name>_bin_by_hour.csv
-            5) Bin by days            <cohort_name>_bin_by_day.csv
-            6) Bin by <X> Hours       <cohort_name>_bin_by_<user_defined_hours>H.csv
-            7) Sessions               <animal>_sessions.csv
-            8) Percent Run & rest     <cohort_name>_percentRunRest.csv
-            9) Graphs                 <cohort_name>_graphs.pdf
-          
-        The pdf of graphs contain plots for:
-            - Total Running Distance By Day
-            - Percent Run and Percent Rest Per Animal
-            - Cumulative Sum Plot Binned By Hour
-            - Distance Histogram Binned By Hour"""))
+    return sessionTable
 
-    parser.add_argument("input",
-        help="File name and/or path to experiment_file.asc or .csv")
+
+def animalSessionsDf(sessionTable, pos, reformatted=False):
+    """Session dataframe of the animal in column pos, the way it is written
+    to <animal>_sessions.csv: missing phases are left blank (NaT/NaN). With
+    reformatted=True it gets the velocity and observed columns from
+    reformatSessions() and sessions are numbered from 1."""
+    first, last = np.searchsorted(sessionTable['animal'], [pos, pos + 1])
+
+    resultsDict = {}
+    for name in SESSION_CSV_COLUMNS:
+        values = sessionTable[name][first:last]
+        isObs = sessionTable[name.split('_')[0] + '_obs'][first:last]
+        if name.endswith(('start', 'end')):
+            values = values.astype('datetime64[ns]')
+        resultsDict[name] = nullableColumn(values, isObs)
+
+    sessionDf = DataFrame(resultsDict, columns=SESSION_CSV_COLUMNS)
+
+    if reformatted:
+        sessionDf.insert(4, 'velocity(m/min)', sessionTable['velocity(m/min)'][first:last])
+        sessionDf['run_obs'] = sessionTable['run_obs'][first:last]
+        sessionDf['rest_obs'] = sessionTable['rest_obs'][first:last]
+        sessionDf.index = sessionDf.index + 1
+        sessionDf.index.name = 'session'
+
+    return sessionDf
+
+
+def longSessionsDf(sessionTable):
+    """All the sessions of every animal in one long format dataframe, the
+    way it is written to <cohort_name>_sessions: indexed by sample, with the
+    group, sensor and session number (from 1) of each session followed by
+    the columns of animalSessionsDf(). Missing phases are left blank."""
+    animal = sessionTable['animal']
+    labels = [col if isinstance(col, tuple) else (col, '', '') for col in sessionTable['animals']]
+    labels = np.array([[str(x) for x in label[:3]] for label in labels], dtype=object).reshape(-1, 3)
+
+    resultsDict = {'group':labels[animal, 1], 'sensor':labels[animal, 2],
+                   'session':sessionTable['session'] + 1}
+    for name in SESSION_CSV_COLUMNS:
+        values = sessionTable[name]
+        if name.endswith(('start', 'end')):
+            values = values.astype('datetime64[ns]')
+        resultsDict[name] = nullableColumn(values, sessionTable[name.split('_')[0] + '_obs'])
+
+    sessionDf = DataFrame(resultsDict, columns=['group', 'sensor', 'session'] + SESSION_CSV_COLUMNS,
+                          index=pd.Index(labels[animal, 0], name='sample'))
+
+    return sessionDf
+
+
+def calcVelocity(sessionTable):
+    """Used in reformatSessions(). Calculate the velocity of each run session,
+    NaN for sessions without a run"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        velocity = sessionTable['run_dist(m)'] / sessionTable['run_mins']
+
+    return np.where(sessionTable['run_obs'], velocity, np.nan)
+
+
+def reformatSessions(sessionTable):
+    """Reformats the session table from calcSessions(). Returns a copy with a
+    run velocity column added. Whether a run or rest was observed in each
+    session is already held in run_obs and rest_obs. Use
+    animalSessionsDf(reformatted=True) for an animal's dataframe with the
+    session, velocity and observed columns."""
+    reformattedTable = dict(sessionTable)
+    reformattedTable['velocity(m/min)'] = calcVelocity(sessionTable)
+
+    return reformattedTable
+
+
+def calcPercentRunRest(sessionTable):
+    '''Calculate the percentage the animal ran and rested of the total time the
+    data was collected. If data was collected one row per minute, the number of
+    rows in the raw data file should correspond to the sum total of minutes.'''
+    colList = sessionTable['animals']
+    animal = sessionTable['animal']
+
+    def sumByAnimal(name):
+        return np.bincount(animal, weights=sessionTable[name], minlength=len(colList))
+
+    sumMinsRun = sumByAnimal('run_mins').astype(np.int64)
+    sumMinsRest = sumByAnimal('rest_mins').astype(np.int64)
+    sumTotal = sumMinsRun + sumMinsRest
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentRun = (sumMinsRun / sumTotal * 100).round(2)
+        percentRest = (sumMinsRest / sumTotal * 100).round(2)
+
+    percentRunRestDf = DataFrame({'animal':list(colList), 'sum_mins_run':sumMinsRun,
+        'sum_dist_run(m)':sumByAnimal('run_dist(m)'), 'sum_mins_rest':sumMinsRest,
+        'total_mins':sumTotal, 'percent_mins_run':percentRun,
+        'percent_mins_rest':percentRest})
+    percentRunRestDf.index.name = 'index'
+
+    return percentRunRestDf
+
+
+def animalGroups(colList):
+    """Group names in the order they first appear in the 'Channel Group:'
+    header, and the group number of each animal column"""
+    groupIdx, groupNames = pd.factorize(colList.get_level_values('group'))
+
+    return list(groupNames), groupIdx
+
+
+def groupMeanSem(values, groupIdx, numGroups):
+    """Mean, standard error of the mean and number of animals of each group,
+    for every row of values (rows x animals) at once. NaN values are left
+    out. The SEM uses n - 1 like pandas' sem() and is NaN for groups with
+    fewer than 2 values."""
+    isValid = ~np.isnan(values)
+    membership = np.zeros((values.shape[1], numGroups))
+    membership[np.arange(values.shape[1]), groupIdx] = 1
+
+    count = isValid.astype(float) @ membership
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(isValid, values, 0) @ membership / count
+        deviation = np.where(isValid, values - mean[:, groupIdx], 0)
+        sem = np.sqrt((deviation ** 2 @ membership) / (count - 1) / count)
+    sem[count < 2] = np.nan
+
+    return mean, sem, count.astype(np.int64)
+
+
+def calcGroupBins(binnedDf):
+    """Group mean, SEM and number of animals of binned distance data, columns
+    are labeled (group, stat)"""
+    groupNames, groupIdx = animalGroups(binnedDf.columns)
+    mean, sem, count = groupMeanSem(binnedDf.values.astype(float), groupIdx, len(groupNames))
+
+    stats = np.stack([mean, sem, count], axis=2).reshape(len(binnedDf), -1)
+    columns = pd.MultiIndex.from_product([groupNames, ['mean', 'sem', 'n']],
+                                         names=['group', 'stat'])
+    groupBinnedDf = DataFrame(stats, index=binnedDf.index, columns=columns)
+
+    return groupBinnedDf
+
+
+def calcAnimalSessionStats(sessionTable):
+    """Used in calcGroupStats(). Number of sessions and the average run
+    length, run distance, run velocity and rest length of each animal.
+    Sessions without a run (or rest) are left out of the run (rest)
+    averages."""
+    colList = sessionTable['animals']
+    animal = sessionTable['animal']
+    runObs = sessionTable['run_obs']
+    restObs = sessionTable['rest_obs']
+    velocity = calcVelocity(sessionTable)
+
+    def meanByAnimal(values, isObs):
+        sums = np.bincount(animal[isObs], weights=values[isObs], minlength=len(colList))
+        counts = np.bincount(animal[isObs], minlength=len(colList))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    animalStats = {'num_sessions':np.bincount(animal, minlength=len(colList)).astype(float),
+                   'mean_run_mins':meanByAnimal(sessionTable['run_mins'], runObs),
+                   'mean_run_dist(m)':meanByAnimal(sessionTable['run_dist(m)'], runObs),
+                   'mean_velocity(m/min)':meanByAnimal(velocity, runObs),
+                   'mean_rest_mins':meanByAnimal(sessionTable['rest_mins'], restObs)}
+
+    return animalStats
+
+
+def calcGroupStats(percentRunRestDf, sessionTable):
+    """Group mean and SEM (over the animals in each group) of the percent run
+    and rest, distance run and session statistics. One row per group."""
+    colList = sessionTable['animals']
+    groupNames, groupIdx = animalGroups(colList)
+
+    animalStats = {name:percentRunRestDf[name].values.astype(float) for name in
+                   ['percent_mins_run', 'percent_mins_rest', 'sum_mins_run', 'sum_dist_run(m)']}
+    animalStats.update(calcAnimalSessionStats(sessionTable))
+
+    measures = list(animalStats)
+    mean, sem, count = groupMeanSem(np.array([animalStats[name] for name in measures]),
+                                    groupIdx, len(groupNames))
+
+    groupStatsDf = DataFrame({'num_animals':np.bincount(groupIdx, minlength=len(groupNames))},
+                             index=pd.Index(groupNames, name='group'))
+    for pos, name in enumerate(measures):
+        groupStatsDf[name + '_mean'] = mean[pos]
+        groupStatsDf[name + '_sem'] = sem[pos]
+
+    return groupStatsDf
+
+
+def lightSchedule(lightsOn, lightsOff):
+    """Turn the --lightsOn/--lightsOff 'hour:min' times into minutes of the
+    day. Returns None if neither was given, exits if only one was or if a
+    time can't be read."""
+    if lightsOn == None and lightsOff == None:
+        return None
+    if lightsOn == None or lightsOff == None:
+        print("Give both --lightsOn and --lightsOff for the light/dark phase tables.")
+        sys.exit(1)
+
+    lights = []
+    for timeString in [lightsOn, lightsOff]:
+        try:
+            hour, minute = [int(x) for x in timeString.split(':')]
+        except ValueError:
+            hour, minute = -1, -1
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            print("Can't read '{0}', give the light times as 'hour:min' (e.g. '6:00' or '18:30').".format(timeString))
+            sys.exit(1)
+        lights.append(hour * 60 + minute)
+
+    if lights[0] == lights[1]:
+        print("--lightsOn and --lightsOff can't be the same time.")
+        sys.exit(1)
+
+    return tuple(lights)
+
+
+def isLightMinute(minuteOfDay, lights):
+    """True for the minutes of the day in the light phase. Lights off can be
+    before lights on, the light phase then runs over midnight."""
+    lightsOn, lightsOff = lights
+    return (minuteOfDay - lightsOn) % DAY_MINUTES < (lightsOff - lightsOn) % DAY_MINUTES
+
+
+def initCircadian(lights, minDistance=0.0):
+    """Running totals for the light/dark phase and 24 hour profile tables:
+    distance, observed minutes and running minutes (distance > minDistance)
+    of every animal by hour of the day and phase (dark 0, light 1). The
+    arrays are made once the number of animals is known."""
+    return {'lights':lights, 'minDistance':minDistance, 'dist':None, 'mins':None,
+            'runMins':None}
+
+
+def updateCircadian(circadian, selectedChunk):
+    """Add a block of selected distance data to the light/dark totals. Every
+    minute goes to a slot for its hour of the day and phase, and each slot
+    is summed in a single grouped pass."""
+    timesNs = selectedChunk.index.values.astype('datetime64[ns]').astype(np.int64)
+    values = selectedChunk.values.astype(float)
+    if circadian['dist'] is None:
+        for name in ['dist', 'mins', 'runMins']:
+            circadian[name] = np.zeros((24, 2, values.shape[1]))
+
+    minuteOfDay = (timesNs // MINUTE_NS) % DAY_MINUTES
+    slot = (minuteOfDay // 60) * 2 + isLightMinute(minuteOfDay, circadian['lights'])
+
+    observed = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        running = values > circadian['minDistance']
+    for name, minuteValues in [('dist', np.where(observed, values, 0.0)), ('mins', observed),
+                               ('runMins', running)]:
+        sums = DataFrame(minuteValues).groupby(slot).sum()
+        circadian[name].reshape(48, -1)[sums.index.values] += sums.values
+
+
+def finishCircadian(circadian, sessionTable):
+    """Turn the light/dark totals into the per animal phase table (distance,
+    minutes, running minutes and number of sessions started in each phase)
+    and the average 24 hour profile (meters per hour at each hour of the day,
+    averaged over the days). Returns them with the light schedule in a
+    dictionary."""
+    colList = sessionTable['animals']
+    if circadian['dist'] is None:
+        updateCircadian(circadian, DataFrame(columns=colList, dtype=float,
+                        index=pd.DatetimeIndex([])))
+    dist, mins, runMins = circadian['dist'], circadian['mins'], circadian['runMins']
+
+    # Sessions count towards the phase their run started in
+    runStart = sessionTable['run_start'][sessionTable['run_obs']]
+    animal = sessionTable['animal'][sessionTable['run_obs']]
+    startLight = isLightMinute((runStart // MINUTE_NS) % DAY_MINUTES, circadian['lights'])
+
+    lightDarkDf = DataFrame({'animal':list(colList)})
+    for phase, isLight in [('light', 1), ('dark', 0)]:
+        lightDarkDf[phase + '_dist(m)'] = dist[:, isLight].sum(axis=0)
+        lightDarkDf[phase + '_mins'] = mins[:, isLight].sum(axis=0).astype(np.int64)
+        lightDarkDf[phase + '_run_mins'] = runMins[:, isLight].sum(axis=0).astype(np.int64)
+        lightDarkDf[phase + '_sessions'] = np.bincount(animal[startLight == isLight],
+                                                       minlength=len(colList))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lightDarkDf['percent_dist_dark'] = (lightDarkDf['dark_dist(m)'] /
+            (lightDarkDf['light_dist(m)'] + lightDarkDf['dark_dist(m)']) * 100).round(2)
+        profile = dist.sum(axis=1) / mins.sum(axis=1) * 60
+    lightDarkDf.index.name = 'index'
+
+    profileDf = DataFrame(profile, index=pd.RangeIndex(24, name='hour'), columns=colList)
+
+    return {'lights':circadian['lights'], 'lightDark':lightDarkDf, 'profile':profileDf}
+
+
+def calcCircadian(selectedDistanceDf, sessionTable, lights, minDistance=0.0):
+    """Light/dark phase totals and the average 24 hour profile of the
+    selected distance data, see finishCircadian()"""
+    circadian = initCircadian(lights, minDistance)
+    if len(selectedDistanceDf) > 0:
+        updateCircadian(circadian, selectedDistanceDf)
+
+    return finishCircadian(circadian, sessionTable)
+
+
+def initSynchrony():
+    """Running sums for the animal by animal activity correlation, see
+    updateSynchrony(). The arrays are made once the number of animals is
+    known."""
+    return {'shift':None, 'count':None, 'sum':None, 'sumSq':None, 'cross':None}
+
+
+def updateSynchrony(synchrony, selectedChunk):
+    """Add a block of selected distance data to the pairwise sums, at most
+    SYNC_BLOCK_ROWS minutes at a time so memory doesn't grow with the block.
+    Every sum is an animal by animal matrix product, and a minute only counts
+    towards a pair if both animals have a value. Values are shifted by the
+    first block's means to keep the sums accurate."""
+    values = selectedChunk.values.astype(float)
+    if synchrony['count'] is None:
+        observed = ~np.isnan(values)
+        synchrony['shift'] = (np.where(observed, values, 0.0).sum(axis=0)
+                              / np.maximum(observed.sum(axis=0), 1))
+        for name in ['count', 'sum', 'sumSq', 'cross']:
+            synchrony[name] = np.zeros((values.shape[1], values.shape[1]))
+
+    for start in range(0, len(values), SYNC_BLOCK_ROWS):
+        block = values[start:start + SYNC_BLOCK_ROWS] - synchrony['shift']
+        observed = ~np.isnan(block)
+        filled = np.where(observed, block, 0.0)
+        observed = observed.astype(float)
+
+        synchrony['count'] += observed.T @ observed
+        synchrony['sum'] += filled.T @ observed # [i, j] sums animal i where j has a value
+        synchrony['sumSq'] += (filled * filled).T @ observed
+        synchrony['cross'] += filled.T @ filled
+
+
+def synchronyCorrelation(synchrony, colList):
+    """Pearson correlation of every pair of animals from the sums of
+    updateSynchrony(), over the minutes both have a value. NaN where a pair
+    has fewer than 2 such minutes or an animal doesn't vary."""
+    if synchrony['count'] is None:
+        return DataFrame(np.full((len(colList), len(colList)), np.nan),
+                         index=synchronyIndex(colList), columns=colList)
+
+    count = synchrony['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = synchrony['sum'] / count
+        cov = synchrony['cross'] / count - mean * mean.T
+        var = synchrony['sumSq'] / count - mean * mean
+        corr = cov / np.sqrt(var * var.T)
+    corr[count < 2] = np.nan
+    corr = np.clip(corr, -1, 1)
+
+    return DataFrame(corr, index=synchronyIndex(colList), columns=colList)
+
+
+def synchronyIndex(colList):
+    """Row labels of the animal by animal tables: the sample names"""
+    return pd.Index([col[0] if isinstance(col, tuple) else col for col in colList])
+
+
+def calcBoutOverlap(sessionTable):
+    """Overlap of the run bouts of every pair of animals, from the run phases
+    of the session table. The time line is split at every run start and end,
+    which animals run in each piece follows from a running count of starts
+    and ends, and the pieces' lengths are added up for every pair with one
+    matrix product per SYNC_BLOCK_ROWS pieces. Returns the Jaccard index of
+    the running minutes (minutes both ran / minutes either ran)."""
+    colList = sessionTable['animals']
+    numCols = len(colList)
+    isRun = sessionTable['run_obs'] & (sessionTable['run_mins'] > 0)
+    start = sessionTable['run_start'][isRun] // MINUTE_NS
+    end = start + sessionTable['run_mins'][isRun]
+    bothMins = np.zeros((numCols, numCols))
+
+    bounds = np.unique(np.concatenate([start, end]))
+    numPieces = max(len(bounds) - 1, 0)
+    length = np.diff(bounds).astype(float)
+
+    # +1 at the piece a run starts in, -1 at the piece after it ends
+    events = np.concatenate([np.searchsorted(bounds, start), np.searchsorted(bounds, end)])
+    order = np.argsort(events, kind='stable')
+    events = events[order]
+    eventAnimal = np.tile(sessionTable['animal'][isRun], 2)[order]
+    eventStep = np.repeat([1.0, -1.0], isRun.sum())[order]
+
+    running = np.zeros(numCols)
+    for first in range(0, numPieces, SYNC_BLOCK_ROWS):
+        last = min(first + SYNC_BLOCK_ROWS, numPieces)
+        lo, hi = np.searchsorted(events, [first, last])
+        steps = np.zeros((last - first, numCols))
+        np.add.at(steps, (events[lo:hi] - first, eventAnimal[lo:hi]), eventStep[lo:hi])
+        active = running + np.cumsum(steps, axis=0)
+        running = active[-1]
+        bothMins += active.T @ (active * length[first:last, None])
+
+    runMins = np.diag(bothMins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overlap = bothMins / (runMins[:, None] + runMins[None, :] - bothMins)
+
+    return DataFrame(overlap, index=synchronyIndex(colList), columns=colList)
+
+
+def synchronyGroupStats(minuteCorrDf, hourCorrDf, overlapDf):
+    """Mean correlation and bout overlap over the pairs of animals within
+    each group, and over all pairs (group 'all'). Groups are in the same
+    order as in calcGroupStats()."""
+    colList = minuteCorrDf.columns
+    groupNames, groupIdx = animalGroups(colList)
+    numGroups = len(groupNames)
+
+    # Every pair once, and the group of the pairs within a group
+    first, second = np.triu_indices(len(colList), k=1)
+    sameGroup = groupIdx[first] == groupIdx[second]
+    pairGroup = groupIdx[first][sameGroup]
+
+    groupStatsDf = DataFrame({'num_animals':np.append(np.bincount(groupIdx, minlength=numGroups),
+                                                      len(colList)),
+                              'num_pairs':np.append(np.bincount(pairGroup, minlength=numGroups),
+                                                    len(first))},
+                             index=pd.Index(list(groupNames) + ['all'], name='group'))
+
+    for name, matrixDf in [('minute_corr', minuteCorrDf), ('hour_corr', hourCorrDf),
+                           ('bout_overlap', overlapDf)]:
+        values = matrixDf.values[first, second]
+        isValid = ~np.isnan(values)
+        inGroup = isValid[sameGroup]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            groupMean = (np.bincount(pairGroup[inGroup], weights=values[sameGroup][inGroup],
+                                     minlength=numGroups)
+                         / np.bincount(pairGroup[inGroup], minlength=numGroups))
+        allMean = values[isValid].mean() if isValid.any() else np.nan
+        groupStatsDf[name + '_mean'] = np.append(groupMean, allMean).round(4)
+
+    return groupStatsDf
+
+
+def finishSynchrony(synchrony, hourlyDf, sessionTable):
+    """Turn the minute correlation sums into the synchrony tables: the animal
+    by animal correlation of the minute and the hourly distance, the run bout
+    overlap (see calcBoutOverlap()) and the group means of each. Returns them
+    in a dictionary."""
+    colList = sessionTable['animals']
+    hourly = initSynchrony()
+    if len(hourlyDf) > 0:
+        updateSynchrony(hourly, hourlyDf)
+
+    minuteCorrDf = synchronyCorrelation(synchrony, colList)
+    hourCorrDf = synchronyCorrelation(hourly, colList)
+    overlapDf = calcBoutOverlap(sessionTable)
+
+    return {'minuteCorr':minuteCorrDf, 'hourCorr':hourCorrDf, 'overlap':overlapDf,
+            'groups':synchronyGroupStats(minuteCorrDf, hourCorrDf, overlapDf)}
+
+
+def calcSynchrony(selectedDistanceDf, hourlyDf, sessionTable):
+    """Animal by animal activity correlation and run bout overlap of the
+    selected distance data, see finishSynchrony()"""
+    synchrony = initSynchrony()
+    if len(selectedDistanceDf) > 0:
+        updateSynchrony(synchrony, selectedDistanceDf)
+
+    return finishSynchrony(synchrony, hourlyDf, sessionTable)
+
+
+################################################################################
+### Section below contains functions for streaming large files in chunks     ###
+################################################################################
+
+def takeSegments(seg, selector):
+    """Select a subset of the phase segments from findPhaseSegments()"""
+    return {key:values[selector] for key, values in seg.items()}
+
+
+def initBinState(customGrpByHr):
+    """Empty running totals for every bin size in binRules(). The bin origin
+    is filled in once the first selected row is seen."""
+    binState = []
+    for rule, freqN, freqNs in binRules(customGrpByHr):
+        binState.append({'rule':rule, 'freqN':freqN, 'freqNs':freqNs, 
+                         'origin':None, 'parts':[]})
+    return binState
+
+
+def updateBins(binState, selectedChunk, baseParam):
+    """Add the sums of a chunk of selected distance data to every bin size. 
+    Rows are in time order, so each bin is a contiguous block of rows."""
+    times = selectedChunk.index.values
+    values = np.nan_to_num(selectedChunk.values.astype(float)) # NaN sums as 0, same as resample
+
+    for bins in binState:
+        if bins['origin'] == None:
+            bins['origin'] = calcBinOrigin(times[0], baseParam, bins['freqN'], bins['freqNs'])
+
+        binNums = calcBinNumbers(times, bins['origin'], bins['freqNs'])
+        starts = np.flatnonzero(np.concatenate(([True], binNums[1:] != binNums[:-1])))
+        bins['parts'].append((binNums[starts], np.add.reduceat(values, starts, axis=0)))
+
+
+def finishBins(bins, colList):
+    """Combine the partial sums of one bin size into a dataframe laid out the
+    same as selectedDistanceDf.resample(rule, base=baseParam).sum()"""
+    binNums = np.concatenate([part[0] for part in bins['parts']])
+    sums = np.concatenate([part[1] for part in bins['parts']])
+
+    # A bin split across two chunks shows up twice, add them together
+    firstBin = binNums.min()
+    binnedArray = np.zeros((binNums.max() - firstBin + 1, len(colList)))
+    np.add.at(binnedArray, binNums - firstBin, sums)
+
+    return binnedFrame(binnedArray, bins['origin'], firstBin, bins['freqNs'], colList)
+
+
+def updateSessionState(sessionState, selectedChunk):
+    """Streaming version of calcSessions(). Finds the run and rest phases in a
+    chunk of selected distance data and carries each animal's last (still 
+    open) phase over to the next chunk. Phases that are finished get their end
+    time and are stored as segments until finishSessions() is called."""
+    times = selectedChunk.index.values
+    seg = findPhaseSegments(selectedChunk.values.astype(float),
+                            sessionState['bouts']['minDistance'])
+    seg['startTime'] = times[seg['start']]
+    nextRow = seg['start'] + seg['mins']
+
+    segCount = np.bincount(seg['animal'], minlength=selectedChunk.shape[1])
+    lastSeg = np.cumsum(segCount) - 1
+    firstSeg = lastSeg - segCount + 1
+
+    openSeg = sessionState['open']
+    if openSeg != None:
+        # Phase continues into this chunk, merge it into the first segment
+        same = openSeg['run'] == seg['run'][firstSeg]
+        contSeg = firstSeg[same]
+        seg['startTime'][contSeg] = openSeg['startTime'][same]
+        seg['mins'][contSeg] += openSeg['mins'][same]
+        seg['dist'][contSeg] += openSeg['dist'][same]
+
+        # Phase changed right at the chunk boundary, close it out
+        closedOpen = takeSegments(openSeg, ~same)
+        closedOpen['endTime'] = np.repeat(times[0], len(closedOpen['run']))
+        sessionState['closed'].append(closedOpen)
+
+    # Every segment but each animal's last one ends inside this chunk
+    isClosed = np.ones(len(seg['run']), dtype=bool)
+    isClosed[lastSeg] = False
+    closed = takeSegments(seg, isClosed)
+    closed['endTime'] = times[nextRow[isClosed]]
+    sessionState['closed'].append(closed)
+
+    sessionState['open'] = takeSegments(seg, lastSeg)
+    sessionState['lastTime'] = times[-1]
+
+
+def finishSessions(sessionState, colList):
+    """Close out the open phases on the last row, apply the bout rules and
+    build the sessions"""
+    openSeg = sessionState['open']
+    if openSeg == None:
+        return emptySessionTable(colList)
+
+    openSeg['endTime'] = np.repeat(sessionState['lastTime'], len(openSeg['run']))
+    parts = sessionState['closed'] + [openSeg]
+    seg = {key:np.concatenate([part[key] for part in parts]) for key in openSeg}
+
+    # Stable sort keeps each animal's segments in time order
+    seg = takeSegments(seg, np.argsort(seg['animal'], kind='mergesort'))
+    seg = applyBoutRules(seg, sessionState['bouts'])
+
+    return buildSessions(seg, colList)
+
+
+def appendCsv(streamState, name, df, **kwargs):
+    """Write the first chunk of a minute level table with its header, then
+    append the rest. The date format is fixed, pandas would drop the time on
+    a chunk that happens to only hold midnight. Minute level tables are
+    always written as csv when streaming. Compressed tables get one
+    compressed frame (gzip member) per chunk, which read back as one file."""
+    if name not in streamState['artifacts']:
+        return
+
+    outputPath = streamState['paths'][name]
+    kwargs['date_format'] = '%Y-%m-%d %H:%M:%S'
+    isAppend = name in streamState['written']
+
+    with openOutput(outputPath, 'at' if isAppend else 'wt', streamState['compressLevel']) as f:
+        df.to_csv(f, header=not isAppend, **kwargs)
+    streamState['written'].add(name)
+
+
+def streamFilledRows(streamState, formattedTurnsDf):
+    """Process a block of back filled turns data: write the minute level
+    tables and update the bins and sessions with the selected rows"""
+    formattedDistanceDf = formattedTurnsDf.astype(float) * 0.361 # Convert turns to meters
+    appendCsv(streamState, 'turns', formattedTurnsDf, float_format='%.10g')
+    appendCsv(streamState, 'distance', formattedDistanceDf)
+    if streamState['store'] != None:
+        storeMinutes(streamState['store'], streamState['cohortName'], formattedDistanceDf)
+
+    selectedChunk = formattedDistanceDf[streamState['customStart']:streamState['customEnd']]
+    if len(selectedChunk) == 0:
+        return
+
+    appendCsv(streamState, 'selected', selectedChunk)
+
+    if streamState['baseParam'] == None:
+        startHr, startMin = getStartingTime(selectedChunk)
+        streamState['baseParam'] = calcBaseParam(startHr, startMin)
+
+    updateBins(streamState['bins'], selectedChunk, streamState['baseParam'])
+    updateSessionState(streamState['sessions'], selectedChunk)
+    if streamState['circadian'] != None:
+        updateCircadian(streamState['circadian'], selectedChunk)
+    if streamState['synchrony'] != None:
+        updateSynchrony(streamState['synchrony'], selectedChunk)
+
+
+def initStreamState(newDirPath, cohortName, customStart, customEnd, customGrpByHr,
+    artifacts=None, compress=None, compressLevel=None, bouts=None, lights=None, synchrony=False):
+    """Everything the streaming pipeline keeps between chunks: where the 
+    minute level tables go, which of them to write and how to compress them,
+    the selected time window, running null counts, the row held back for
+    back filling, and the bin and session totals along with the bout rules.
+    The light/dark totals are only kept if a light schedule is given, the
+    correlation sums only with synchrony=True. The store (see initStore())
+    is set by the caller, it isn't saved."""
+    customStartDt, customEndDt = parseCustomDateTimes(customStart, customEnd)
+    if artifacts == None:
+        artifacts = OUTPUT_ARTIFACTS
+    if bouts == None:
+        bouts = boutRules()
+
+    streamState = {'paths':streamPaths(newDirPath, cohortName, compress), 'written':set(),
+                   'cohortName':cohortName, 'store':None, 'storePath':None,
+                   'artifacts':list(artifacts), 'compress':compress, 'compressLevel':compressLevel, 
+                   'customStart':customStartDt, 'customEnd':customEndDt, 
+                   'customGrpByHr':customGrpByHr, 'baseParam':None, 
+                   'nullCounts':None, 'quality':initQuality(), 'carryRow':None, 'colList':None,
+                   'bins':initBinState(customGrpByHr),
+                   'sessions':{'open':None, 'closed':[], 'lastTime':None, 'bouts':bouts},
+                   'circadian':None, 'synchrony':None}
+    if lights != None:
+        streamState['circadian'] = initCircadian(lights, bouts['minDistance'])
+    if synchrony:
+        streamState['synchrony'] = initSynchrony()
+    return streamState
+
+
+def streamPaths(newDirPath, cohortName, compress=None):
+    """Paths of the minute level tables written by the streaming pipeline"""
+    paths = {}
+    for name, suffix in [('raw', '_rawdata.csv'), ('turns', '_formatted_turns.csv'),
+            ('distance', '_formatted_distance.csv'), ('selected', '_selected_distance.csv')]:
+        paths[name] = os.path.join(newDirPath, cohortName + suffix)
+        if compress != None:
+            paths[name] += COMPRESSIONS[compress]
+
+    return paths
+
+
+def streamRawChunk(streamState, rawChunk):
+    """Feed one chunk of raw turns data through the streaming pipeline"""
+    appendCsv(streamState, 'raw', rawChunk, float_format='%.10g')
+    streamState['colList'] = rawChunk.columns
+
+    if streamState['nullCounts'] is None:
+        streamState['nullCounts'] = rawChunk.isnull().sum()
+    else:
+        streamState['nullCounts'] = streamState['nullCounts'] + rawChunk.isnull().sum()
+    updateQuality(streamState['quality'],
+                  rawChunk.index.values.astype('datetime64[ns]').astype(np.int64))
+
+    # Hold back the last row, it may need back filling from the next chunk
+    if streamState['carryRow'] is not None:
+        rawChunk = pd.concat([streamState['carryRow'], rawChunk])
+    streamState['carryRow'] = rawChunk.iloc[-1:]
+
+    filledChunk = rawChunk.fillna(method='bfill', limit=1) # Same back fill as fillNa()
+    streamFilledRows(streamState, filledChunk.iloc[:-1])
+
+
+def finishStream(streamState, tableWriter):
+    """Process the last row, then output the null counts, bins, sessions and
+    plots from the running totals"""
+    streamFilledRows(streamState, streamState['carryRow']) # Nothing left to back fill the last row from
+    checkSelectedWindow(streamState['baseParam'] == None)
+    colList = streamState['colList']
+
+    qualityCounts = finishQuality(streamState['quality'])
+    printQualityWarnings(qualityCounts)
+    nullRows = addQualityCounts(labelNullCounts(streamState['nullCounts']), qualityCounts)
+    print("Outputting number of null rows.")
+    writeTable(tableWriter, 'null', tableWriter['cohortName'] +'_num_null', nullRows)
+
+    binnedDfs = [finishBins(bins, colList) for bins in streamState['bins']]
+    hourlyDf, dailyDf = binnedDfs[0], binnedDfs[1]
+
+    if streamState['customGrpByHr'] != None:
+        customDfList = [{bins['rule']:binnedDf} for bins, binnedDf 
+                        in zip(streamState['bins'][2:], binnedDfs[2:])]
+    else:
+        customDfList = None
+
+    sessionTable = finishSessions(streamState['sessions'], colList)
+    percentRunRestDf = calcPercentRunRest(sessionTable)
+    circadian = None
+    if streamState['circadian'] != None:
+        circadian = finishCircadian(streamState['circadian'], sessionTable)
+    synchrony = None
+    if streamState['synchrony'] != None:
+        synchrony = finishSynchrony(streamState['synchrony'], hourlyDf, sessionTable)
+
+    outputResults(hourlyDf, dailyDf, customDfList, sessionTable, percentRunRestDf, 
+        tableWriter, circadian, synchrony)
+
+
+def streamCohort(inputPath, cohortName, customStart, customEnd, customGrpByHr,
+    chunkSize, outputFormat='csv', artifacts=None, plotWorkers=1, deferPlots=False,
+    profiler=None, writeWorkers=0, durable=False, compress=None, compressLevel=None,
+    bouts=None, lights=None, storePath=None, plotPoints=DEFAULT_PLOT_POINTS,
+    sessionLayout='animal', synchrony=False):
+    """Streaming version of the whole pipeline for recordings too long to hold
+    in memory. Reads chunkSize minute rows at a time, writes the minute level
+    tables as it goes and keeps only running totals for the bins and each 
+    animal's open run or rest phase, so memory stays flat however long the
+    recording is. Produces the same output files as outputAllToFile(), but 
+    the minute level tables are always csv."""
+    newDirPath = makeCohortDir(cohortName)
+    store = initStore(storePath) if storePath != None else None
+    tableWriter = initTableWriter(newDirPath, cohortName, outputFormat, artifacts,
+                                  plotWorkers, deferPlots, profiler, writeWorkers, durable,
+                                  compress, compressLevel, store, plotPoints, sessionLayout)
+    streamState = initStreamState(newDirPath, cohortName, customStart, customEnd,
+                                  customGrpByHr, artifacts, compress, compressLevel, bouts,
+                                  lights, synchrony)
+    streamState['store'] = store
+
+    print('\nStreaming data in chunks of {0} rows...'.format(chunkSize))
+    with profileStage(profiler, 'streamChunks'):
+        for rawChunk in readVitalViewChunks(inputPath, chunkSize):
+            streamRawChunk(streamState, rawChunk)
+
+    with profileStage(profiler, 'finishStream'):
+        finishStream(streamState, tableWriter)
+
+
+################################################################################
+### Section below contains functions for incremental re-analysis             ###
+################################################################################
+
+def readVitalViewRange(inputPath, headerIndex, startOffset, endOffset, chunkSize, sep=',',
+    dateFields=1):
+    """Yield chunks of raw turns data for the rows between two byte offsets of
+    the file, along with the offset just past the last row of each chunk. 
+    Reading starts with a seek, so rows before startOffset cost nothing.
+    sep and dateFields are from readInputLayout()."""
+    numCols = len(headerIndex) + 1
+    blockBytes = chunkSize * numCols * 4 # rough guess of chunkSize rows
+
+    with open(inputPath, 'rb') as f:
+        f.seek(startOffset)
+        position = startOffset
+        pending = b''
+
+        while position < endOffset:
+            data = f.read(min(blockBytes, endOffset - position))
+            if len(data) == 0:
+                break # file was truncated while reading
+            position += len(data)
+            pending += data
+
+            # Only parse whole rows, keep a partial row for the next block
+            if position < endOffset:
+                cut = pending.rfind(b'\n') + 1
+            else:
+                cut = len(pending)
+
+            block, pending = pending[:cut], pending[cut:]
+            if len(block.strip()) == 0:
+                continue
+
+            rawChunk = readVitalViewBody(io.BytesIO(block), numCols, 0, sep=sep,
+                                         dateFields=dateFields)
+            rawChunk.columns = headerIndex
+            yield convertDatetime(rawChunk), position - len(pending)
+
+
+def fileFingerprint(inputPath, offset):
+    """Hash of the header rows and the first and last few kB of data before 
+    offset. If the file was only appended to since the last run, these bytes
+    won't have changed."""
+    headerEnd = readInputLayout(inputPath, check=False)['headerEnd']
+    with open(inputPath, 'rb') as f:
+        head = f.read(min(offset, headerEnd + 4096))
+        f.seek(max(f.tell(), offset - 4096))
+        tail = f.read(offset - f.tell())
+
+    return hashlib.sha1(head + tail).hexdigest()
+
+
+def compactStreamState(streamState):
+    """Merge the per chunk bin sums and closed session segments into single 
+    arrays, so the saved state doesn't keep growing a list every run"""
+    for bins in streamState['bins']:
+        if len(bins['parts']) > 1:
+            binNums = np.concatenate([part[0] for part in bins['parts']])
+            sums = np.concatenate([part[1] for part in bins['parts']])
+            uniqueNums, position = np.unique(binNums, return_inverse=True)
+            merged = np.zeros((len(uniqueNums), sums.shape[1]))
+            np.add.at(merged, position, sums)
+            bins['parts'] = [(uniqueNums, merged)]
+
+    quality = streamState['quality']
+    if len(quality['late']) > 1:
+        quality['late'] = [np.sort(np.concatenate(quality['late']))]
+
+    sessionState = streamState['sessions']
+    if len(sessionState['closed']) > 1:
+        parts = sessionState['closed']
+        sessionState['closed'] = [{key:np.concatenate([part[key] for part in parts]) 
+                                   for key in parts[0]}]
+
+
+def saveStreamState(statePath, streamState, inputPath, offset):
+    """Save the streaming state to the cohort folder, along with where to pick
+    up reading the input file and how big each minute level table was"""
+    compactStreamState(streamState)
+
+    savedState = dict(streamState)
+    del savedState['paths'] # rebuilt on load, the folder may have moved
+    del savedState['store']
+    savedState['offset'] = offset
+    savedState['fingerprint'] = fileFingerprint(inputPath, offset)
+    savedState['csvSizes'] = {name:os.path.getsize(streamState['paths'][name]) 
+                              for name in streamState['written']}
+
+    with open(statePath, 'wb') as f:
+        pickle.dump(savedState, f)
+
+
+def loadStreamState(statePath, inputPath, newDirPath, cohortName, customStart, 
+    customEnd, customGrpByHr, artifacts, compress=None, bouts=None, lights=None, storePath=None,
+    synchrony=False):
+    """Load the state saved by the last incremental run. Returns None (start
+    over) if there is none, if the input file was changed rather than appended
+    to, if the analysis options changed or if the outputs (or the cohort's rows
+    in the store) were touched."""
+    if not os.path.exists(statePath):
+        return None
+
+    with open(statePath, 'rb') as f:
+        streamState = pickle.load(f)
+    streamState['paths'] = streamPaths(newDirPath, cohortName, streamState.get('compress'))
+    streamState['store'] = None
+
+    if 'synchrony' not in streamState or 'late' not in streamState['quality']:
+        print('The saved state is from an older version, starting over.')
+        return None
+
+    customStartDt, customEndDt = parseCustomDateTimes(customStart, customEnd)
+    if artifacts == None:
+        artifacts = OUTPUT_ARTIFACTS
+    if bouts == None:
+        bouts = boutRules()
+
+    savedLights = None
+    if streamState['circadian'] != None:
+        savedLights = streamState['circadian']['lights']
+
+    if ((streamState['customStart'], streamState['customEnd'], streamState['customGrpByHr'],
+            streamState['artifacts'], streamState.get('compress'), streamState['sessions']['bouts'],
+            savedLights, streamState['storePath'], streamState['synchrony'] != None) !=
+            (customStartDt, customEndDt, customGrpByHr, list(artifacts), compress, bouts, lights,
+             storePath, synchrony)):
+        print('Analysis options changed since the last run, starting over.')
+        return None
+
+    offset = streamState['offset']
+    if (os.path.getsize(inputPath) < offset or 
+            fileFingerprint(inputPath, offset) != streamState['fingerprint']):
+        print('{0} changed since the last run, starting over.'.format(inputPath))
+        return None
+
+    for name, size in streamState['csvSizes'].items():
+        outputPath = streamState['paths'][name]
+        if not os.path.exists(outputPath) or os.path.getsize(outputPath) < size:
+            print('{0} is missing or incomplete, starting over.'.format(outputPath))
+            return None
+
+    if storePath != None and not storeHasCohort(storePath, cohortName):
+        print('{0} has no data of {1}, starting over.'.format(storePath, cohortName))
+        return None
+
+    return streamState
+
+
+def incrementalCohort(inputPath, cohortName, customStart, customEnd, customGrpByHr,
+    chunkSize, outputFormat='csv', artifacts=None, plotWorkers=1, deferPlots=False,
+    profiler=None, writeWorkers=0, durable=False, compress=None, compressLevel=None,
+    bouts=None, lights=None, storePath=None, plotPoints=DEFAULT_PLOT_POINTS,
+    sessionLayout='animal', synchrony=False):
+    """Incremental version of streamCohort() for recordings that keep growing.
+    The streaming state (where reading stopped, each animal's open phase and 
+    the partial bins) is saved to <cohort_name>_state.pkl in the cohort folder.
+    The next run seeks past the rows already processed, appends the new rows
+    to the minute level tables and rebuilds the bins, sessions and plots, so
+    the work scales with the new data instead of the whole recording."""
+    newDirPath = makeCohortDir(cohortName)
+    store = initStore(storePath) if storePath != None else None
+    tableWriter = initTableWriter(newDirPath, cohortName, outputFormat, artifacts,
+                                  plotWorkers, deferPlots, profiler, writeWorkers, durable,
+                                  compress, compressLevel, store, plotPoints, sessionLayout)
+    statePath = os.path.join(newDirPath, cohortName + '_state.pkl')
+
+    layout = readInputLayout(inputPath)
+    headerIndex = buildHeaderIndex([row[1:] for row in layout['headerRows']])
+
+    streamState = loadStreamState(statePath, inputPath, newDirPath, cohortName, 
+                                  customStart, customEnd, customGrpByHr, artifacts, compress,
+                                  bouts, lights, storePath, synchrony)
+    if streamState == None:
+        streamState = initStreamState(newDirPath, cohortName, customStart, customEnd, 
+                                      customGrpByHr, artifacts, compress, compressLevel, bouts,
+                                      lights, synchrony)
+        streamState['storePath'] = storePath
+        offset = layout['headerEnd']
+    else:
+        print('\nResuming from {0}'.format(streamState['carryRow'].index[0]))
+        offset = streamState['offset']
+        if store != None:
+            store['replace'] = False # keep the minutes stored by the earlier runs
+
+        # The last row was written before it could be back filled, drop it
+        # from the tables so it can be processed again with the new rows
+        for name, size in streamState['csvSizes'].items():
+            os.truncate(streamState['paths'][name], size)
+    streamState['store'] = store
+
+    endOffset = os.path.getsize(inputPath)
+    print('Reading {0} new bytes in chunks of {1} rows...'.format(endOffset - offset, chunkSize))
+
+    with profileStage(profiler, 'streamChunks'):
+        for rawChunk, offset in readVitalViewRange(inputPath, headerIndex, offset, endOffset,
+                                                   chunkSize, layout['sep'], layout['dateFields']):
+            streamRawChunk(streamState, rawChunk)
+
+    if streamState['carryRow'] is None:
+        print("No data rows found in {0}".format(inputPath))
+        sys.exit(1)
+
+    # Save before the held back last row is processed, so the next run can
+    # back fill it from the rows appended after it
+    saveStreamState(statePath, streamState, inputPath, offset)
+    with profileStage(profiler, 'finishStream'):
+        finishStream(streamState, tableWriter)
+
+
+################################################################################
+### Section below contains functions for following a growing file (follow)   ###
+################################################################################
+
+def initFollowState(colList):
+    """Per animal state of the online session finder: the phase each animal
+    is in, when it started, its length and distance so far, the run phase of
+    the open session and the last hour of distances (a ring of 60 minutes).
+    Everything is one array per field, so memory doesn't grow with time."""
+    nCols = len(colList)
+    followState = {'animals':list(colList), 'lastTime':None, 'pendingRow':None,
+                   'running':np.zeros(nCols, dtype=bool),
+                   'phaseStart':np.zeros(nCols, dtype=np.int64),
+                   'phaseMins':np.zeros(nCols, dtype=np.int64),
+                   'phaseDist':np.zeros(nCols),
+                   'session':np.zeros(nCols, dtype=np.int64),
+                   'runObs':np.zeros(nCols, dtype=bool),
+                   'runStart':np.zeros(nCols, dtype=np.int64),
+                   'runEnd':np.zeros(nCols, dtype=np.int64),
+                   'runMins':np.zeros(nCols, dtype=np.int64),
+                   'runDist':np.zeros(nCols),
+                   'hourRing':np.zeros((60, nCols))}
+    return followState
+
+
+def eventTimes(timesNs):
+    """Format int64 nanosecond times the way the csv tables show them"""
+    timeStrings = np.datetime_as_string(np.asarray(timesNs).astype('datetime64[ns]'), unit='s')
+    return np.char.replace(timeStrings, 'T', ' ').tolist()
+
+
+def sessionEvents(followState, event, timeNs, positions, hourDist):
+    """JSON ready session_open or session_close events of the animals in
+    columns positions, all at the time timeNs"""
+    animals = followState['animals']
+    timeString = eventTimes(timeNs)
+    records = [{'event':event, 'time':timeString, 'animal':animals[pos][0],
+                'group':animals[pos][1], 'session':int(followState['session'][pos]),
+                'last_hour_dist(m)':round(float(hourDist[pos]), 6)} for pos in positions]
+    if event == 'session_open':
+        return records
+
+    runObs = followState['runObs'][positions]
+    runTimes = eventTimes(np.concatenate((followState['runStart'][positions],
+                                          followState['runEnd'][positions])))
+    restStarts = eventTimes(followState['phaseStart'][positions])
+    for i, pos in enumerate(positions):
+        if runObs[i]:
+            records[i].update({'run_start':runTimes[i], 'run_end':runTimes[i + len(positions)],
+                               'run_mins':int(followState['runMins'][pos]),
+                               'run_dist(m)':float(followState['runDist'][pos])})
+        else:
+            records[i].update({'run_start':None, 'run_end':None, 'run_mins':None,
+                               'run_dist(m)':None})
+        records[i].update({'rest_start':restStarts[i], 'rest_end':timeString,
+                           'rest_mins':int(followState['phaseMins'][pos])})
+
+    return records
+
+
+def clearRing(ring, firstMinute, lastMinute):
+    """Zero the hour ring slots of minutes firstMinute to lastMinute"""
+    if lastMinute - firstMinute >= 59:
+        ring[:] = 0
+    elif lastMinute >= firstMinute:
+        ring[np.arange(firstMinute, lastMinute + 1) % 60] = 0
+
+
+def followMinute(followState, timeNs, distance, emit):
+    """Feed one minute of (back filled) distance data for all animals through
+    the same run/rest phases as calcSessions(). A session opens when a run
+    starts (or on the first row) and closes when the rest after it ends. The
+    rest phase ends on the first minute of the next run, same as the end
+    times calcSessions() gives."""
+    with np.errstate(invalid='ignore'):
+        running = distance > 0 # missing values count as rest
+    distance = np.where(running, distance, 0.0)
+
+    # Minutes are numbered from the epoch, minute % 60 is the ring slot
+    lastTime = followState['lastTime']
+    ring = followState['hourRing']
+    minute = timeNs // MINUTE_NS
+    lastMinute = minute - 1 if lastTime == None else lastTime // MINUTE_NS
+
+    # Totals of the clock hour that ended since the last row
+    hourStart = (lastMinute // 60 + 1) * 60
+    if lastTime != None and minute >= hourStart:
+        clearRing(ring, lastMinute + 1, hourStart - 1)
+        emit({'event':'hour', 'time':eventTimes(hourStart * MINUTE_NS),
+              'last_hour_dist(m)':{animalName[0]:round(float(total), 6) for animalName, total
+                                   in zip(followState['animals'], ring.sum(axis=0))}})
+
+    # Minutes without a row don't count, and this minute replaces the one an hour ago
+    clearRing(ring, lastMinute + 1, minute)
+    ring[minute % 60] = distance
+    hourDist = ring.sum(axis=0)
+
+    if lastTime == None:
+        followState['running'] = running
+        followState['phaseStart'][:] = timeNs
+        for record in sessionEvents(followState, 'session_open', timeNs,
+                                    np.arange(len(running)), hourDist):
+            emit(record)
+
+    else:
+        flips = running != followState['running']
+        runEnded = np.flatnonzero(flips & followState['running'])
+        restEnded = np.flatnonzero(flips & ~followState['running'])
+
+        followState['runObs'][runEnded] = True
+        followState['runStart'][runEnded] = followState['phaseStart'][runEnded]
+        followState['runEnd'][runEnded] = timeNs
+        followState['runMins'][runEnded] = followState['phaseMins'][runEnded]
+        followState['runDist'][runEnded] = followState['phaseDist'][runEnded]
+
+        if len(restEnded) > 0:
+            for record in sessionEvents(followState, 'session_close', timeNs, restEnded, hourDist):
+                emit(record)
+            followState['session'][restEnded] += 1
+            followState['runObs'][restEnded] = False
+            for record in sessionEvents(followState, 'session_open', timeNs, restEnded, hourDist):
+                emit(record)
+
+        followState['running'] = running
+        followState['phaseStart'][flips] = timeNs
+        followState['phaseMins'][flips] = 0
+        followState['phaseDist'][flips] = 0
+
+    followState['phaseMins'] += 1
+    followState['phaseDist'] += distance
+    followState['lastTime'] = timeNs
+
+
+def followRows(followState, rawChunk, emit):
+    """Feed new rows of raw turns data to followMinute() one at a time. A row
+    with missing values waits for the next row to back fill it, like fillNa(),
+    every other row is handled as soon as it is read. Rows that aren't later
+    than the last one are skipped."""
+    times = rawChunk.index.values.astype('datetime64[ns]').astype(np.int64)
+    turns = rawChunk.values.astype(float)
+
+    for timeNs, row in zip(times, turns):
+        lastTime = followState['lastTime']
+        pendingRow = followState['pendingRow']
+        if pendingRow != None:
+            lastTime = pendingRow[0]
+        if lastTime != None and timeNs <= lastTime:
+            print('Warning: skipping row {0}, not after {1}'.format(*eventTimes([timeNs, lastTime])),
+                  file=sys.stderr)
+            continue
+
+        if pendingRow != None:
+            pendingTime, pendingTurns = pendingRow
+            pendingTurns = np.where(np.isnan(pendingTurns), row, pendingTurns)
+            followMinute(followState, pendingTime, pendingTurns * 0.361, emit)
+            followState['pendingRow'] = None
+
+        if np.isnan(row).any():
+            followState['pendingRow'] = (timeNs, row)
+        else:
+            followMinute(followState, timeNs, row * 0.361, emit)
+
+
+def followFile(inputPath, eventsFile, interval=FOLLOW_INTERVAL, once=False):
+    """Tail a VitalView csv that is still being recorded and write a JSON
+    line to eventsFile for every session that opens or closes, and for every
+    clock hour with each animal's distance. Only whole rows are read, a row
+    the recorder is still writing waits for the next check. Runs until
+    interrupted, or until the end of the file with once=True. If the file
+    shrinks (a new recording) it starts over."""
+    layout = readInputLayout(inputPath)
+    headerIndex = buildHeaderIndex([row[1:] for row in layout['headerRows']])
+    numCols = len(headerIndex) + 1
+
+    def emit(record):
+        eventsFile.write(json.dumps(record) + '\n')
+
+    followState = initFollowState(headerIndex)
+    offset = layout['headerEnd']
+    pending = b''
+
+    while True:
+        if os.path.getsize(inputPath) < offset:
+            print('{0} got shorter, starting over.'.format(inputPath), file=sys.stderr)
+            followState = initFollowState(headerIndex)
+            layout = readInputLayout(inputPath)
+            offset = layout['headerEnd']
+            pending = b''
+
+        with open(inputPath, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        offset += len(data)
+        pending += data
+
+        cut = pending.rfind(b'\n') + 1
+        block, pending = pending[:cut], pending[cut:]
+        if len(block.strip()) > 0:
+            rawChunk = readVitalViewBody(io.BytesIO(block), numCols, 0, sep=layout['sep'],
+                                         dateFields=layout['dateFields'])
+            rawChunk.columns = headerIndex
+            followRows(followState, convertDatetime(rawChunk), emit)
+            eventsFile.flush()
+
+        if once:
+            return followState
+
+        time.sleep(interval)
+
+
+################################################################################
+### Section below contains functions for caching parsed input files          ###
+################################################################################
+
+def fileContentHash(inputPath):
+    """sha1 of the whole file, used as the cache key"""
+    fileHash = hashlib.sha1()
+    with open(inputPath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            fileHash.update(block)
+
+    return fileHash.hexdigest()
+
+
+def saveCacheEntry(rawDf, entryDir):
+    """Store a parsed raw turns dataframe as .npy files: the turns matrix,
+    the timestamps (int64 nanoseconds) and the three header levels. Written
+    to a temporary folder first so a half written entry is never used."""
+    tmpDir = '{0}.{1}.tmp'.format(entryDir, os.getpid())
+    os.makedirs(tmpDir)
+
+    np.save(os.path.join(tmpDir, 'turns.npy'), np.ascontiguousarray(rawDf.values))
+    np.save(os.path.join(tmpDir, 'times.npy'), rawDf.index.values.astype(np.int64))
+    np.save(os.path.join(tmpDir, 'header.npy'),
+            np.array([rawDf.columns.get_level_values(i) for i in range(3)], dtype=str))
+
+    try:
+        os.rename(tmpDir, entryDir)
+    except OSError: # Another process cached the same file first
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def loadCacheEntry(entryDir):
+    """Map a cached raw turns dataframe back in. The turns matrix is memory
+    mapped (read only) rather than read into memory."""
+    turns = np.load(os.path.join(entryDir, 'turns.npy'), mmap_mode='r')
+    times = np.load(os.path.join(entryDir, 'times.npy'))
+    header = np.load(os.path.join(entryDir, 'header.npy'))
+
+    headerIndex = pd.MultiIndex.from_arrays([list(level) for level in header],
+                                            names=['sample', 'group', 'sensor'])
+    rawDf = DataFrame(turns, index=pd.to_datetime(times), columns=headerIndex, copy=False)
+
+    return rawDf
+
+
+def cacheEntrySize(entryDir):
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.join(entryDir, '*')))
+
+
+def evictCache(cacheDir, cacheSize, keep=None):
+    """Delete the least recently used entries until the cache is no bigger
+    than cacheSize MB. The keep entry (the one just used) is never deleted."""
+    entries = [path for path in glob.glob(os.path.join(cacheDir, '*'))
+               if os.path.isdir(path) and not path.endswith('.tmp')]
+    entries.sort(key=os.path.getmtime)
+    totalSize = sum(cacheEntrySize(path) for path in entries)
+
+    for entryDir in entries:
+        if totalSize <= cacheSize * 1024**2:
+            break
+        if entryDir == keep:
+            continue
+        totalSize -= cacheEntrySize(entryDir)
+        shutil.rmtree(entryDir, ignore_errors=True)
+
+
+def readVitalViewCached(inputPath, cacheDir, cacheSize=DEFAULT_CACHE_SIZE, refresh=False):
+    """readVitalViewCsv() through an on-disk cache of parsed files in cacheDir,
+    keyed by the file contents and CACHE_VERSION. Files seen before are memory
+    mapped instead of parsed again. refresh throws away the cached copy of
+    this file first. Entries of older versions are never used, they age out
+    of the cache."""
+    entryName = '{0}-v{1}'.format(fileContentHash(inputPath), CACHE_VERSION)
+    entryDir = os.path.join(cacheDir, entryName)
+
+    if refresh:
+        shutil.rmtree(entryDir, ignore_errors=True)
+
+    if os.path.isdir(entryDir):
+        try:
+            rawDf = loadCacheEntry(entryDir)
+            os.utime(entryDir) # Mark as recently used
+            print('\nUsing cached copy of {0}'.format(inputPath))
+            return rawDf
+        except (OSError, ValueError):
+            print('\nWarning: cached copy of {0} is unreadable, parsing it again'.format(inputPath))
+            shutil.rmtree(entryDir, ignore_errors=True)
+
+    rawDf = readVitalViewCsv(inputPath)
+
+    os.makedirs(cacheDir, exist_ok=True)
+    saveCacheEntry(rawDf, entryDir)
+    evictCache(cacheDir, cacheSize, keep=entryDir)
+
+    return rawDf
+
+
+################################################################################
+### Section below contains functions for the SQLite store (--store)          ###
+################################################################################
+
+def openStore(storePath):
+    """Open the SQLite store, creating the file and its tables if needed.
+    Minute, bin and session rows are keyed by animal and time, animals are
+    indexed by cohort, group and sample. Several processes (e.g. batch mode)
+    can write to it, each waits its turn for up to STORE_TIMEOUT seconds."""
+    conn = sqlite3.connect(storePath, timeout=STORE_TIMEOUT)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(STORE_SCHEMA)
+    return conn
+
+
+def openStoreReadOnly(storePath):
+    """Open the SQLite store for reading only. The path is turned into a file
+    URI so names with spaces, '?', '#' or '%' open the right file."""
+    uri = pathlib.Path(storePath).resolve().as_uri() + '?mode=ro'
+    return sqlite3.connect(uri, uri=True, timeout=STORE_TIMEOUT)
+
+
+def initStore(storePath, replace=True):
+    """Settings for the store functions. The database is opened on first use.
+    With replace=True everything stored for the cohort before is deleted
+    first, an incremental run that resumes only adds to it."""
+    return {'path':storePath, 'conn':None, 'cohortId':None, 'animalIds':None,
+            'replace':replace}
+
+
+def storeTimes(times):
+    """Timestamps as the 'YYYY-MM-DD HH:MM:SS' text the store keeps, which
+    sorts in time order and works with SQLite's date functions"""
+    times = np.asarray(times).astype('datetime64[s]')
+    return np.char.replace(np.datetime_as_string(times), 'T', ' ')
+
+
+def storeCohort(store, cohortName, colList):
+    """Used by the other store functions on first use. Open the database and
+    add the cohort and its animals (one per column), deleting what was stored
+    for the cohort before unless store['replace'] is False"""
+    conn = openStore(store['path'])
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO cohorts (cohort) VALUES (?)', (cohortName,))
+        conn.execute('UPDATE cohorts SET stored_at = ? WHERE cohort = ?',
+                     (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), cohortName))
+        cohortId = conn.execute('SELECT cohort_id FROM cohorts WHERE cohort = ?',
+                                (cohortName,)).fetchone()[0]
+
+        if store['replace']:
+            for table in ['minutes', 'bins', 'sessions']:
+                conn.execute('DELETE FROM {0} WHERE animal_id IN (SELECT animal_id FROM animals '
+                             'WHERE cohort_id = ?)'.format(table), (cohortId,))
+            conn.execute('DELETE FROM animals WHERE cohort_id = ?', (cohortId,))
+
+        conn.executemany('INSERT OR IGNORE INTO animals (cohort_id, sample, group_name, sensor, '
+                         'position) VALUES (?, ?, ?, ?, ?)',
+                         [(cohortId,) + tuple(col) + (pos,) for pos, col in enumerate(colList)])
+        animalIds = conn.execute('SELECT animal_id FROM animals WHERE cohort_id = ? ORDER BY position',
+                                 (cohortId,)).fetchall()
+
+    store.update(conn=conn, cohortId=cohortId, animalIds=np.array([row[0] for row in animalIds]))
+
+
+def storeMinutes(store, cohortName, formattedDistanceDf):
+    """Bulk insert a block of minute distances, one row per animal and minute,
+    in a single transaction. A minute that is already stored (the back filled
+    last row of an incremental run) is replaced."""
+    if store['conn'] == None:
+        storeCohort(store, cohortName, formattedDistanceDf.columns)
+
+    # One animal after another, in the order of the key, so rows are appended.
+    # Rows are handed over STORE_CHUNK_ROWS at a time to keep memory flat
+    times = storeTimes(formattedDistanceDf.index.values)
+    values = formattedDistanceDf.values
+
+    with store['conn']:
+        for col, animalId in enumerate(store['animalIds'].tolist()):
+            for start in range(0, len(times), STORE_CHUNK_ROWS):
+                end = start + STORE_CHUNK_ROWS
+                rows = zip([animalId] * len(times[start:end]), times[start:end].tolist(),
+                           values[start:end, col].astype(float).tolist()) # NaN is stored as NULL
+                store['conn'].executemany('INSERT OR REPLACE INTO minutes VALUES (?, ?, ?)', rows)
+
+
+def storeResults(store, cohortName, hourlyDf, dailyDf, customDfList, sessionTable):
+    """Replace the cohort's bins and sessions in the store, in a single
+    transaction. Bins are stored with rule 'hour', 'day' or '<X>H', sessions
+    are numbered from 1 the way the reformatted session tables are."""
+    if store['conn'] == None:
+        storeCohort(store, cohortName, sessionTable['animals'])
+    conn = store['conn']
+    animalIds = store['animalIds']
+
+    binnedDfs = [('hour', hourlyDf), ('day', dailyDf)]
+    if customDfList != None:
+        binnedDfs += [(rule, customDf) for dfDict in customDfList
+                      for rule, customDf in dfDict.items()]
+
+    sessionValues = {'session':sessionTable['session'] + 1,
+                     'run_dist':sessionTable['run_dist(m)'], 'velocity':calcVelocity(sessionTable)}
+    for name in STORE_COLUMNS['sessions'][1:]:
+        isObs = sessionTable[name.split('_')[0] + '_obs'] if name != 'velocity' else True
+        values = sessionValues.get(name, sessionTable.get(name))
+        if name.endswith(('start', 'end')):
+            values = storeTimes(values.astype('datetime64[ns]'))
+        sessionValues[name] = np.where(isObs, values.astype(object), None)
+
+    with conn:
+        for table in ['bins', 'sessions']:
+            conn.execute('DELETE FROM {0} WHERE animal_id IN (SELECT animal_id FROM animals '
+                         'WHERE cohort_id = ?)'.format(table), (store['cohortId'],))
+
+        for rule, binnedDf in binnedDfs:
+            numRows, numCols = binnedDf.shape
+            conn.executemany('INSERT INTO bins VALUES (?, ?, ?, ?)',
+                             zip(np.repeat(animalIds, numRows).tolist(), [rule] * (numRows * numCols),
+                                 np.tile(storeTimes(binnedDf.index.values), numCols).tolist(),
+                                 binnedDf.values.astype(float).T.ravel().tolist()))
+
+        conn.executemany('INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         zip(animalIds[sessionTable['animal']].tolist(),
+                             *[sessionValues[name].tolist() for name in STORE_COLUMNS['sessions']]))
+
+
+def closeStore(store):
+    """Close the store's database, if it was opened"""
+    if store['conn'] != None:
+        store['conn'].close()
+        store['conn'] = None
+        print('Stored in {0}'.format(store['path']))
+
+
+def storeHasCohort(storePath, cohortName):
+    """True if the store exists and holds minute data of the cohort"""
+    if not os.path.exists(storePath):
+        return False
+
+    conn = openStore(storePath)
+    try:
+        row = conn.execute('SELECT 1 FROM minutes JOIN animals USING (animal_id) JOIN cohorts '
+                           'USING (cohort_id) WHERE cohort = ? LIMIT 1', (cohortName,)).fetchone()
+    finally:
+        conn.close()
+
+    return row != None
+
+
+def queryStore(storePath, table='bins', cohort=None, group=None, sample=None, rule=None,
+    start=None, end=None):
+    """Read rows of one of the store's tables (minutes, bins, sessions or
+    animals) into a dataframe, with the cohort, sample, group and sensor of
+    each animal. Filters on any of cohort, group, sample and bin rule, and
+    on a time range (start and end included, anything pandas can read as a
+    time). Runs as an indexed lookup on the animals and their times."""
+    if not os.path.exists(storePath):
+        print("Can't find the store {0}".format(storePath))
+        sys.exit(1)
+
+    filterError = queryFilterError(table, rule, start, end)
+    if filterError != None:
+        print(filterError)
+        sys.exit(1)
+
+    columns = ['c.cohort', 'a.sample', 'a.group_name', 'a.sensor']
+    if table == 'animals':
+        columns += ['a.' + name for name in STORE_COLUMNS[table]]
+        fromSql = 'animals a JOIN cohorts c ON c.cohort_id = a.cohort_id'
+        order = 'c.cohort, a.position'
+    else:
+        columns += ['t.' + name for name in STORE_COLUMNS[table]]
+        fromSql = ('{0} t JOIN animals a ON a.animal_id = t.animal_id '
+                   'JOIN cohorts c ON c.cohort_id = a.cohort_id'.format(table))
+        order = 'c.cohort, a.position, ' + ('t.session' if table == 'sessions' else 't.time')
+
+    where = []
+    params = []
+    for column, value in [('c.cohort', cohort), ('a.group_name', group), ('a.sample', sample),
+                          ('t.rule', rule)]:
+        if value != None:
+            where.append(column + ' = ?')
+            params.append(value)
+
+    timeColumn = 't.run_start' if table == 'sessions' else 't.time'
+    for operator, value in [('>=', start), ('<=', end)]:
+        if value != None:
+            where.append('{0} {1} ?'.format(timeColumn, operator))
+            params.append(pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S'))
+
+    sql = 'SELECT {0} FROM {1}'.format(', '.join(columns), fromSql)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY ' + order
+
+    conn = openStoreReadOnly(storePath)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def queryFilterError(table, rule=None, start=None, end=None):
+    """Used in parseQueryInput() and queryStore(). What is wrong with the
+    filters for this table, None if nothing is"""
+    if table not in STORE_COLUMNS:
+        return "Unknown table '{0}', pick one of {1}".format(table, ', '.join(STORE_COLUMNS))
+    if rule != None and table != 'bins':
+        return '--rule only applies to the bins table'
+    if table == 'animals' and (start != None or end != None):
+        return "--start and --end don't apply to the animals table"
+
+    for option, value in [('--start', start), ('--end', end)]:
+        if value != None:
+            try:
+                pd.Timestamp(value)
+            except ValueError:
+                return "{0} '{1}' isn't a date or time".format(option, value)
+
+    return None
+
+
+def queryMain(query_args):
+    """Run the query subcommand, write the rows as csv"""
+    if query_args.sql != None:
+        if not os.path.exists(query_args.store):
+            print("Can't find the store {0}".format(query_args.store))
+            sys.exit(1)
+        conn = openStoreReadOnly(query_args.store)
+        try:
+            resultDf = pd.read_sql_query(query_args.sql, conn)
+        except (sqlite3.Error, pd.errors.DatabaseError) as error:
+            print('Query failed: {0}'.format(error))
+            sys.exit(1)
+        finally:
+            conn.close()
+    else:
+        resultDf = queryStore(query_args.store, query_args.table, query_args.cohort,
+                              query_args.group, query_args.sample, query_args.rule,
+                              query_args.start, query_args.end)
+
+    if query_args.output != None:
+        resultDf.to_csv(query_args.output, index=False)
+        print('{0} rows written to {1}'.format(len(resultDf), query_args.output))
+    else:
+        resultDf.to_csv(sys.stdout, index=False)
+
+
+################################################################################
+### Section below contains functions for profiling a run (--profile)         ###
+################################################################################
+
+def procResidentBytes():
+    """Resident memory of this process in bytes from /proc (Linux)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def residentMemoryReader():
+    """Function that returns the resident memory of this process in bytes,
+    using psutil if it is installed or /proc on Linux. None if neither is
+    available."""
+    try:
+        import psutil
+        process = psutil.Process()
+        return lambda: process.memory_info().rss
+    except ImportError:
+        pass
+
+    if os.path.exists('/proc/self/statm'):
+        return procResidentBytes
+    return None
+
+
+def sampleMemory(profiler):
+    """Runs in a background thread while profiling. Raises the peak of every
+    stage that is running to the current resident memory."""
+    while not profiler['stopSampling'].is_set():
+        residentBytes = profiler['readMemory']()
+        with profiler['lock']:
+            frames = list(profiler['stack'])
+        for frame in frames:
+            frame['peak'] = max(frame['peak'], residentBytes)
+        profiler['stopSampling'].wait(MEMORY_SAMPLE_SECONDS)
+
+
+def initProfiler(cProfileStage=None):
+    """Start recording how long each stage and output file takes and the
+    peak resident memory while it runs. Memory is sampled from a background
+    thread, so the run isn't slowed down. cProfileStage is the name of a 
+    stage to also run under cProfile."""
+    profiler = {'stages':[], 'files':[], 'stack':[], 'cProfileStage':cProfileStage,
+                'cProfile':None, 'wall':time.perf_counter(), 'cpu':time.process_time(),
+                'readMemory':residentMemoryReader(), 'stopSampling':threading.Event(),
+                'lock':threading.Lock()}
+
+    if profiler['readMemory'] != None:
+        sampler = threading.Thread(target=sampleMemory, args=(profiler,), daemon=True)
+        sampler.start()
+        profiler['sampler'] = sampler
+    else:
+        print('\nWarning: install psutil to record memory use when profiling')
+
+    return profiler
+
+
+@contextlib.contextmanager
+def profileStage(profiler, name, kind='stages'):
+    """Record the wall time, CPU time and peak resident memory of the with 
+    block in profiler[kind] ('stages' or 'files'). Stages can be nested, and
+    files can be written from the --writeWorkers threads, their CPU time is
+    then that of the whole process. Does nothing if profiler is None. Yields
+    the record so the caller can add to it (e.g. the file size)."""
+    entry = {'name':name}
+    if profiler == None:
+        yield entry
+        return
+
+    readMemory = profiler['readMemory']
+    startMemory = readMemory() if readMemory != None else 0
+    frame = {'peak':startMemory}
+    with profiler['lock']:
+        profiler['stack'].append(frame)
+        profiler[kind].append(entry)
+
+    isProfiled = name == profiler['cProfileStage']
+    if isProfiled:
+        profiler['cProfile'] = cProfile.Profile()
+        profiler['cProfile'].enable()
+
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        yield entry
+    finally:
+        entry['wall'] = time.perf_counter() - wallStart
+        entry['cpu'] = time.process_time() - cpuStart
+        if isProfiled:
+            profiler['cProfile'].disable()
+
+        with profiler['lock']: # Other threads may have added frames since
+            stack = profiler['stack']
+            del stack[next(pos for pos in range(len(stack)) if stack[pos] is frame)]
+        entry['peakMB'] = None
+        entry['growthMB'] = None
+        if readMemory != None:
+            endMemory = readMemory()
+            entry['peakMB'] = max(frame['peak'], endMemory) / 1024**2
+            entry['growthMB'] = (endMemory - startMemory) / 1024**2
+
+
+def maxResidentMB():
+    """Largest resident set size of this process so far, None where the
+    resource module isn't available (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes on macOS, kB elsewhere
+        return maxRss / 1024**2
+    return maxRss / 1024
+
+
+def printProfileSummary(report):
+    """Print the stage and file timings of a profile report as a table"""
+    print('\n{0:<50}{1:>10}{2:>10}{3:>11}'.format('Stage / file', 'wall (s)', 'cpu (s)', 'peak (MB)'))
+    for kind in ['stages', 'files']:
+        for entry in report[kind]:
+            peak = '-' if entry['peakMB'] == None else '{0:.1f}'.format(entry['peakMB'])
+            print('{0:<50}{1:>10.3f}{2:>10.3f}{3:>11}'.format(entry['name'][-50:],
+                  entry['wall'], entry['cpu'], peak))
+    print('{0:<50}{1:>10.3f}{2:>10.3f}'.format('Total', report['wall'], report['cpu']))
+    if report['maxResidentMB'] != None:
+        print('Largest resident memory: {0:.1f} MB'.format(report['maxResidentMB']))
+
+
+def writeProfileReport(profiler, newDirPath, cohortName, completed=True):
+    """Stop profiling, print the summary table and write it to
+    <cohort_name>_profile.json in the cohort folder, along with the cProfile
+    dump <cohort_name>_<stage>.prof if a stage was picked for it. completed
+    is False for a run that stopped on an error, its stages are the ones
+    that ran up to that point."""
+    report = {'cohortName':cohortName, 'completed':completed,
+              'wall':time.perf_counter() - profiler['wall'],
+              'cpu':time.process_time() - profiler['cpu'], 'maxResidentMB':maxResidentMB(),
+              'stages':profiler['stages'], 'files':profiler['files'], 'cProfile':None}
+    profiler['stopSampling'].set()
+
+    if profiler['cProfile'] != None:
+        profilePath = os.path.join(newDirPath, '{0}_{1}.prof'.format(cohortName, profiler['cProfileStage']))
+        profiler['cProfile'].dump_stats(profilePath)
+        report['cProfile'] = profilePath
+    elif profiler['cProfileStage'] != None:
+        print("\nWarning: stage '{0}' didn't run, no cProfile dump saved".format(profiler['cProfileStage']))
+
+    if not completed:
+        print('\nThe run stopped on an error, profile of the stages up to that point:')
+    printProfileSummary(report)
+
+    reportPath = os.path.join(newDirPath, cohortName + '_profile.json')
+    with open(reportPath, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Profile written to {0}'.format(reportPath))
+    if report['cProfile'] != None:
+        print('cProfile dump written to {0}'.format(report['cProfile']))
+
+
+###########################################################
+### Section below contains functions for plotting data  ###
+###########################################################
+
+def chunkLists(userList, chunkSize):
+    """Use to split lists of columns into chunks of sublists for graphing"""
+    chunkList = []
+
+    # x goes from start of list to end in groups of chunkSize
+    for x in range(0, len(userList), chunkSize):
+        # Eg. If chunkSize = 6:
+        # first loop: start = 0 and end = 6
+        # second loop: start = 6 and end = 12
+        # third loop: start = 12 end = 18 etc.
+        chunk=userList[x:x+chunkSize]
+        chunkList.append(chunk)
+    return chunkList
+
+def listPlotPages(hourlyDf, lights=None, synchrony=None):
+    """List the pages of the graphs pdf in order as (kind, plot number, 
+    number of plots of that kind, columns of hourlyDf on the page). The 24
+    hour profile page, only there with a light schedule, holds the lights on
+    and off minutes instead of columns, the synchrony heatmap page the
+    minute correlation and bout overlap tables."""
+    pages = [('daily', 1, 1, None), ('percent', 1, 1, None)]
+    if lights != None:
+        pages.append(('circadian', 1, 1, lights))
+    if synchrony != None:
+        pages.append(('synchrony', 1, 1, (synchrony['minuteCorr'], synchrony['overlap'])))
+
+    # Cumsum plots hold 6 animals per page, histograms 3
+    chunks = chunkLists(hourlyDf.columns, 6)
+    for i, c in enumerate(chunks):
+        pages.append(('cumsum', i+1, len(chunks), c))
+
+    chunks2 = chunkLists(hourlyDf.columns, 3)
+    for i, c in enumerate(chunks2):
+        pages.append(('hist', i+1, len(chunks2), c))
+
+    return pages
+
+
+def decimateMinMax(df, maxPoints):
+    """Shape preserving downsampling for line plots. Splits the rows of df
+    into maxPoints // 2 buckets of equal length and keeps the smallest and
+    largest value of each column in each bucket, in time order, so peaks
+    survive however long the recording is. Returns one Series per column,
+    each with its own index of at most maxPoints times."""
+    values = df.values.astype(float)
+    numRows, numCols = values.shape
+    bucketSize = -(-numRows // max(maxPoints // 2, 1))
+    numBuckets = -(-numRows // bucketSize)
+
+    # Only the last bucket is padded. Padding and missing values are never
+    # picked, unless a bucket holds nothing else.
+    padded = np.full((numBuckets * bucketSize, numCols), np.nan)
+    padded[:numRows] = values
+    padded = padded.reshape(numBuckets, bucketSize, numCols)
+    isNull = np.isnan(padded)
+    lowPos = np.where(isNull, np.inf, padded).argmin(axis=1)
+    highPos = np.where(isNull, -np.inf, padded).argmax(axis=1)
+
+    keepPos = np.stack([np.minimum(lowPos, highPos), np.maximum(lowPos, highPos)], axis=1)
+    keepPos = keepPos + (np.arange(numBuckets) * bucketSize)[:, None, None]
+    keepPos = keepPos.reshape(2 * numBuckets, numCols)
+
+    seriesList = []
+    for pos in range(numCols):
+        rows = np.unique(keepPos[:, pos])
+        seriesList.append(Series(values[rows, pos], index=df.index[rows], name=df.columns[pos]))
+
+    return seriesList
+
+
+def plotLines(df, plotPoints, figsize, linewidth, alpha):
+    """Line plot of each column of df, like df.plot(). If df has more than
+    plotPoints rows the lines are drawn from decimateMinMax() instead, so the
+    page's file size and drawing time stay the same however long the
+    recording is. Returns the axes."""
+    if plotPoints <= 0 or len(df) <= plotPoints:
+        return df.plot(figsize=figsize, linewidth=linewidth, alpha=alpha)
+
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    fig, ax = plt.subplots(figsize=figsize)
+    for series in decimateMinMax(df, plotPoints):
+        label = series.name
+        if isinstance(label, tuple):
+            label = '({0})'.format(', '.join(str(x) for x in label))
+        ax.plot(series.index, series.values, label=label, linewidth=linewidth, alpha=alpha)
+    ax.margins(x=0)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
+
+    return ax
+
+
+def drawPage(page, percentRunRestDf, hourlyDf, dailyDf, cohortName, profileDf=None,
+    plotPoints=DEFAULT_PLOT_POINTS):
+    """Draw one page of the graphs pdf and return its figure. Only the data
+    the page needs has to be given, the others can be None. The hourly lines
+    are cut down to at most plotPoints points each (0 for all of them)."""
+    import matplotlib.pyplot as plt
+    kind, plotNum, numPlots, cols = page
+
+    if kind == 'daily':
+        # Barplot of daily distance sums
+        b = dailyDf.plot(kind='bar',figsize=(10,5), width=0.75, alpha=.75) #color=['#FFAAAA','#D46A6A','#801515','#550000'])
+        b.set_title('{0}: Total Running Distance By Day'.format(cohortName), y=1.08)
+        b.set_ylabel('Distance in meters')
+        b.set_xlabel('Animal & Condition')
+        b.legend(bbox_to_anchor=(1.12, 0.6),prop={'size':6})
+        return b.get_figure()
+
+    elif kind == 'percent':
+        # Stacked Barplot of % rest and run
+        fig = plt.figure(figsize=(10,5))
+        pnames = percentRunRestDf.animal
+        pruns = percentRunRestDf.percent_mins_run
+        prests = percentRunRestDf.percent_mins_rest
+        px = range(len(pnames)) # xaxis must be numbers, we can change to names with xticks
+        width =0.50 # of bars, must be a fraction
+        b1 = plt.bar(px, pruns, width, color='black')
+        b2 = plt.bar(px, prests, width, color='lightgrey',bottom=pruns)
+        # xticks takes original xaxis (px), and replacement (pnames)
+        plt.xticks(px, pnames, size='small', rotation=90, horizontalalignment='left')
+        plt.title('Percent Run and Percent Rest Per Animal', y=1.08)
+        plt.legend((b1[0], b2[0]), ('Run', 'Rest'), bbox_to_anchor=(1.15, 1.01),prop={'size':10})
+        plt.ylabel('Percent %')
+        plt.xlabel('Animal & Condition')
+        return fig
+
+    elif kind == 'circadian':
+        # Average 24 hour profile, hours plotted at their middle, dark phase shaded
+        lightsOn, lightsOff = cols
+        hourDf = profileDf.copy()
+        hourDf.index = hourDf.index + 0.5
+        c = hourDf.plot(figsize=(10,5), linewidth=2, alpha=0.70)
+        if lightsOff < lightsOn:
+            darkSpans = [(lightsOff, lightsOn)]
+        else:
+            darkSpans = [(0, lightsOn), (lightsOff, DAY_MINUTES)]
+        for start, end in darkSpans:
+            c.axvspan(start / 60, end / 60, color='grey', alpha=0.25, linewidth=0)
+        c.set_xlim(0, 24)
+        c.set_xticks(range(0, 25, 3))
+        c.set_title('{0}: Average 24 Hour Profile (dark phase shaded)'.format(cohortName), y=1.08)
+        c.set_ylabel('Distance in meters per hour')
+        c.set_xlabel('Hour of the day')
+        c.legend(bbox_to_anchor=(1.12, 0.6),prop={'size':6})
+        return c.get_figure()
+
+    elif kind == 'synchrony':
+        # Heatmaps of the minute correlation and bout overlap, animals side by
+        # side by group (in header order) with lines between the groups
+        fig, axes = plt.subplots(1, 2, figsize=(15, 7))
+        for ax, matrixDf, title, vmin, cmap in zip(axes, cols,
+                ['Minute Activity Correlation', 'Run Bout Overlap (Jaccard)'], [-1, 0],
+                ['RdBu_r', 'viridis']):
+            groups = np.array([str(col[1]) if isinstance(col, tuple) else '' for col in matrixDf.columns])
+            order = np.argsort(pd.factorize(groups)[0], kind='stable')
+            image = ax.imshow(matrixDf.values[np.ix_(order, order)], vmin=vmin, vmax=1,
+                              cmap=cmap, interpolation='nearest')
+            fig.colorbar(image, ax=ax, shrink=0.75)
+
+            sortedGroups = groups[order]
+            edges = np.flatnonzero(sortedGroups[1:] != sortedGroups[:-1]) + 0.5
+            for edge in edges:
+                ax.axhline(edge, color='black', linewidth=0.8)
+                ax.axvline(edge, color='black', linewidth=0.8)
+
+            # Sample names fit on small cohorts, otherwise name the groups
+            if len(order) <= 40:
+                ticks, labels = np.arange(len(order)), matrixDf.index[order]
+                rotation, size = 90, 'x-small'
+            else:
+                bounds = np.concatenate(([-0.5], edges, [len(order) - 0.5]))
+                ticks = (bounds[:-1] + bounds[1:]) / 2
+                labels = sortedGroups[np.concatenate(([0], np.ceil(edges).astype(int)))]
+                rotation, size = 0, 'small'
+            ax.set_xticks(ticks)
+            ax.set_xticklabels(labels, rotation=rotation, size=size)
+            ax.set_yticks(ticks)
+            ax.set_yticklabels(labels, size=size)
+            ax.set_title(title)
+        fig.suptitle('{0}: Activity Synchrony Between Animals'.format(cohortName))
+        return fig
+
+    elif kind == 'cumsum':
+        # Cumsum Line plot
+        l = plotLines(hourlyDf[cols].cumsum(), plotPoints, figsize=(7, 7), linewidth=3, alpha=0.70)
+        l.set_title('{0}: Cumilative Sum Plot Binned By Hour (plot {1} of {2})'.format(
+            cohortName, plotNum, numPlots), y=1.08)
+        l.set_ylabel('Distance in meters)')
+        l.set_xlabel('Date & Time')
+        l.legend(bbox_to_anchor=(1.38, 1.01),prop={'size':8})
+        return l.get_figure()
+
+    else:
+        # Distance Histogram - Line plot
+        h = plotLines(hourlyDf[cols], plotPoints, figsize=(15, 3), linewidth=3, alpha=0.65)
+        h.set_title('{0}: Distance Histogram Binned By Hour (plot {1} of {2})'.format(
+            cohortName, plotNum, numPlots), y=1.08)
+        h.set_ylabel('Distance in meters')
+        h.set_xlabel('Date & Time')
+        h.legend(bbox_to_anchor=(1.18, 1.01), prop={'size':8})
+        return h.get_figure()
+
+
+def pageLabel(page):
+    """Short description of a page for the timing report"""
+    kind, plotNum, numPlots, cols = page
+    return '{0} {1}/{2}'.format(kind, plotNum, numPlots)
+
+
+def renderPageToFile(page, percentRunRestDf, hourlyDf, dailyDf, cohortName, pagePath,
+    profileDf=None, plotPoints=DEFAULT_PLOT_POINTS):
+    """Used by plotGraphs() in worker processes. Draws one page with the
+    non-interactive Agg backend into its own single page pdf and returns
+    how long it took."""
+    startTime = time.time()
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+    fig = drawPage(page, percentRunRestDf, hourlyDf, dailyDf, cohortName, profileDf,
+                   plotPoints)
+    fig.savefig(pagePath, format='pdf', bbox_inches='tight')
+    plt.close(fig)
+
+    return time.time() - startTime
+
+
+def renderPagesParallel(pages, percentRunRestDf, hourlyDf, dailyDf, graphsPath, 
+    cohortName, workers, profileDf=None, plotPoints=DEFAULT_PLOT_POINTS):
+    """Render the pages in a process pool, one single page pdf each, then
+    join them (in order) into the final pdf with pypdf. Returns the time each
+    page took, or None if pypdf isn't installed."""
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        print("Rendering pages one at a time, install pypdf to render them in parallel.")
+        return None
+
+    pagePaths = [graphsPath + '.page{0}.tmp'.format(i) for i in range(len(pages))]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for page, pagePath in zip(pages, pagePaths):
+            # Only send each worker the data its page needs
+            kind, plotNum, numPlots, cols = page
+            pageArgs = (page, 
+                        percentRunRestDf if kind == 'percent' else None,
+                        hourlyDf[cols] if kind in ('cumsum', 'hist') else None,
+                        dailyDf if kind == 'daily' else None)
+            futures.append(executor.submit(renderPageToFile, *pageArgs, 
+                                           cohortName=cohortName, pagePath=pagePath,
+                                           profileDf=profileDf if kind == 'circadian' else None,
+                                           plotPoints=plotPoints))
+        pageTimes = [future.result() for future in futures]
+
+    writer = PdfWriter()
+    for pagePath in pagePaths:
+        writer.append(pagePath)
+    with open(graphsPath, 'wb') as f:
+        writer.write(f)
+
+    for pagePath in pagePaths:
+        os.remove(pagePath)
+
+    return pageTimes
+
+
+def plotGraphs(percentRunRestDf, hourlyDf, dailyDf, newDirPath, cohortName, workers=1,
+    circadian=None, plotPoints=DEFAULT_PLOT_POINTS, synchrony=None):
+    """Make some plots. With more than one worker the pages are rendered in
+    parallel processes. Prints how long each page took. The 24 hour profile
+    page is added if circadian (from finishCircadian()) is given, the
+    synchrony heatmaps if synchrony (from finishSynchrony()) is. Lines on
+    the hourly pages get at most plotPoints points (see decimateMinMax())."""
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    graphsPath = os.path.join(newDirPath, cohortName + '_graphs.pdf')
+    lights, profileDf = None, None
+    if circadian != None:
+        lights, profileDf = circadian['lights'], circadian['profile']
+    pages = listPlotPages(hourlyDf, lights, synchrony)
+    startTime = time.time()
+    pageTimes = None
+
+    if workers > 1:
+        pageTimes = renderPagesParallel(pages, percentRunRestDf, hourlyDf, dailyDf, 
+                                        graphsPath, cohortName, workers, profileDf,
+                                        plotPoints)
+
+    if pageTimes == None:
+        pageTimes = []
+        with PdfPages(graphsPath) as pdf:
+            for page in pages:
+                pageStart = time.time()
+                fig = drawPage(page, percentRunRestDf, hourlyDf, dailyDf, cohortName, profileDf,
+                               plotPoints)
+                pdf.savefig(fig, bbox_inches='tight')
+                plt.close(fig)
+                pageTimes.append(time.time() - pageStart)
+
+    for page, pageTime in zip(pages, pageTimes):
+        print('  {0:15} {1:6.2f}s'.format(pageLabel(page), pageTime))
+    print('{0} pages in {1:.2f}s'.format(len(pages), time.time() - startTime))
+
+
+def savePlotData(percentRunRestDf, hourlyDf, dailyDf, newDirPath, cohortName,
+    circadian=None, synchrony=None):
+    """Save what plotGraphs() needs to <cohort_name>_plotdata.npz, so the
+    graphs can be made later with 'sessions.py plot <cohort folder>'"""
+    arrays = {}
+    arrays.update(packTable('hour', hourlyDf))
+    arrays.update(packTable('day', dailyDf))
+    arrays.update(packTable('percent', percentRunRestDf))
+    if circadian != None:
+        arrays.update(packTable('profile', circadian['profile']))
+        arrays.update(packTable('lights', DataFrame({'minute':list(circadian['lights'])},
+                                                    index=['on', 'off'])))
+    if synchrony != None:
+        arrays.update(packTable('minuteCorr', synchrony['minuteCorr']))
+        arrays.update(packTable('overlap', synchrony['overlap']))
+
+    np.savez_compressed(os.path.join(newDirPath, cohortName + '_plotdata.npz'), **arrays)
+
+
+def plotCohortDir(cohortDir, workers=1, plotPoints=DEFAULT_PLOT_POINTS):
+    """Make the graphs pdf from the plot data saved with --deferPlots"""
+    if plotPoints < 0 or plotPoints == 1:
+        print("--plotPoints must be 0 (draw every point) or at least 2.")
+        sys.exit(1)
+    cohortDir = os.path.abspath(cohortDir)
+    cohortName = os.path.basename(cohortDir)
+    plotDataPath = os.path.join(cohortDir, cohortName + '_plotdata.npz')
+    checkInputFile(plotDataPath)
+
+    tablesDict = readOutputArchive(plotDataPath)
+    circadian = None
+    if 'profile' in tablesDict:
+        circadian = {'profile':tablesDict['profile'],
+                     'lights':tuple(int(x) for x in tablesDict['lights']['minute'])}
+    synchrony = None
+    if 'minuteCorr' in tablesDict:
+        synchrony = {'minuteCorr':tablesDict['minuteCorr'], 'overlap':tablesDict['overlap']}
+
+    print('\nMaking plots...')
+    plotGraphs(tablesDict['percent'], tablesDict['hour'], tablesDict['day'], 
+               cohortDir, cohortName, workers, circadian, plotPoints, synchrony)
+
+
+####################################################################################
+### Section below contains functions for file input/output data & sanity checks  ###
+####################################################################################
+
+def checkInputFile(inputFileArg):
+    """Make sure the file exists"""
+    if not os.path.exists(inputFileArg):
+        print("{0} not found. Check path.".format(inputFileArg))
+        sys.exit(1)
+
+def checkHeader(headerLabels):
+    """Function to check the file's header. Takes the labels in the first
+    column of the three header rows."""
+
+    # Compare the labels to HEADER_NAMES. If they don't match, print feedback
+    # and quit program.
+    if list(headerLabels) != HEADER_NAMES:
+        print("ERROR: This file is in the wrong format. ")
+        print("It's missing the proper headers (i.e. Channel Name, Channel Group, Sensor Type)")
+        sys.exit(1) # quit the program
+    else:
+        print('File header checks out.') 
+
+
+def makeCohortDir(cohortName):
+    """Creates a cohort folder in current directory and returns its path"""
+    currWorkingDir = os.getcwd()
+    newDirPath = os.path.join(currWorkingDir, cohortName)
+
+    if not os.path.exists(newDirPath):
+        os.makedirs(newDirPath)
+
+    return newDirPath
+
+
+def checkOutputOptions(outputFormat, artifacts, compress=None, compressLevel=None):
+    """Make sure the output format and artifact names are known, that a
+    parquet engine or compression library is installed if one is needed and
+    that the compression settings apply and are in range"""
+    if outputFormat not in OUTPUT_FORMATS:
+        print("Unknown output format '{0}'. Choose from: {1}".format(
+            outputFormat, ', '.join(OUTPUT_FORMATS)))
+        sys.exit(1)
+
+    if artifacts != None:
+        unknown = [name for name in artifacts if name not in OUTPUT_ARTIFACTS]
+        if len(unknown) > 0:
+            print("Unknown output(s) {0}. Choose from: {1}".format(
+                ', '.join(unknown), ', '.join(OUTPUT_ARTIFACTS)))
+            sys.exit(1)
+
+    if outputFormat == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            try:
+                import fastparquet
+            except ImportError:
+                print("Parquet output needs pyarrow or fastparquet. Install one with:")
+                print("pip install pyarrow")
+                sys.exit(1)
+
+    if compress != None and outputFormat == 'npz':
+        print("--compress doesn't apply to --outputFormat npz, the archive is always compressed.")
+        sys.exit(1)
+
+    if compressLevel != None and compress == None:
+        print("--compressLevel only applies together with --compress.")
+        sys.exit(1)
+
+    if compress != None and outputFormat == 'csv':
+        try:
+            compressionModule(compress)
+        except ImportError:
+            print("{0} compression needs the {1} package. Install it with:".format(
+                compress, {'zstd':'zstandard', 'lz4':'lz4'}[compress]))
+            print("pip install {0}".format({'zstd':'zstandard', 'lz4':'lz4'}[compress]))
+            sys.exit(1)
+
+    if compress != None and compressLevel != None:
+        lowest, highest = COMPRESS_LEVELS[compress][:2]
+        if not lowest <= compressLevel <= highest:
+            print("{0} compression levels go from {1} to {2}.".format(compress, lowest, highest))
+            sys.exit(1)
+
+
+def initTableWriter(newDirPath, cohortName, outputFormat='csv', artifacts=None,
+    plotWorkers=1, deferPlots=False, profiler=None, writeWorkers=0, durable=False,
+    compress=None, compressLevel=None, store=None, plotPoints=DEFAULT_PLOT_POINTS,
+    sessionLayout='animal'):
+    """Settings for writeTable(): where tables go, in which format and which
+    of OUTPUT_ARTIFACTS to write (all of them if artifacts is None). Also
+    holds how many processes render the graphs and the most points per line
+    they draw, or whether to only save the plot data for later, and the
+    profiler (see initProfiler()) if any.
+
+    With writeWorkers > 0 tables are queued to a pool of that many threads
+    and written in the background, at most two per thread wait in the
+    queue. durable=True flushes every file (and the folders) to disk before
+    closeTableWriter() returns. compress is one of COMPRESSIONS (or None) for
+    csv and parquet tables, compressLevel its level (None for the default).
+    The npz archive is always compressed. store (see initStore()) also loads
+    the minute data, bins and sessions into a SQLite database. sessionLayout
+    (one of SESSION_LAYOUTS) picks one sessions table per animal, a single
+    long table or both."""
+    if artifacts == None:
+        artifacts = OUTPUT_ARTIFACTS
+
+    tableWriter = {'dirPath':newDirPath, 'cohortName':cohortName, 
+                   'format':outputFormat, 'artifacts':set(artifacts), 'archive':{},
+                   'plotWorkers':plotWorkers, 'deferPlots':deferPlots,
+                   'profiler':profiler, 'durable':durable, 'pool':None, 'slots':None,
+                   'pending':[], 'errors':[], 'dirs':set(), 'compress':compress,
+                   'compressLevel':compressLevel, 'store':store, 'plotPoints':plotPoints,
+                   'sessionLayout':sessionLayout}
+
+    if writeWorkers > 0:
+        tableWriter['pool'] = ThreadPoolExecutor(max_workers=writeWorkers)
+        tableWriter['slots'] = threading.BoundedSemaphore(2 * writeWorkers)
+
+    return tableWriter
+
+
+def writeTable(tableWriter, artifact, fileName, df, **csvKwargs):
+    """Write one table if its artifact was selected. fileName is relative to
+    the cohort folder, without an extension. csv and parquet tables get a file
+    each. npz tables are collected and saved to <cohort_name>.npz together
+    by closeTableWriter()."""
+    if artifact not in tableWriter['artifacts']:
+        return
+
+    if tableWriter['format'] == 'npz':
+        tableWriter['archive'][fileName] = df
+        return
+
+    outputPath = os.path.join(tableWriter['dirPath'], fileName)
+    if not os.path.exists(os.path.dirname(outputPath)):
+        os.makedirs(os.path.dirname(outputPath))
+    extension = '.' + tableWriter['format']
+    if tableWriter['format'] == 'csv' and tableWriter['compress'] != None:
+        extension += COMPRESSIONS[tableWriter['compress']]
+    fileName += extension
+    outputPath += extension
+    tableWriter['dirs'].add(os.path.dirname(outputPath))
+
+    def saveTable():
+        if tableWriter['format'] == 'csv':
+            # Formatted and compressed CSV_WRITE_ROWS rows at a time
+            with openOutput(outputPath, 'wt', tableWriter['compressLevel']) as f:
+                df.to_csv(f, chunksize=CSV_WRITE_ROWS, **csvKwargs)
+
+        elif tableWriter['format'] == 'parquet':
+            # parquet wants strings in object columns, e.g. the animal tuples
+            parquetDf = df.copy()
+            for col in parquetDf.columns:
+                if parquetDf[col].dtype == object:
+                    parquetDf[col] = parquetDf[col].map(lambda x: None if x is None else str(x))
+            parquetOptions = {}
+            if tableWriter['compress'] != None:
+                parquetOptions['compression'] = tableWriter['compress']
+                if tableWriter['compressLevel'] != None:
+                    parquetOptions['compression_level'] = tableWriter['compressLevel']
+            parquetDf.to_parquet(outputPath, **parquetOptions)
+
+    queueWrite(tableWriter, fileName, outputPath, saveTable)
+
+
+def queueWrite(tableWriter, fileName, outputPath, saveFunc):
+    """Used in writeTable(). Run saveFunc() (which writes outputPath) now, or
+    on the writer threads if there are any. Blocks while the queue is full."""
+    if tableWriter['pool'] == None:
+        writeFile(tableWriter, fileName, outputPath, saveFunc)
+        return
+
+    tableWriter['slots'].acquire()
+    future = tableWriter['pool'].submit(writeFile, tableWriter, fileName, outputPath, saveFunc)
+    future.add_done_callback(lambda future: tableWriter['slots'].release())
+    tableWriter['pending'].append(future)
+
+
+def writeFile(tableWriter, fileName, outputPath, saveFunc):
+    """Write one output file, flush it to disk if the writer is durable. An
+    error is recorded against the file instead of raised, so the other files
+    still get written. closeTableWriter() reports them."""
+    try:
+        with profileStage(tableWriter['profiler'], fileName, 'files') as entry:
+            saveFunc()
+            if tableWriter['durable']:
+                with open(outputPath, 'rb+') as f:
+                    os.fsync(f.fileno())
+        entry['bytes'] = os.path.getsize(outputPath)
+
+    except Exception as e:
+        tableWriter['errors'].append((outputPath, '{0}: {1}'.format(type(e).__name__, e)))
+
+
+def fsyncDir(dirPath):
+    """Flush a folder's entries (new file names) to disk, where the OS
+    allows opening folders (not on Windows)"""
+    try:
+        dirFd = os.open(dirPath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dirFd)
+    except OSError:
+        pass
+    finally:
+        os.close(dirFd)
+
+
+def compressionModule(compress):
+    """Import the module for one of COMPRESSIONS. zstd and lz4 need the
+    optional zstandard and lz4 packages."""
+    if compress == 'gzip':
+        import gzip
+        return gzip
+    elif compress == 'zstd':
+        import zstandard
+        return zstandard
+    else:
+        import lz4.frame
+        return lz4.frame
+
+
+def pathCompression(outputPath):
+    """Compression of an output table going by its file extension, None if
+    it isn't compressed"""
+    for compress, extension in COMPRESSIONS.items():
+        if outputPath.endswith(extension):
+            return compress
+
+    return None
+
+
+def openOutput(outputPath, mode='rt', level=None):
+    """Open an output table as text for reading ('rt'), writing ('wt') or
+    appending ('at'), compressed according to its file extension (see
+    COMPRESSIONS). Data goes through the compressor as it is written, so
+    nothing is held back in memory. level is the compression level for
+    writing, None for the default of COMPRESS_LEVELS."""
+    compress = pathCompression(outputPath)
+    if compress == None:
+        return open(outputPath, mode, newline='')
+
+    if level == None:
+        level = COMPRESS_LEVELS[compress][2]
+    module = compressionModule(compress)
+
+    if compress == 'gzip':
+        return module.open(outputPath, mode, compresslevel=level, newline='')
+    elif compress == 'lz4':
+        return module.open(outputPath, mode, compression_level=level, newline='')
+
+    # zstandard has no open(), wrap its streams. Appending adds a frame.
+    rawFile = open(outputPath, mode[0] + 'b')
+    if mode[0] == 'r':
+        stream = module.ZstdDecompressor().stream_reader(rawFile, read_across_frames=True)
+    else:
+        stream = module.ZstdCompressor(level=level).stream_writer(rawFile)
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def readOutputTable(outputPath):
+    """Load one table written by writeTable() (csv, compressed csv or parquet)
+    into a dataframe. The column levels of the minute level, binned and group
+    tables and the datetime index are restored."""
+    if outputPath.endswith('.parquet'):
+        return pd.read_parquet(outputPath)
+
+    # The csv has one header row per column level, named in its first cell
+    headerRows = 0
+    with openOutput(outputPath) as f:
+        for line in f:
+            if line.split(',', 1)[0] not in OUTPUT_HEADER_LEVELS:
+                break
+            headerRows += 1
+
+    with openOutput(outputPath) as f:
+        if headerRows > 1:
+            df = pd.read_csv(f, header=list(range(headerRows)), index_col=0)
+        else:
+            df = pd.read_csv(f, index_col=0)
+
+    if df.index.dtype == object:
+        try:
+            df.index = pd.to_datetime(df.index, format='%Y-%m-%d %H:%M:%S')
+        except (ValueError, TypeError):
+            pass
+
+    return df
+
+
+def readOutputTables(cohortDir):
+    """Load every table in a cohort folder, whatever --outputFormat and
+    --compress were. Returns a dictionary with the file name relative to the
+    cohort folder (without the extension) as key and the dataframe as value,
+    the same keys readOutputArchive() uses."""
+    tablesDict = {}
+    extensions = ['.csv', '.parquet'] + ['.csv' + ext for ext in COMPRESSIONS.values()]
+
+    for dirPath, dirNames, fileNames in os.walk(cohortDir):
+        for fileName in sorted(fileNames):
+            outputPath = os.path.join(dirPath, fileName)
+            if fileName.endswith('.npz') and not fileName.endswith('_plotdata.npz'):
+                tablesDict.update(readOutputArchive(outputPath))
+                continue
+
+            for extension in extensions:
+                if fileName.endswith(extension):
+                    name = os.path.relpath(outputPath, cohortDir)[:-len(extension)]
+                    tablesDict[name] = readOutputTable(outputPath)
+                    break
+
+    return tablesDict
+
+
+def closeTableWriter(tableWriter):
+    """Completion barrier of the table writer. Saves the tables collected for
+    the npz format in a single compressed NumPy archive, waits for the
+    queued tables to be written (and flushed to disk and the folders synced
+    if the writer is durable), then lists every file that failed and exits
+    if there were any."""
+    if tableWriter['format'] == 'npz' and len(tableWriter['archive']) > 0:
+        archive = tableWriter['archive']
+        archivePath = os.path.join(tableWriter['dirPath'], tableWriter['cohortName'] + '.npz')
+        tableWriter['dirs'].add(tableWriter['dirPath'])
+        tableWriter['archive'] = {}
+
+        def saveArchive():
+            arrays = {}
+            for fileName, df in archive.items():
+                arrays.update(packTable(fileName, df))
+            np.savez_compressed(archivePath, **arrays)
+
+        queueWrite(tableWriter, os.path.basename(archivePath), archivePath, saveArchive)
+
+    for future in tableWriter['pending']:
+        future.result()
+    tableWriter['pending'] = []
+
+    if tableWriter['durable']:
+        for dirPath in sorted(tableWriter['dirs']):
+            fsyncDir(dirPath)
+
+    if tableWriter['store'] != None:
+        closeStore(tableWriter['store'])
+
+    if len(tableWriter['errors']) > 0:
+        print('\nERROR: {0} output file(s) could not be written:'.format(len(tableWriter['errors'])))
+        for outputPath, error in tableWriter['errors']:
+            print('  {0}: {1}'.format(outputPath, error))
+        sys.exit(1)
+
+
+def packTable(fileName, df):
+    """Used in closeTableWriter(). Turn a dataframe into plain arrays named
+    '<fileName>::<part>' that np.savez can store without pickling. A table
+    with one numeric dtype (the minute level and binned data) is stored as a
+    single 2-D array, anything else column by column."""
+    arrays = {}
+    columnLabels = [col if isinstance(col, tuple) else (col,) for col in df.columns]
+
+    index = df.index.values
+    if index.dtype == object: # e.g. the group names
+        index = index.astype(str)
+    arrays[fileName + '::index'] = index
+    arrays[fileName + '::index_name'] = np.array(df.index.name or '')
+    arrays[fileName + '::columns'] = np.array(columnLabels, dtype=str).reshape(len(columnLabels), -1)
+    arrays[fileName + '::column_names'] = np.array([name or '' for name in df.columns.names])
+
+    dtypes = set(df.dtypes)
+    if len(dtypes) == 1 and dtypes.pop() != object:
+        arrays[fileName + '::values'] = df.values
+    else:
+        for pos in range(df.shape[1]):
+            values = df.iloc[:, pos].values
+            if values.dtype == object:
+                values = np.array(['' if x is None else str(x) for x in values])
+            arrays[fileName + '::col' + str(pos)] = values
+
+    return arrays
+
+
+def readOutputArchive(archivePath):
+    """Load the tables saved with --outputFormat npz. Returns a dictionary with
+    the file name each table would have had as csv (without the extension)
+    as key and the dataframe, with its MultiIndex header and datetime index
+    restored, as value."""
+    tablesDict = {}
+
+    with np.load(archivePath) as archive:
+        parts = {}
+        for key in archive.files:
+            fileName, part = key.split('::')
+            parts.setdefault(fileName, {})[part] = archive[key]
+
+    for fileName, tableParts in parts.items():
+        columnNames = [name or None for name in tableParts['column_names']]
+        labels = tableParts['columns']
+        if labels.shape[1] > 1:
+            columns = pd.MultiIndex.from_arrays(list(labels.T), names=columnNames)
+        else:
+            columns = pd.Index(labels[:, 0], name=columnNames[0])
+
+        if 'values' in tableParts:
+            df = DataFrame(tableParts['values'], index=tableParts['index'], columns=columns)
+        else:
+            colData = []
+            for pos in range(len(columns)):
+                values = tableParts['col' + str(pos)]
+                if values.dtype.kind == 'U':
+                    values = np.array([None if x == '' else x for x in values], dtype=object)
+                colData.append(values)
+            df = DataFrame(dict(enumerate(colData)), index=tableParts['index'])
+            df.columns = columns
+
+        df.index.name = str(tableParts['index_name']) or None
+        tablesDict[fileName] = df
+
+    return tablesDict
+
+
+def outputMinuteData(rawDf, nullRows, formattedTurnsDf, formattedDistanceDf, 
+    selectedDistanceDf, tableWriter):
+    """Output the minute level data frames (raw, formatted and selected)"""
+    cohortName = tableWriter['cohortName']
+    print('\nExporting results ({0})...'.format(tableWriter['format']))
+    print("Outputting raw dataframe")
+    writeTable(tableWriter, 'raw', cohortName +'_rawdata', rawDf, float_format='%.10g')
+    print("Outputting number of null rows.")
+    writeTable(tableWriter, 'null', cohortName +'_num_null', nullRows)
+    print("Outputting turns formatted dataframe.")
+    writeTable(tableWriter, 'turns', cohortName +'_formatted_turns', formattedTurnsDf, float_format='%.10g')
+    print("Outputting formatted distance dataframe.")
+    writeTable(tableWriter, 'distance', cohortName +'_formatted_distance', formattedDistanceDf)
+    print("Outputting df with selected hours, if not specified will output all data")
+    writeTable(tableWriter, 'selected', cohortName +'_selected_distance', selectedDistanceDf)
+
+    if tableWriter['store'] != None:
+        print("Storing the minute data in {0}".format(tableWriter['store']['path']))
+        with profileStage(tableWriter['profiler'], 'store'):
+            storeMinutes(tableWriter['store'], cohortName, formattedDistanceDf)
+
+
+def outputResults(hourlyDf, dailyDf, customDfList, sessionTable, percentRunRestDf, 
+    tableWriter, circadian=None, synchrony=None):
+    """Output the binned data, percent run and rest, the sessions,
+    the light/dark phase tables (if circadian from finishCircadian() is
+    given), the synchrony tables (if synchrony from finishSynchrony() is
+    given) and the plots"""
+    cohortName = tableWriter['cohortName']
+    print("Outputting custom data bins.")
+    if customDfList != None:
+        for dfDict in customDfList:
+            for rule, customDf in dfDict.items():
+                writeTable(tableWriter, 'bins', cohortName +'_bin_by_' + rule + '_', customDf)
+
+    print("Outputting data binned by the hour.")
+    writeTable(tableWriter, 'bins', cohortName +'_bin_by_hour', hourlyDf)
+    print("Outputting data binned by day")
+    writeTable(tableWriter, 'bins', cohortName +'_bin_by_day', dailyDf)
+    # Output the plots
+    # Output session data frames
+    print("Outputting calculated percent run and rest.")
+    writeTable(tableWriter, 'percent', cohortName + '_percentRunRest', percentRunRestDf)
+    print('\nExporting results...')
+
+    if 'groups' in tableWriter['artifacts']:
+        outputGroupStats(hourlyDf, dailyDf, customDfList, sessionTable, percentRunRestDf,
+            tableWriter)
+
+    if tableWriter['store'] != None:
+        print("Storing the bins and sessions in {0}".format(tableWriter['store']['path']))
+        with profileStage(tableWriter['profiler'], 'store'):
+            storeResults(tableWriter['store'], cohortName, hourlyDf, dailyDf, customDfList,
+                         sessionTable)
+
+    if circadian != None:
+        print("Outputting light/dark phase totals and the 24 hour profile.")
+        writeTable(tableWriter, 'circadian', cohortName + '_light_dark', circadian['lightDark'])
+        writeTable(tableWriter, 'circadian', cohortName + '_daily_profile', circadian['profile'])
+
+    if synchrony != None:
+        print("Outputting the activity correlation and bout overlap between animals.")
+        writeTable(tableWriter, 'synchrony', cohortName + '_correlation_minute', synchrony['minuteCorr'])
+        writeTable(tableWriter, 'synchrony', cohortName + '_correlation_hour', synchrony['hourCorr'])
+        writeTable(tableWriter, 'synchrony', cohortName + '_bout_overlap', synchrony['overlap'])
+        writeTable(tableWriter, 'synchrony', cohortName + '_synchrony_groups', synchrony['groups'])
+
+    if tableWriter['sessionLayout'] in ('long', 'both'):
+        print("Outputting session data for all animals.")
+        writeTable(tableWriter, 'sessions', cohortName + '_sessions', longSessionsDf(sessionTable))
+
+    for pos, animalName in enumerate(sessionTable['animals']):
+        if 'sessions' not in tableWriter['artifacts'] or tableWriter['sessionLayout'] == 'long':
+            break
+        print("Outputting session data for: ", animalName)
+        writeTable(tableWriter, 'sessions', os.path.join('animal_sessions',
+            animalName[0] +'_' + animalName[1] + '_sessions'),
+            animalSessionsDf(sessionTable, pos))
+
+    if 'graphs' in tableWriter['artifacts'] and tableWriter['deferPlots']:
+        print('\nSaving plot data, make the graphs with: sessions.py plot {0}'.format(cohortName))
+        savePlotData(percentRunRestDf, hourlyDf, dailyDf, tableWriter['dirPath'], cohortName,
+                     circadian, synchrony)
+    elif 'graphs' in tableWriter['artifacts']:
+        print('\nMaking plots...')
+        with profileStage(tableWriter['profiler'], 'plotGraphs'):
+            plotGraphs(percentRunRestDf, hourlyDf, dailyDf, tableWriter['dirPath'], cohortName,
+                       tableWriter['plotWorkers'], circadian, tableWriter['plotPoints'],
+                       synchrony)
+
+    # The tables are written in the background while plotting, wait for them
+    closeTableWriter(tableWriter)
+    print('**Done**.')
+
+
+def outputGroupStats(hourlyDf, dailyDf, customDfList, sessionTable, percentRunRestDf,
+    tableWriter):
+    """Output the group means and SEMs of the binned data and the run, rest
+    and session statistics, grouped by the 'Channel Group:' header"""
+    cohortName = tableWriter['cohortName']
+    binnedDfs = [('hour', hourlyDf), ('day', dailyDf)]
+    if customDfList != None:
+        binnedDfs += [(rule + '_', customDf) for dfDict in customDfList
+                      for rule, customDf in dfDict.items()]
+
+    with profileStage(tableWriter['profiler'], 'calcGroupStats'):
+        groupBinnedDfs = [(name, calcGroupBins(binnedDf)) for name, binnedDf in binnedDfs]
+        groupStatsDf = calcGroupStats(percentRunRestDf, sessionTable)
+
+    print("Outputting group averages.")
+    for name, groupBinnedDf in groupBinnedDfs:
+        writeTable(tableWriter, 'groups', cohortName + '_group_bin_by_' + name, groupBinnedDf)
+    writeTable(tableWriter, 'groups', cohortName + '_group_stats', groupStatsDf)
+
+
+def outputAllToFile(rawDf, formattedTurnsDf, formattedDistanceDf, selectedDistanceDf, 
+    baseParam, hourlyDf, dailyDf, customDfList, sessionTable, reformattedTable, percentRunRestDf, 
+    nullRows, cohortName, outputFormat='csv', artifacts=None, plotWorkers=1, deferPlots=False,
+    profiler=None, writeWorkers=0, durable=False, compress=None, compressLevel=None,
+    storePath=None, plotPoints=DEFAULT_PLOT_POINTS, sessionLayout='animal', circadian=None,
+    synchrony=None):
+    """Creates a cohort folder in current directory and output's all the
+    data frames for each sample. The output settings are passed on to
+    initTableWriter(), with storePath the data is also loaded into that
+    SQLite store. circadian and synchrony are the optional results of
+    calcCircadian() and calcSynchrony()."""
+    newDirPath = makeCohortDir(cohortName)
+    store = initStore(storePath) if storePath != None else None
+    tableWriter = initTableWriter(newDirPath, cohortName, outputFormat, artifacts,
+                                  plotWorkers, deferPlots, profiler, writeWorkers, durable,
+                                  compress, compressLevel, store, plotPoints, sessionLayout)
+
+    with profileStage(profiler, 'outputMinuteData'):
+        outputMinuteData(rawDf, nullRows, formattedTurnsDf, formattedDistanceDf,
+            selectedDistanceDf, tableWriter)
+    with profileStage(profiler, 'outputResults'):
+        outputResults(hourlyDf, dailyDf, customDfList, sessionTable, percentRunRestDf,
+            tableWriter, circadian, synchrony)
+
+        
+def getFilenameInfo(FILE_NAME_REGEXP, user_args_input):
+    """Function to split the filename and extension and return both."""
     
+    # get filename from first command line argument
+    # fileDir, wholeFileName = os.path.split(user_args_input)
+    wholeFileName = os.path.basename(user_args_input)
+
+    # Use a regular expression to match the filename
+    nameSearchObj = re.search(FILE_NAME_REGEXP, wholeFileName)
+
+    # Capture name without extension. 
+    fileNameNoExtension = nameSearchObj.group(1)
+
+    # Grab file extension to determine if .asc or .csv
+    fileExtension = nameSearchObj.group(2)
+
+    # return information file name without extension (e.g. '.csv', '.asc')
+    return  fileNameNoExtension, fileExtension #, wholeFileName, fileDir
+
+
+def addAnalysisOptions(parser):
+    """Add the analysis options shared by the single file and batch parsers"""
     parser.add_argument("-S", '--customStart', default=None, 
         help=textwrap.dedent("""Specify custom start time in 'month/day/year hour:min' format. (e.g. '9/5/2018 11:30').
         Make sure to place in quotes and leave a space between year and hour.  Add no leading zeros. The
@@ -638,63 +3674,619 @@ def parseUserInput():
     parser.add_argument("-H",'--customGrpByHr', default=None, action='append',
         help=textwrap.dedent("""Optional: specify number of hours to group data by"""))
     
+    parser.add_argument('--legacySessions', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: calculate sessions with the original row by row loop instead
+        of the vectorized run-length engine (slower, use for comparing results)"""))
+
+    parser.add_argument('--minRun', default=1, type=int,
+        help=textwrap.dedent("""Optional: shortest run bout in minutes, shorter runs count as rest.
+        Defaults to 1"""))
+
+    parser.add_argument('--minRest', default=1, type=int,
+        help=textwrap.dedent("""Optional: shortest rest bout in minutes, shorter rests between two runs
+        are joined into one run. Applied after --minRun. Defaults to 1"""))
+
+    parser.add_argument('--minDistance', default=0.0, type=float,
+        help=textwrap.dedent("""Optional: a minute only counts as running if the animal covered more than
+        this many meters in it. Defaults to 0"""))
+
+    parser.add_argument('--mergeGap', default=0, type=int,
+        help=textwrap.dedent("""Optional: join two runs separated by a rest of at most this many minutes
+        into one run, before --minRun is applied. Defaults to 0 (no merging)"""))
+    
+    parser.add_argument('--lightsOn', default=None,
+        help=textwrap.dedent("""Optional: time the lights go on, as 'hour:min' (e.g. '6:00'). Together with
+        --lightsOff adds the light/dark phase totals, the average 24 hour profile and its
+        graph page"""))
+
+    parser.add_argument('--lightsOff', default=None,
+        help=textwrap.dedent("""Optional: time the lights go off, as 'hour:min' (e.g. '18:00')"""))
+
+    parser.add_argument('--synchrony', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: add the animal by animal correlation of the minute and hourly
+        distance, the overlap of their run bouts, the means within each group and a
+        heatmap page to the graphs"""))
+
+    parser.add_argument('--reindex', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: sort the rows by time, drop duplicate timestamps (keeping the last
+        one in the file) and fill in missing minutes, so there is exactly one row per minute.
+        Not available with --chunkSize/--incremental"""))
+
+    parser.add_argument('--fillPolicy', default='nan', choices=FILL_POLICIES,
+        help=textwrap.dedent("""Optional: what --reindex puts in the missing minutes: nan (default, single
+        missing rows still get back filled), zero, ffill (copy the row before) or bfill
+        (copy the row after)"""))
+
+    parser.add_argument('--chunkSize', default=None, type=int,
+        help=textwrap.dedent("""Optional: stream the input file in chunks of this many rows (minutes) instead
+        of loading it all into memory, for very long recordings"""))
+
+    parser.add_argument('--outputFormat', default='csv', choices=OUTPUT_FORMATS,
+        help=textwrap.dedent("""Optional: write the tables as csv files (default), parquet files (needs pyarrow)
+        or a single compressed NumPy archive <cohort_name>.npz (load it with readOutputArchive()).
+        With --chunkSize/--incremental the minute level tables are always csv"""))
+
+    parser.add_argument('--compress', default=None, choices=list(COMPRESSIONS),
+        help=textwrap.dedent("""Optional: compress the csv tables (gzip, or zstd/lz4 if the zstandard/lz4
+        package is installed), they get a .csv.gz/.csv.zst/.csv.lz4 extension. With
+        --outputFormat parquet it sets the parquet compression, --outputFormat npz is always
+        compressed. Load them back in Python with readOutputTables()"""))
+
+    parser.add_argument('--compressLevel', default=None, type=int,
+        help=textwrap.dedent("""Optional: compression level for --compress, gzip 0-9 (default 6), zstd
+        1-22 (default 3), lz4 0-16 (default 0)"""))
+
+    parser.add_argument('--outputs', default=None, type=lambda x: x.split(','),
+        help=textwrap.dedent("""Optional: comma separated list of what to output, from: {0}.
+        Defaults to all of them""".format(', '.join(OUTPUT_ARTIFACTS))))
+
+    parser.add_argument('--sessionLayout', default='animal', choices=SESSION_LAYOUTS,
+        help=textwrap.dedent("""Optional: write the sessions as one table per animal in animal_sessions/
+        (animal), as a single long table <cohort_name>_sessions with the sample, group
+        and session number of each row (long), or both. Defaults to animal"""))
+
+    parser.add_argument('--plotWorkers', default=1, type=int,
+        help=textwrap.dedent("""Optional: number of processes to render the graph pages with (needs pypdf
+        to join the pages). Defaults to 1"""))
+
+    parser.add_argument('--plotPoints', default=DEFAULT_PLOT_POINTS, type=int,
+        help=textwrap.dedent("""Optional: most points drawn per line on the hourly histogram and
+        cumulative sum pages. Longer recordings keep the lowest and highest point of
+        each of plotPoints/2 time buckets, so peaks still show. 0 draws every point.
+        Defaults to {0}""".format(DEFAULT_PLOT_POINTS)))
+
+    parser.add_argument('--deferPlots', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: save the plot data instead of making the graphs, make them later
+        with 'sessions.py plot <cohort folder>'. Leave 'graphs' out of --outputs to skip plots"""))
+
+    parser.add_argument('--writeWorkers', default=0, type=int,
+        help=textwrap.dedent("""Optional: number of threads that write the output tables in the background
+        while the rest is calculated and plotted. Helps where writing waits on the disk
+        (e.g. network storage), the csv formatting itself doesn't run in parallel.
+        Defaults to 0 (write them one after another)"""))
+
+    parser.add_argument('--durableWrites', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: flush every output table to disk (fsync) before the run finishes"""))
+
+    parser.add_argument('--store', default=None,
+        help=textwrap.dedent("""Optional: also load the minute distances, bins and sessions into this SQLite
+        database (created if needed), replacing what was stored for the cohort before.
+        Many cohorts can share one database, query it with 'sessions.py query'"""))
+
+    parser.add_argument('--incremental', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: for recordings that keep growing. Saves where processing stopped
+        in the cohort folder, so the next run only processes the newly appended rows"""))
+
+    parser.add_argument('--cacheDir', default=None,
+        help=textwrap.dedent("""Optional: keep a copy of each parsed input file in this folder, keyed by
+        the file contents, so later runs on the same file (e.g. with other -S/-E/-H) skip
+        parsing. Not used with --chunkSize/--incremental"""))
+
+    parser.add_argument('--cacheSize', default=DEFAULT_CACHE_SIZE, type=int,
+        help=textwrap.dedent("""Optional: largest size of --cacheDir in MB, the least recently used
+        files are removed first. Defaults to {0}""".format(DEFAULT_CACHE_SIZE)))
+
+    parser.add_argument('--refreshCache', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: ignore and replace the cached copy of the input file"""))
+
+    parser.add_argument('--profile', default=False, action='store_true',
+        help=textwrap.dedent("""Optional: record the wall time, CPU time and peak memory of each stage and
+        output file, print a summary and save it to <cohort_name>_profile.json. Memory
+        tracing slows the run down somewhat. Graph pages rendered by --plotWorkers
+        processes only count towards wall time"""))
+
+    parser.add_argument('--profileStage', default=None, choices=PROFILE_STAGES,
+        help=textwrap.dedent("""Optional: also run this stage under cProfile and save the stats to
+        <cohort_name>_<stage>.prof (open with python -m pstats). Implies --profile"""))
+
+
+def parseUserInput(argv=None):
+    """Use argparse to handle user input for program"""
+    
+    # Create a parser object
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        
+        description="""%(prog)s parses mouse running wheel data and calculates 
+        run and rest sessions.  
+
+        The program takes '.csv' data output from the 
+        Vitalview Software. The input file should have three levels of headers. 
+        From top to bottom. The header needs to be 'Channel Name:','Channel Group:' 
+        and 'Sensor Type:'""",
+
+        epilog=textwrap.dedent("""\
+        The script will output a csv file for each of the following:
+            1) Raw data               <cohort_name>_rawdata.csv
+            2) Formatted turns        <cohort_name>_formatted_turns.csv
+            3) Formatted distance     <cohort_name>_formatted_distance.csv
+            4) Selected distance      <cohort_name>_selected_distance.csv (based on customStart/End inputs)
+            4) Bin by hr              <cohort_name>_bin_by_hour.csv
+            5) Bin by days            <cohort_name>_bin_by_day.csv
+            6) Bin by <X> Hours       <cohort_name>_bin_by_<user_defined_hours>H.csv
+            7) Sessions               <animal>_sessions.csv
+            8) Percent Run & rest     <cohort_name>_percentRunRest.csv
+            9) Graphs                 <cohort_name>_graphs.pdf
+          
+        The pdf of graphs contain plots for:
+            - Total Running Distance By Day
+            - Percent Run and Percent Rest Per Animal
+            - Cumulative Sum Plot Binned By Hour
+            - Distance Histogram Binned By Hour"""))
+
+    parser.add_argument("input",
+        help="File name and/or path to experiment_file.asc or .csv")
+    
+    addAnalysisOptions(parser)
+
     parser.add_argument("-V", "--version", action="version",
                         version=textwrap.dedent("""\
         %(prog)s
         -----------------------   
-        Version:    0.5.0
+        Version:    {0}
         Updated:    09/5/2018
         By:         Prech Uapinyoying
-        Website:    https://github.com/puapinyoying"""))
+        Website:    https://github.com/puapinyoying""".format(VERSION)))
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     return args
 
 
-# Grab parsed user input.
-user_args = parseUserInput()
+def parseBatchInput(argList):
+    """Use argparse to handle user input for the batch subcommand"""
+    parser = argparse.ArgumentParser(prog='sessions.py batch',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""Run the analysis on many VitalView files in parallel. Each 
+        file gets its own cohort folder in the current directory, same as
+        running sessions.py on it alone.""")
+
+    parser.add_argument("inputs", nargs='+',
+        help="Files, directories (all .csv files inside) or quoted glob patterns")
+
+    parser.add_argument("-j", '--workers', default=os.cpu_count(), type=int,
+        help="Number of worker processes. Defaults to the number of cores")
+
+    parser.add_argument('--manifest', default='batch_manifest.csv',
+        help="Where to write the summary of each file's status and run time. Defaults to batch_manifest.csv")
+
+    addAnalysisOptions(parser)
+
+    args = parser.parse_args(argList)
+
+    return args
+
+
+def parsePlotInput(argList):
+    """Use argparse to handle user input for the plot subcommand"""
+    parser = argparse.ArgumentParser(prog='sessions.py plot',
+        description="""Make the graphs pdf for a cohort folder from the plot data
+        saved by an earlier run with --deferPlots.""")
+
+    parser.add_argument("cohortDir", help="Path to the cohort folder")
+
+    parser.add_argument("-j", '--workers', default=1, type=int,
+        help="Number of processes to render the pages with. Defaults to 1")
+
+    parser.add_argument('--plotPoints', default=DEFAULT_PLOT_POINTS, type=int,
+        help=textwrap.dedent("""Most points drawn per line on the hourly pages, 0 draws every
+        point. Defaults to {0}""".format(DEFAULT_PLOT_POINTS)))
+
+    args = parser.parse_args(argList)
+
+    return args
+
+
+def parseQueryInput(argList):
+    """Use argparse to handle user input for the query subcommand"""
+    parser = argparse.ArgumentParser(prog='sessions.py query',
+        description="""Read rows from a database made with --store and write them
+        as csv, with the cohort, sample, group and sensor of each animal.""")
+
+    parser.add_argument("store", help="Path to the SQLite database")
+
+    parser.add_argument('-t', '--table', default='bins', choices=list(STORE_COLUMNS),
+        help="Table to read: minutes, bins (default), sessions or animals")
+
+    parser.add_argument('--cohort', default=None, help="Only this cohort")
+
+    parser.add_argument('--group', default=None, help="Only animals of this 'Channel Group'")
+
+    parser.add_argument('--sample', default=None, help="Only this animal ('Channel Name')")
+
+    parser.add_argument('--rule', default=None,
+        help="Only bins of this size: hour, day or <X>H (e.g. 4H)")
+
+    parser.add_argument('--start', default=None,
+        help="Only rows from this time on (sessions: run start), e.g. '2018-03-01' or '2018-03-01 18:00'")
+
+    parser.add_argument('--end', default=None, help="Only rows up to and including this time")
+
+    parser.add_argument('--sql', default=None,
+        help="Run this SQL query instead (the database is opened read only)")
+
+    parser.add_argument('-o', '--output', default=None,
+        help="csv file to write the rows to. Defaults to standard output")
+
+    args = parser.parse_args(argList)
+
+    if args.sql == None:
+        filterError = queryFilterError(args.table, args.rule, args.start, args.end)
+        if filterError != None:
+            parser.error(filterError)
+
+    return args
+
+
+def parseFollowInput(argList):
+    """Use argparse to handle user input for the follow subcommand"""
+    parser = argparse.ArgumentParser(prog='sessions.py follow',
+        description="""Follow a VitalView csv file while it is being recorded and
+        write a JSON line for every run/rest session that opens or closes
+        (with each animal's distance over the last hour), and for every
+        clock hour with all animals' distances.""")
+
+    parser.add_argument("input", help="VitalView csv file that is being recorded")
+
+    parser.add_argument('-o', '--events', default='-',
+        help="File to append the events to. Defaults to - (standard output)")
+
+    parser.add_argument('--interval', default=FOLLOW_INTERVAL, type=float,
+        help="Seconds between checks for new rows. Defaults to {0}".format(FOLLOW_INTERVAL))
+
+    parser.add_argument('--once', default=False, action='store_true',
+        help="Stop at the end of the file instead of waiting for more rows")
+
+    args = parser.parse_args(argList)
+
+    return args
+
+
+def followMain(follow_args):
+    """Used in main(). Check the input and run followFile() until Ctrl-C"""
+    checkInputFile(follow_args.input)
+
+    if follow_args.events == '-':
+        eventsFile = sys.stdout
+    else:
+        eventsFile = open(follow_args.events, 'a')
+
+    # Progress messages go to stderr, stdout may be the events
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            followFile(follow_args.input, eventsFile, follow_args.interval, follow_args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if eventsFile is not sys.stdout:
+            eventsFile.close()
+
 
-if user_args.input:
+def analysisOptions(**kwargs):
+    """Analysis settings for analyzeCohort() when using this module from 
+    Python, e.g. analysisOptions(customGrpByHr=['4', '12'], outputs=['bins']).
+    Takes the long names of the command line options, anything not given
+    gets the command line default."""
+    parser = argparse.ArgumentParser()
+    addAnalysisOptions(parser)
+    options = parser.parse_args([])
+
+    for name, value in kwargs.items():
+        if not hasattr(options, name):
+            raise TypeError("Unknown analysis option '{0}'".format(name))
+        setattr(options, name, value)
+
+    return options
+
+
+def analyzeCohort(inputPath, options=None):
+    """Run the whole pipeline on one VitalView file and write the results to
+    a cohort folder in the current directory. options holds the analysis 
+    settings from addAnalysisOptions(), see analysisOptions(). Returns the
+    cohort name."""
+    if options == None:
+        options = analysisOptions()
 
     # Start with sanity checks
-    checkInputFile(user_args.input) # Does file exist? If no, exit and warn.
+    checkInputFile(inputPath) # Does file exist? If no, exit and warn.
 
     # Next grab the file name to use as cohort and file extension
-    cohortName, fileExtension = getFilenameInfo(FILE_NAME_REGEXP, user_args.input)
+    cohortName, fileExtension = getFilenameInfo(FILE_NAME_REGEXP, inputPath)
 
-    if fileExtension == 'csv':
-        rawDf = pd.read_csv(user_args.input, index_col=[0], header=None)
+    if fileExtension.lower() not in INPUT_EXTENSIONS:
+        print("This program only excepts the raw '.csv' or '.asc' files.")
+        sys.exit(1)
 
-    else:
-        print("This program only excepts the raw '.csv' files.")
+    checkOutputOptions(options.outputFormat, options.outputs, options.compress,
+                       options.compressLevel)
+
+    if options.reindex and (options.incremental or options.chunkSize != None):
+        print("--reindex needs the whole file in memory, it can't be used with --chunkSize/--incremental.")
+        sys.exit(1)
+
+    if options.plotPoints < 0 or options.plotPoints == 1:
+        print("--plotPoints must be 0 (draw every point) or at least 2.")
+        sys.exit(1)
+
+    bouts = boutRules(options.minRun, options.minRest, options.minDistance, options.mergeGap)
+    lights = lightSchedule(options.lightsOn, options.lightsOff)
+    if options.legacySessions and bouts != boutRules():
+        print("--legacySessions can't be used with --minRun/--minRest/--minDistance/--mergeGap.")
         sys.exit(1)
 
+    profiler = None
+    if options.profile or options.profileStage != None:
+        profiler = initProfiler(options.profileStage)
+
+    # The profile is written even if the run stops on an error (e.g. files
+    # that couldn't be written), those are the runs most worth a look
+    completed = False
+    try:
+        if options.incremental:
+            incrementalCohort(inputPath, cohortName, options.customStart, options.customEnd,
+                options.customGrpByHr, options.chunkSize or DEFAULT_CHUNK_SIZE,
+                options.outputFormat, options.outputs, options.plotWorkers, options.deferPlots,
+                profiler, options.writeWorkers, options.durableWrites, options.compress,
+                options.compressLevel, bouts, lights, options.store, options.plotPoints,
+                options.sessionLayout, options.synchrony)
+
+        elif options.chunkSize != None:
+            streamCohort(inputPath, cohortName, options.customStart,
+                options.customEnd, options.customGrpByHr, options.chunkSize,
+                options.outputFormat, options.outputs, options.plotWorkers, options.deferPlots,
+                profiler, options.writeWorkers, options.durableWrites, options.compress,
+                options.compressLevel, bouts, lights, options.store, options.plotPoints,
+                options.sessionLayout, options.synchrony)
+
+        else:
+            analyzeInMemory(inputPath, cohortName, options, profiler, bouts, lights)
+        completed = True
+
+    finally:
+        if profiler != None:
+            writeProfileReport(profiler, makeCohortDir(cohortName), cohortName, completed)
+
+    return cohortName
+
+
+def analyzeInMemory(inputPath, cohortName, options, profiler=None, bouts=None, lights=None):
+    """Used in analyzeCohort(). The default pipeline, with the whole file in
+    memory"""
+    if bouts == None:
+        bouts = boutRules()
+
+    with profileStage(profiler, 'load'):
+        if options.cacheDir != None:
+            rawDf = readVitalViewCached(inputPath, options.cacheDir, options.cacheSize,
+                                        options.refreshCache)
+        else:
+            rawDf = readVitalViewCsv(inputPath)
+
+    # Check for missing, duplicate and out of order timestamps
+    with profileStage(profiler, 'checkDataQuality'):
+        qualityCounts = checkDataQuality(rawDf)
+        printQualityWarnings(qualityCounts, options.reindex)
+        if options.reindex:
+            rawDf = reindexMinutes(rawDf, options.fillPolicy)
+
     # Start doing some calculations and creating dataframes
-    formattedTurnsDf, formattedDistanceDf, nullRows = formatRawDf(rawDf)
+    with profileStage(profiler, 'formatTurnsDf'):
+        formattedTurnsDf, formattedDistanceDf, nullRows = formatTurnsDf(rawDf)
+    nullRows = addQualityCounts(nullRows, qualityCounts)
 
     # Produce the formated dataframe with the user selected time windows
-    customStart = user_args.customStart
-    customEnd = user_args.customEnd
-    selectedDistanceDf = customStartDateTime(formattedDistanceDf, customStart, customEnd)
+    customStart = options.customStart
+    customEnd = options.customEnd
+    with profileStage(profiler, 'customStartDateTime'):
+        selectedDistanceDf = customStartDateTime(formattedDistanceDf, customStart, customEnd)
+    checkSelectedWindow(selectedDistanceDf.empty)
+
+    # Queue the minute level tables, with --writeWorkers they are written
+    # while the bins and sessions are calculated
+    tableWriter = initTableWriter(makeCohortDir(cohortName), cohortName, options.outputFormat,
+        options.outputs, options.plotWorkers, options.deferPlots, profiler,
+        options.writeWorkers, options.durableWrites, options.compress, options.compressLevel,
+        initStore(options.store) if options.store != None else None, options.plotPoints,
+        options.sessionLayout)
+    with profileStage(profiler, 'outputMinuteData'):
+        outputMinuteData(rawDf, nullRows, formattedTurnsDf, formattedDistanceDf,
+            selectedDistanceDf, tableWriter)
 
     # Reformat the df to group the data by days, hours and custom amount of hours
     startHr, startMin = getStartingTime(selectedDistanceDf)
     baseParam = calcBaseParam(startHr, startMin)
-    hourlyDf = formatHourly(selectedDistanceDf, baseParam)
-    dailyDf = formatDaily(selectedDistanceDf, baseParam)
+    with profileStage(profiler, 'binAllRules'):
+        binnedDict = binAllRules(selectedDistanceDf, options.customGrpByHr, baseParam)
+    hourlyDf = binnedDict['H']
+    dailyDf = binnedDict['1d']
 
-    if user_args.customGrpByHr != None:
-        customDfList = resampleByHr(selectedDistanceDf, user_args.customGrpByHr, baseParam)
+    if options.customGrpByHr != None:
+        customDfList = [{i + 'H':binnedDict[i + 'H']} for i in options.customGrpByHr]
     else:
         customDfList = None
 
     # Calculate the sessions and other stats
-    sessionsDict = calcSessions(selectedDistanceDf)
-    reformattedDict = reformatSessions(sessionsDict)
-    percentRunRestDf = calcPercentRunRest(reformattedDict)
-
-    # Dump csvs into folders
-    outputAllToFile(formattedTurnsDf, formattedDistanceDf, selectedDistanceDf, 
-        baseParam, hourlyDf, dailyDf, customDfList, sessionsDict, reformattedDict, 
-        percentRunRestDf, nullRows, cohortName)
\ No newline at end of file
+    with profileStage(profiler, 'calcSessions'):
+        sessionTable = calcSessions(selectedDistanceDf, options.legacySessions, bouts)
+    with profileStage(profiler, 'reformatSessions'):
+        reformattedTable = reformatSessions(sessionTable)
+    with profileStage(profiler, 'calcPercentRunRest'):
+        percentRunRestDf = calcPercentRunRest(reformattedTable)
+
+    circadian = None
+    if lights != None:
+        with profileStage(profiler, 'calcCircadian'):
+            circadian = calcCircadian(selectedDistanceDf, sessionTable, lights,
+                                      bouts['minDistance'])
+
+    synchrony = None
+    if options.synchrony:
+        with profileStage(profiler, 'calcSynchrony'):
+            synchrony = calcSynchrony(selectedDistanceDf, hourlyDf, sessionTable)
+
+    # Dump the rest of the csvs into folders and make the plots
+    with profileStage(profiler, 'outputResults'):
+        outputResults(hourlyDf, dailyDf, customDfList, sessionTable, percentRunRestDf,
+            tableWriter, circadian, synchrony)
+
+
+##############################################################################
+### Section below contains functions for batch processing many files      ###
+##############################################################################
+
+def expandBatchInputs(inputArgs):
+    """Turn the batch input arguments (files, directories or glob patterns)
+    into a sorted list of unique file paths. Directories contribute every
+    .csv and .asc file directly inside them."""
+    inputPaths = []
+
+    for inputArg in inputArgs:
+        if os.path.isdir(inputArg):
+            matches = [path for path in glob.glob(os.path.join(inputArg, '*.*'))
+                       if path.rsplit('.', 1)[-1].lower() in INPUT_EXTENSIONS]
+        elif glob.has_magic(inputArg):
+            matches = glob.glob(inputArg)
+        else:
+            matches = [inputArg]
+
+        for path in sorted(matches):
+            if path not in inputPaths:
+                inputPaths.append(path)
+
+    return inputPaths
+
+
+def batchWorker(inputPath, options):
+    """Run analyzeCohort() on one file in a worker process. Any error 
+    (including sys.exit() from the sanity checks) is caught and reported back
+    so one bad file can't take down the rest of the batch. The progress 
+    messages are saved to <cohort_name>_log.txt in the cohort folder."""
+    startTime = time.time()
+    log = io.StringIO()
+    result = {'input':inputPath, 'cohort':None, 'status':'ok', 'error':''}
+
+    with contextlib.redirect_stdout(log):
+        try:
+            result['cohort'] = analyzeCohort(inputPath, options)
+        except SystemExit:
+            result['status'] = 'failed'
+            result['error'] = log.getvalue().strip().split('\n')[-1]
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+            traceback.print_exc(file=log)
+
+    result['seconds'] = round(time.time() - startTime, 3)
+
+    if result['cohort'] != None:
+        logPath = os.path.join(os.getcwd(), result['cohort'], result['cohort'] + '_log.txt')
+        with open(logPath, 'w') as f:
+            f.write(log.getvalue())
+
+    return result
+
+
+def runBatch(batch_args):
+    """Fan the pipeline out over a process pool, one file per task, and write
+    a manifest of what succeeded or failed and how long each file took"""
+    inputPaths = expandBatchInputs(batch_args.inputs)
+    if len(inputPaths) == 0:
+        print("No input files found.")
+        sys.exit(1)
+
+    results = []
+    tasks = []
+
+    # Each cohort is written to a folder named after the file, so two files
+    # with the same name would overwrite each other's results
+    cohortNames = set()
+    for inputPath in inputPaths:
+        cohortName = os.path.splitext(os.path.basename(inputPath))[0]
+        if cohortName in cohortNames:
+            results.append({'input':inputPath, 'cohort':cohortName, 'status':'failed', 
+                            'error':'Duplicate cohort name', 'seconds':0.0})
+        else:
+            cohortNames.add(cohortName)
+            tasks.append(inputPath)
+
+    print('Processing {0} files with {1} workers...'.format(len(tasks), batch_args.workers))
+    batchStart = time.time()
+
+    with ProcessPoolExecutor(max_workers=batch_args.workers) as executor:
+        futures = {executor.submit(batchWorker, inputPath, batch_args):inputPath 
+                   for inputPath in tasks}
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e: # worker process died
+                result = {'input':futures[future], 'cohort':None, 'status':'failed', 
+                          'error':'{0}: {1}'.format(type(e).__name__, e), 'seconds':None}
+
+            print('{0:8} {1} ({2}s) {3}'.format(result['status'], result['input'], 
+                result['seconds'], result['error']))
+            results.append(result)
+
+    manifestDf = DataFrame(results, columns=['input', 'cohort', 'status', 'seconds', 'error'])
+    manifestDf = manifestDf.sort_values('input').reset_index(drop=True)
+    manifestDf.to_csv(batch_args.manifest, index=False)
+
+    numFailed = (manifestDf.status != 'ok').sum()
+    print('\n{0} succeeded, {1} failed in {2:.1f}s. Manifest written to {3}'.format(
+        len(manifestDf) - numFailed, numFailed, time.time() - batchStart, batch_args.manifest))
+
+    return manifestDf
+
+
+def main(argv=None):
+    """Command line entry point. argv defaults to sys.argv[1:]"""
+    if argv == None:
+        argv = sys.argv[1:]
+
+    if argv[0:1] == ['batch']:
+        batch_args = parseBatchInput(argv[1:])
+        manifestDf = runBatch(batch_args)
+
+        if (manifestDf.status != 'ok').any():
+            sys.exit(1)
+
+    elif argv[0:1] == ['plot']:
+        plot_args = parsePlotInput(argv[1:])
+        plotCohortDir(plot_args.cohortDir, plot_args.workers, plot_args.plotPoints)
+
+    elif argv[0:1] == ['follow']:
+        followMain(parseFollowInput(argv[1:]))
+
+    elif argv[0:1] == ['query']:
+        queryMain(parseQueryInput(argv[1:]))
+
+    else:
+        # Grab parsed user input.
+        user_args = parseUserInput(argv)
+
+        if user_args.input:
+            analyzeCohort(user_args.input, user_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import sessions
+
+TEST_INPUT = os.path.join(REPO_DIR, 'test-input.csv')
+
+
+@pytest.fixture(scope='session')
+def rawDf():
+    return sessions.readVitalViewCsv(TEST_INPUT)
+
+
+@pytest.fixture(scope='session')
+def formattedDistanceDf(rawDf):
+    formattedTurnsDf, formattedDistanceDf, nullRows = sessions.formatTurnsDf(rawDf)
+    return formattedDistanceDf
+
+
+def runCohort(workDir, args, inputPath=TEST_INPUT):
+    """Run sessions.py on inputPath from workDir, returns the cohort folder"""
+    os.makedirs(workDir, exist_ok=True)
+    currentDir = os.getcwd()
+    os.chdir(workDir)
+    try:
+        cohortName = sessions.analyzeCohort(inputPath, sessions.parseUserInput([inputPath] + args))
+    finally:
+        os.chdir(currentDir)
+
+    return os.path.join(workDir, cohortName)
+
+
+def assertCohortDirsMatch(cohortDir, expectedDir):
+    """Every csv table in expectedDir is in cohortDir with the same values
+    (numbers to floating point rounding)"""
+    tablePaths = sorted(os.path.relpath(os.path.join(root, name), expectedDir)
+                        for root, dirs, names in os.walk(expectedDir)
+                        for name in names if name.endswith('.csv'))
+    assert tablePaths
+
+    for tablePath in tablePaths:
+        table = pd.read_csv(os.path.join(cohortDir, tablePath), header=None, dtype=str)
+        expected = pd.read_csv(os.path.join(expectedDir, tablePath), header=None, dtype=str)
+        assert table.shape == expected.shape, tablePath
+
+        values = table.fillna('').values.ravel()
+        expectedValues = expected.fillna('').values.ravel()
+        for value, expectedValue in zip(values, expectedValues):
+            if value == expectedValue:
+                continue
+            try:
+                value, expectedValue = float(value), float(expectedValue)
+            except ValueError:
+                assert value == expectedValue, tablePath
+            assert value == pytest.approx(expectedValue, rel=1e-9), tablePath
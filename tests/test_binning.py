@@ -0,0 +1,76 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sessions
+
+CUSTOM_GRP_BY_HR = ['4', '6', '7', '12']
+
+
+@pytest.mark.parametrize('customStart', [
+    '8/21/2017 10:01', '8/21/2017 11:01', '8/21/2017 11:17', '8/21/2017 23:59',
+    '8/22/2017 0:00', '8/22/2017 4:53', '8/22/2017 13:47', '8/23/2017 6:29',
+])
+def test_binAllRules_matches_resample(formattedDistanceDf, customStart):
+    selectedDistanceDf = sessions.customStartDateTime(formattedDistanceDf, customStart, None)
+    baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+
+    binnedDict = sessions.binAllRules(selectedDistanceDf, CUSTOM_GRP_BY_HR, baseParam)
+
+    assert sorted(binnedDict) == sorted(['H', '1d'] + [i + 'H' for i in CUSTOM_GRP_BY_HR])
+    for rule, binnedDf in binnedDict.items():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning) # base is deprecated
+            expected = selectedDistanceDf.resample(rule, base=baseParam).sum()
+
+        # resample works the shift out as a float and is itself a nanosecond
+        # off for some start times, the bins start on whole minutes
+        assert (binnedDf.index.second == 0).all() and (binnedDf.index.nanosecond == 0).all()
+        assert binnedDf.index.equals(expected.index.round('min')), rule
+        assert binnedDf.columns.equals(expected.columns)
+        np.testing.assert_allclose(binnedDf.values, expected.values, err_msg=rule)
+
+
+def resampleAll(selectedDistanceDf, baseParam):
+    """resample(rule, base=baseParam).sum() for every bin size"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning) # base is deprecated
+        return {rule:selectedDistanceDf.resample(rule, base=baseParam).sum()
+                for rule, freqN, freqNs in sessions.binRules(CUSTOM_GRP_BY_HR)}
+
+
+@pytest.mark.parametrize('order', ['shuffled', 'reversed', 'one row moved'])
+def test_binAllRules_sorts_out_of_order_rows(formattedDistanceDf, order):
+    selectedDistanceDf = sessions.customStartDateTime(formattedDistanceDf, '8/21/2017 11:17', None)
+    baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+    rows = np.arange(len(selectedDistanceDf))
+    if order == 'shuffled':
+        rows = np.random.RandomState(0).permutation(rows)
+    elif order == 'reversed':
+        rows = rows[::-1]
+    else:
+        rows = np.append(np.delete(rows, 700), 700)
+
+    binnedDict = sessions.binAllRules(selectedDistanceDf.iloc[rows], CUSTOM_GRP_BY_HR, baseParam)
+
+    for rule, expected in resampleAll(selectedDistanceDf, baseParam).items():
+        assert binnedDict[rule].index.equals(expected.index.round('min')), rule
+        np.testing.assert_allclose(binnedDict[rule].values, expected.values, rtol=1e-14, err_msg=rule)
+
+
+def test_binAllRules_rounding_does_not_grow_with_length():
+    # 120 days of whole wheel turns, the bins are as close to resample at the
+    # end of the recording as at the start
+    times = pd.date_range('2017-08-21 11:17', periods=120 * 1440, freq='min')
+    turns = np.random.RandomState(0).randint(0, 40, size=(len(times), 2))
+    colList = pd.MultiIndex.from_tuples([('t1', 'wild', '0'), ('t2', 'wild', '1')],
+                                        names=['sample', 'group', 'sensor'])
+    selectedDistanceDf = pd.DataFrame(turns * 0.361, index=times, columns=colList)
+    baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+
+    binnedDict = sessions.binAllRules(selectedDistanceDf, CUSTOM_GRP_BY_HR, baseParam)
+
+    for rule, expected in resampleAll(selectedDistanceDf, baseParam).items():
+        np.testing.assert_allclose(binnedDict[rule].values, expected.values, rtol=1e-14, err_msg=rule)
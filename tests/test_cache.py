@@ -0,0 +1,26 @@
+import os
+
+import pandas as pd
+
+import sessions
+from conftest import TEST_INPUT
+
+
+def test_cached_copy_matches_parsed_file(tmp_path, rawDf):
+    cacheDir = str(tmp_path / 'cache')
+
+    sessions.readVitalViewCached(TEST_INPUT, cacheDir)
+    cachedDf = sessions.readVitalViewCached(TEST_INPUT, cacheDir)
+
+    pd.testing.assert_frame_equal(cachedDf, rawDf)
+
+
+def test_cache_version_is_part_of_the_key(tmp_path, monkeypatch):
+    cacheDir = str(tmp_path / 'cache')
+
+    sessions.readVitalViewCached(TEST_INPUT, cacheDir)
+    monkeypatch.setattr(sessions, 'CACHE_VERSION', sessions.CACHE_VERSION + 1)
+    sessions.readVitalViewCached(TEST_INPUT, cacheDir)
+
+    assert sorted(name.rsplit('-', 1)[1] for name in os.listdir(cacheDir)) == \
+        ['v{0}'.format(sessions.CACHE_VERSION - 1), 'v{0}'.format(sessions.CACHE_VERSION)]
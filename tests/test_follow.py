@@ -0,0 +1,39 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sessions
+from conftest import TEST_INPUT
+
+
+def test_follow_events_match_sessions(tmp_path, formattedDistanceDf):
+    eventsPath = str(tmp_path / 'events.jsonl')
+    sessions.main(['follow', '--once', '-o', eventsPath, TEST_INPUT])
+    with open(eventsPath) as f:
+        events = [json.loads(line) for line in f]
+
+    sessionTable = sessions.calcSessions(formattedDistanceDf)
+    samples = list(formattedDistanceDf.columns.get_level_values(0))
+    key = lambda animal, session: (samples.index(animal), session)
+
+    opened = sorted(key(event['animal'], event['session']) for event in events
+                    if event['event'] == 'session_open')
+    assert opened == list(zip(sessionTable['animal'], sessionTable['session']))
+
+    # Every session but each animal's last is closed, with the same phases
+    closed = {key(event['animal'], event['session']):event for event in events
+              if event['event'] == 'session_close'}
+    isLast = np.append(sessionTable['animal'][1:] != sessionTable['animal'][:-1], True)
+    assert len(closed) == (~isLast).sum()
+    for row in np.flatnonzero(~isLast):
+        event = closed[(sessionTable['animal'][row], sessionTable['session'][row])]
+        assert event['rest_mins'] == sessionTable['rest_mins'][row]
+        assert pd.Timestamp(event['rest_start']).value == sessionTable['rest_start'][row]
+        if sessionTable['run_obs'][row]:
+            assert event['run_mins'] == sessionTable['run_mins'][row]
+            assert event['run_dist(m)'] == pytest.approx(sessionTable['run_dist(m)'][row], abs=1e-3)
+
+    hours = [event for event in events if event['event'] == 'hour']
+    assert len(hours) == len(formattedDistanceDf.resample('H').sum()) - 1
@@ -0,0 +1,31 @@
+import pytest
+
+from conftest import TEST_INPUT, assertCohortDirsMatch, runCohort
+
+ANALYSIS_ARGS = ['-S', '8/21/2017 11:01', '-H', '4', '--outputs', 'raw,null,bins,percent,sessions']
+
+
+def writeAsc(ascPath, sep, splitDate):
+    """Copy of test-input.csv as an .asc export with lines of experiment
+    information above the header"""
+    with open(TEST_INPUT, encoding='utf-8-sig') as f:
+        lines = [line.rstrip('\n').split(',') for line in f]
+
+    with open(ascPath, 'w') as f:
+        f.write('Experiment: test\nStart Date: 8/21/17\n\n')
+        for fields in lines:
+            if splitDate and not fields[0].endswith(':'):
+                fields = fields[0].split(' ') + fields[1:]
+            f.write(sep.join(fields) + '\n')
+
+
+@pytest.mark.parametrize('sep, splitDate', [('\t', True), ('\t', False), (';', True)])
+@pytest.mark.parametrize('modeArgs', [[], ['--chunkSize', '500']])
+def test_asc_matches_csv(tmp_path, sep, splitDate, modeArgs):
+    ascPath = str(tmp_path / 'test-input.asc')
+    writeAsc(ascPath, sep, splitDate)
+
+    expectedDir = runCohort(str(tmp_path / 'csv'), ANALYSIS_ARGS + modeArgs)
+    cohortDir = runCohort(str(tmp_path / 'asc'), ANALYSIS_ARGS + modeArgs, ascPath)
+
+    assertCohortDirsMatch(cohortDir, expectedDir)
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+import sessions
+from conftest import runCohort
+
+
+@pytest.mark.parametrize('outputArgs', [
+    ['--outputFormat', 'npz', '--compress', 'gzip'],
+    ['--outputFormat', 'npz', '--compress', 'gzip', '--compressLevel', '9'],
+    ['--compressLevel', '9'],
+    ['--compress', 'gzip', '--compressLevel', '10'],
+])
+def test_compress_options_that_would_be_ignored_are_rejected(tmp_path, capsys, outputArgs):
+    with pytest.raises(SystemExit) as exitInfo:
+        runCohort(str(tmp_path), ['--outputs', 'bins'] + outputArgs)
+
+    assert exitInfo.value.code == 1
+    assert 'compress' in capsys.readouterr().out
+    assert not (tmp_path / 'test-input').exists()
+
+
+def test_outputAllToFile_passes_the_output_settings(tmp_path, monkeypatch, rawDf):
+    formattedTurnsDf, formattedDistanceDf, nullRows = sessions.formatTurnsDf(rawDf)
+    selectedDistanceDf = sessions.customStartDateTime(formattedDistanceDf, '8/21/2017 11:01', None)
+    baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+    binnedDict = sessions.binAllRules(selectedDistanceDf, [], baseParam)
+    sessionTable = sessions.calcSessions(selectedDistanceDf)
+    reformattedTable = sessions.reformatSessions(sessionTable)
+    percentRunRestDf = sessions.calcPercentRunRest(reformattedTable)
+    storePath = str(tmp_path / 'cohorts.sqlite')
+
+    monkeypatch.chdir(tmp_path)
+    sessions.outputAllToFile(rawDf, formattedTurnsDf, formattedDistanceDf, selectedDistanceDf,
+        baseParam, binnedDict['H'], binnedDict['1d'], None, sessionTable, reformattedTable,
+        percentRunRestDf, nullRows, 'test-input', artifacts=['sessions'], compress='gzip',
+        storePath=storePath, sessionLayout='long')
+
+    assert os.listdir(str(tmp_path / 'test-input')) == ['test-input_sessions.csv.gz']
+    assert len(sessions.queryStore(storePath, 'sessions')) == len(sessionTable['session'])
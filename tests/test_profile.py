@@ -0,0 +1,30 @@
+import json
+import os
+
+import pytest
+
+from conftest import runCohort
+
+
+def test_profile_report(tmp_path):
+    cohortDir = runCohort(str(tmp_path), ['--outputs', 'bins,sessions', '--profile'])
+
+    with open(os.path.join(cohortDir, 'test-input_profile.json')) as f:
+        report = json.load(f)
+    assert report['completed']
+    assert {'load', 'calcSessions', 'outputResults'} <= {stage['name'] for stage in report['stages']}
+
+
+def test_profile_report_written_when_a_file_fails(tmp_path, capsys):
+    # A folder in the way of one of the tables makes its write fail
+    os.makedirs(str(tmp_path / 'test-input' / 'test-input_bin_by_hour.csv'))
+
+    with pytest.raises(SystemExit) as exitInfo:
+        runCohort(str(tmp_path), ['--outputs', 'bins,sessions', '--profile'])
+    assert exitInfo.value.code == 1
+    assert 'could not be written' in capsys.readouterr().out
+
+    with open(str(tmp_path / 'test-input' / 'test-input_profile.json')) as f:
+        report = json.load(f)
+    assert not report['completed']
+    assert 'outputResults' in [stage['name'] for stage in report['stages']]
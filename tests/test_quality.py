@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import sessions
+
+MINUTE_NS = sessions.MINUTE_NS
+
+
+def qualityCounts(times, chunkSize=None):
+    quality = sessions.initQuality()
+    if chunkSize == None:
+        chunkSize = max(len(times), 1)
+    for start in range(0, len(times), chunkSize):
+        sessions.updateQuality(quality, times[start:start + chunkSize])
+    return sessions.finishQuality(quality), quality
+
+
+def test_quality_counts():
+    # 0-4, a 3 minute gap, 8 repeated, 6 out of order, 10-11 with 5 again
+    minutes = np.array([0, 1, 2, 3, 4, 8, 8, 6, 9, 10, 5, 11])
+    counts, quality = qualityCounts(minutes * MINUTE_NS)
+
+    assert counts == {'out_of_order_rows':2, 'duplicate_rows':1, 'missing_minutes':1, 'gaps':1}
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('chunkSize', [1, 7, 50])
+def test_quality_counts_same_in_chunks(seed, chunkSize):
+    rng = np.random.default_rng(seed)
+    minutes = np.arange(300) + np.cumsum(rng.random(300) < 0.05) * 3
+    minutes = np.insert(minutes, rng.integers(0, 300, 5), minutes[rng.integers(0, 300, 5)])
+    swaps = rng.integers(0, len(minutes), (4, 2))
+    minutes[swaps[:, 0]], minutes[swaps[:, 1]] = minutes[swaps[:, 1]], minutes[swaps[:, 0]]
+
+    assert qualityCounts(minutes * MINUTE_NS, chunkSize)[0] == qualityCounts(minutes * MINUTE_NS)[0]
+
+
+def test_quality_memory_does_not_grow_with_the_recording():
+    # A year of minutes with a gap each week, in chunks
+    times = np.arange(365 * 24 * 60, dtype=np.int64) * MINUTE_NS
+    times += (np.arange(len(times)) // (7 * 24 * 60)) * 10 * MINUTE_NS
+    counts, quality = qualityCounts(times, 10000)
+
+    assert counts['gaps'] == 52 and counts['missing_minutes'] == 52 * 10
+    assert len(quality['runStarts']) == 53 and len(quality['late']) == 0
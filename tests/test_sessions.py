@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import sessions
+
+
+def assertSessionTablesEqual(table, expected):
+    assert list(table['animals']) == list(expected['animals'])
+    for name in table:
+        if name == 'animals':
+            continue
+        if table[name].dtype.kind == 'f':
+            np.testing.assert_allclose(table[name], expected[name], err_msg=name)
+        else:
+            np.testing.assert_array_equal(table[name], expected[name], err_msg=name)
+
+
+@pytest.mark.parametrize('customStart, customEnd', [
+    (None, None),
+    ('8/21/2017 11:01', '8/23/2017 9:01'),
+    ('8/22/2017 3:17', None),
+])
+def test_calcSessions_matches_legacy(formattedDistanceDf, customStart, customEnd):
+    selectedDistanceDf = sessions.customStartDateTime(formattedDistanceDf, customStart, customEnd)
+
+    table = sessions.calcSessions(selectedDistanceDf)
+    expected = sessions.calcSessions(selectedDistanceDf, legacy=True)
+
+    assert len(table['session']) > 0
+    assertSessionTablesEqual(table, expected)
+
+
+def test_bout_rules():
+    # Runs at 2-3, 5-7, 12 and 16-19. The 1 minute rest at 4 is merged
+    # (mergeGap), the 1 minute run at 12 becomes rest (minRun) and the rests
+    # around it are joined, the 8 minute rest is long enough to stay (minRest)
+    distance = [0, 0, 5, 5, 0, 5, 5, 5, 0, 0, 0, 0, 5, 0, 0, 0, 5, 5, 5, 5, 0, 0]
+    colList = pd.MultiIndex.from_tuples([('t1', 'wild', '0')], names=['sample', 'group', 'sensor'])
+    df = pd.DataFrame(np.array(distance, dtype=float)[:, None], columns=colList,
+                      index=pd.date_range('2017-08-21 10:00', periods=len(distance), freq='min'))
+    minute = lambda i: (df.index[0] + pd.Timedelta(minutes=i)).value
+
+    table = sessions.calcSessions(df, bouts=sessions.boutRules(minRun=2, minRest=3, mergeGap=1))
+
+    np.testing.assert_array_equal(table['session'], [0, 1, 2])
+    np.testing.assert_array_equal(table['run_obs'], [False, True, True])
+    np.testing.assert_array_equal(table['run_mins'], [0, 6, 4])
+    np.testing.assert_array_equal(table['run_dist(m)'], [0, 25, 20])
+    np.testing.assert_array_equal(table['run_start'][1:], [minute(2), minute(16)])
+    np.testing.assert_array_equal(table['run_end'][1:], [minute(8), minute(20)])
+    np.testing.assert_array_equal(table['rest_mins'], [2, 8, 2])
+    np.testing.assert_array_equal(table['rest_start'], [minute(0), minute(8), minute(20)])
+
+
+def test_bout_rules_on_test_input(formattedDistanceDf):
+    bouts = sessions.boutRules(minRun=3, minRest=4, mergeGap=2, minDistance=0.5)
+    table = sessions.calcSessions(formattedDistanceDf, bouts=bouts)
+
+    isRun = table['run_obs']
+    assert (table['run_mins'][isRun] >= bouts['minRun']).all()
+
+    # Rests between two runs of the same animal are longer than both limits,
+    # only the first and last rest of an animal may be shorter
+    isLast = np.append(table['animal'][1:] != table['animal'][:-1], True)
+    innerRest = isRun & table['rest_obs'] & ~isLast & np.append(isRun[1:], False)
+    assert innerRest.any()
+    assert (table['rest_mins'][innerRest] >= max(bouts['minRest'], bouts['mergeGap'] + 1)).all()
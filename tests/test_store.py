@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sessions
+from conftest import TEST_INPUT, runCohort
+
+ANALYSIS_ARGS = ['-S', '8/21/2017 11:01', '-H', '4', '--outputs', 'bins,sessions']
+
+
+def test_store_holds_the_cohort(tmp_path, formattedDistanceDf):
+    storePath = str(tmp_path / 'cohorts.sqlite')
+    runCohort(str(tmp_path), ANALYSIS_ARGS + ['--store', storePath])
+
+    selectedDistanceDf = sessions.customStartDateTime(formattedDistanceDf, '8/21/2017 11:01', None)
+    baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+    hourlyDf = sessions.binAllRules(selectedDistanceDf, ['4'], baseParam)['H']
+    sessionTable = sessions.calcSessions(selectedDistanceDf)
+
+    animalsDf = sessions.queryStore(storePath, 'animals')
+    assert list(animalsDf['sample']) == list(selectedDistanceDf.columns.get_level_values(0))
+
+    # The minutes are stored from the start of the recording, like _formatted_distance
+    minutesDf = sessions.queryStore(storePath, 'minutes', sample='t1448')
+    assert len(minutesDf) == len(formattedDistanceDf)
+    np.testing.assert_allclose(minutesDf['distance'], formattedDistanceDf[('t1448', 'wild', '0')])
+
+    binsDf = sessions.queryStore(storePath, 'bins', rule='hour')
+    np.testing.assert_allclose(binsDf['distance'], hourlyDf.values.T.ravel())
+    assert len(sessions.queryStore(storePath, 'bins', rule='4H')) == 32 * 12
+
+    sessionsDf = sessions.queryStore(storePath, 'sessions')
+    assert len(sessionsDf) == len(sessionTable['session'])
+    restObs = sessionTable['rest_obs']
+    assert sessionsDf['rest_mins'].isnull().values.tolist() == (~restObs).tolist()
+    np.testing.assert_array_equal(sessionsDf['rest_mins'][restObs], sessionTable['rest_mins'][restObs])
+
+    windowDf = sessions.queryStore(storePath, 'minutes', start='2017-08-22 00:00',
+                                   end='2017-08-22 00:59', group='wild')
+    assert len(windowDf) == 60 * 8
+
+
+def test_incremental_store_matches_one_run(tmp_path):
+    fullStore = str(tmp_path / 'full.sqlite')
+    runCohort(str(tmp_path / 'full'), ANALYSIS_ARGS + ['--store', fullStore])
+
+    with open(TEST_INPUT) as f:
+        lines = f.readlines()
+    growingPath = str(tmp_path / 'grow' / 'test-input.csv')
+    growingStore = str(tmp_path / 'grow.sqlite')
+    os.makedirs(os.path.dirname(growingPath))
+    for numLines in [800, len(lines)]:
+        with open(growingPath, 'w') as f:
+            f.writelines(lines[:numLines])
+        runCohort(str(tmp_path / 'grow'), ANALYSIS_ARGS + ['--store', growingStore, '--incremental'],
+                  growingPath)
+
+    for table in ['minutes', 'bins', 'sessions']:
+        expected = sessions.queryStore(fullStore, table)
+        stored = sessions.queryStore(growingStore, table)
+        pd.testing.assert_frame_equal(stored, expected, check_exact=False, rtol=1e-9)
+
+
+@pytest.mark.parametrize('queryArgs', [
+    ['-t', 'minutes', '--rule', 'hour'],
+    ['-t', 'sessions', '--rule', 'day'],
+    ['-t', 'animals', '--start', '2017-08-22'],
+    ['-t', 'animals', '--end', '2017-08-22'],
+    ['--start', 'not a date'],
+])
+def test_query_rejects_filters_the_table_lacks(tmp_path, capsys, queryArgs):
+    storePath = str(tmp_path / 'cohorts.sqlite')
+    runCohort(str(tmp_path), ['--outputs', 'bins', '--store', storePath])
+    capsys.readouterr()
+
+    with pytest.raises(SystemExit) as exitInfo:
+        sessions.main(['query', storePath] + queryArgs)
+    assert exitInfo.value.code == 2
+    assert 'error:' in capsys.readouterr().err
+
+    table = queryArgs[1] if queryArgs[0] == '-t' else 'bins'
+    filters = {'--rule':'rule', '--start':'start', '--end':'end'}
+    with pytest.raises(SystemExit):
+        sessions.queryStore(storePath, table, **{filters[queryArgs[-2]]:queryArgs[-1]})
+
+
+@pytest.mark.parametrize('storeName', ['my cohorts.sqlite', 'run?1#2.sqlite', '100%.sqlite'])
+def test_query_opens_stores_with_uri_characters(tmp_path, monkeypatch, capsys, storeName):
+    storePath = str(tmp_path / storeName)
+    runCohort(str(tmp_path), ['--outputs', 'bins', '--store', storePath])
+    assert sorted(os.listdir(str(tmp_path))) == sorted(['test-input', storeName])
+
+    numAnimals = len(sessions.queryStore(storePath, 'animals'))
+    assert numAnimals > 0
+
+    monkeypatch.chdir(tmp_path)
+    capsys.readouterr()
+    sessions.main(['query', storeName, '--sql', 'SELECT COUNT(*) AS n FROM animals'])
+    assert capsys.readouterr().out.split() == ['n', str(numAnimals)]
+
+
+def test_store_minutes_in_chunks(tmp_path, monkeypatch, formattedDistanceDf):
+    fullStore = str(tmp_path / 'full.sqlite')
+    runCohort(str(tmp_path / 'full'), ['--outputs', 'bins', '--store', fullStore])
+
+    monkeypatch.setattr(sessions, 'STORE_CHUNK_ROWS', 7)
+    chunkedStore = str(tmp_path / 'chunked.sqlite')
+    runCohort(str(tmp_path / 'chunked'), ['--outputs', 'bins', '--store', chunkedStore])
+
+    minutesDf = sessions.queryStore(chunkedStore, 'minutes')
+    assert len(minutesDf) == formattedDistanceDf.size
+    pd.testing.assert_frame_equal(minutesDf, sessions.queryStore(fullStore, 'minutes'))
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+import sessions
+from conftest import TEST_INPUT, assertCohortDirsMatch, runCohort
+
+
+@pytest.mark.parametrize('modeArgs', [[], ['--chunkSize', '300'], ['--incremental']])
+def test_empty_selection_exits_with_message(tmp_path, monkeypatch, capsys, modeArgs):
+    monkeypatch.chdir(tmp_path)
+
+    with pytest.raises(SystemExit) as exitInfo:
+        sessions.main([TEST_INPUT, '-S', '9/21/2017 11:01', '--outputs', 'bins'] + modeArgs)
+
+    assert exitInfo.value.code == 1
+    assert 'No data in the selected window' in capsys.readouterr().out
+
+
+ANALYSIS_ARGS = ['-S', '8/21/2017 11:01', '-E', '8/23/2017 9:01', '-H', '4', '-H', '7',
+                 '--outputs', 'null,bins,percent,sessions,groups,circadian,synchrony']
+BOUT_ARGS = ['--minDistance', '0.5', '--mergeGap', '2', '--minRun', '3', '--minRest', '4']
+EXTRA_ARGS = ['--lightsOn', '7:00', '--lightsOff', '19:00', '--synchrony']
+
+
+@pytest.mark.parametrize('boutArgs', [[], BOUT_ARGS, EXTRA_ARGS])
+def test_streaming_matches_in_memory(tmp_path, boutArgs):
+    expectedDir = runCohort(str(tmp_path / 'memory'), ANALYSIS_ARGS + boutArgs)
+    cohortDir = runCohort(str(tmp_path / 'stream'), ANALYSIS_ARGS + boutArgs + ['--chunkSize', '333'])
+
+    assertCohortDirsMatch(cohortDir, expectedDir)
+
+
+@pytest.mark.parametrize('boutArgs', [[], BOUT_ARGS])
+def test_incremental_resume_matches_one_run(tmp_path, capsys, boutArgs):
+    expectedDir = runCohort(str(tmp_path / 'full'), ANALYSIS_ARGS + boutArgs)
+
+    with open(TEST_INPUT) as f:
+        lines = f.readlines()
+    growingPath = str(tmp_path / 'grow' / 'test-input.csv')
+    os.makedirs(os.path.dirname(growingPath))
+    capsys.readouterr()
+    for numLines in [500, 1700, len(lines)]:
+        with open(growingPath, 'w') as f:
+            f.writelines(lines[:numLines])
+        cohortDir = runCohort(str(tmp_path / 'grow'),
+                              ANALYSIS_ARGS + boutArgs + ['--incremental', '--chunkSize', '300'],
+                              growingPath)
+
+    # The later runs picked up where the last one stopped
+    assert 'starting over' not in capsys.readouterr().out
+    assertCohortDirsMatch(cohortDir, expectedDir)
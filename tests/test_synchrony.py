@@ -0,0 +1,21 @@
+import numpy as np
+
+import sessions
+
+
+def test_synchrony(formattedDistanceDf):
+    selectedDistanceDf = sessions.customStartDateTime(formattedDistanceDf, '8/21/2017 11:01', None)
+    baseParam = sessions.calcBaseParam(*sessions.getStartingTime(selectedDistanceDf))
+    hourlyDf = sessions.binAllRules(selectedDistanceDf, [], baseParam)['H']
+    sessionTable = sessions.calcSessions(selectedDistanceDf)
+
+    synchrony = sessions.calcSynchrony(selectedDistanceDf, hourlyDf, sessionTable)
+
+    np.testing.assert_allclose(synchrony['minuteCorr'].values,
+                               selectedDistanceDf.astype(float).corr().values, atol=1e-12)
+    np.testing.assert_allclose(synchrony['hourCorr'].values, hourlyDf.corr().values, atol=1e-12)
+    assert np.allclose(np.diag(synchrony['overlap'].values), 1)
+
+    # Groups in the same order as the other group tables
+    groupStatsDf = sessions.calcGroupStats(sessions.calcPercentRunRest(sessionTable), sessionTable)
+    assert list(synchrony['groups'].index) == list(groupStatsDf.index) + ['all']